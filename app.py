@@ -3,31 +3,52 @@ from dotenv import load_dotenv
 load_dotenv()
 
 import streamlit as st
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 import textgrad as tg
 from datetime import datetime
 import pandas as pd
 import io
 import os
+import time
 # import re # Not directly used here if parse_evaluation_output is solely in utils
 
 # --- Import from local modules ---
 from config import (
     AVAILABLE_MODELS, INITIAL_SYSTEM_PROMPT_TEXT,
-    USER_QUERY_TEMPLATE, EVALUATION_PROMPT_TEMPLATE
+    EVALUATION_PROMPT_TEMPLATE, CONVERGENCE_MIN_IMPROVEMENT, HISTORY_PAGE_SIZE
 )
 from textgrad_utils import (
     get_generator_engine, get_evaluator_engine, handle_textgrad_exception
 )
+from llm_cache import get_response_cache
+from engine_wrappers import set_backward_engine
 from ui_components import (
     view_edit_prompt_ui, display_df_with_download_and_copy,
-    display_text_with_copy_and_download, 
+    display_text_with_copy_and_download, live_table_callbacks, display_prescore_report, display_usage_metrics,
+    display_trace_summary, display_beam_lineage, display_run_bundle_download,
+    parse_table_cached, prescore_table_cached,
     render_understanding_optimization_section
 )
+from table_stream import stream_listener
+from prompt_cache import cache_eligible_pct
 from utils import ( 
-    parse_evaluation_output, save_prompt_to_library,
-    load_prompt_from_library, get_saved_prompts_list,
+    save_prompt_to_library,
+    load_prompt_from_library, get_saved_prompts_list, get_saved_prompts_index,
+    suggest_warm_start_prompts, load_warm_start_prompt,
     ensure_saved_prompts_dir # Ensure this is called early if needed
 )
+from pipeline import (
+    EXTERNAL_DATA_KEYS, validate_user_inputs, format_user_query,
+    build_format_data, source_dedup_report, make_user_prompt_var, generate_table, evaluate_table, run_optimization,
+    resume_optimization, parse_profiles, run_minibatch_optimization, run_beam_optimization
+)
+from run_journal import RunJournal, list_runs
+from optimization_jobs import submit_job, get_job
+from rate_limiter import set_scheduler_session, rate_limit_stats
+from call_policy import call_policy_stats
+from tracing import Tracer, activate_tracer, start_span, span, traced
+from convergence import describe_stop_reason
+from history_store import HistoryStore, summary_rows
 
 # --- Page Configuration ---
 st.set_page_config(layout="wide", page_title="TextGrad Report Optimizer")
@@ -45,6 +66,11 @@ def initialize_session_state():
         'eval_prompt_mode': 'view',
         'generator_llm_name': "Gemini 1.5 Flash", # Default, ensure it's in AVAILABLE_MODELS
         'evaluator_llm_name': "Gemini 2.5 Flash Preview", 
+        'cache_generator_responses': False,
+        'cache_evaluator_responses': False, # Keep off for fresh evaluator samples
+        'hedge_slow_calls': False, # Duplicate calls slower than the recent p95 (costs extra quota)
+        'stream_generation': False,
+        'last_stream_stats': None,
         'user_input_data': {},
         'external_data_provided': False,
         'formatted_user_prompt_text': "",
@@ -54,7 +80,6 @@ def initialize_session_state():
         'last_generated_table_variable': None,
         'generated_prompt_for_eval': "",
         'last_evaluation_output': "",
-        'last_loss_object': None,
         'last_evaluation_score': None,
         'last_evaluation_description': "",
         'last_evaluation_feedback': "",
@@ -68,9 +93,31 @@ def initialize_session_state():
         'best_optimized_step': -1,
         'num_opt_steps': 3,
         'target_score_thresh': 90,
-        'optimization_history': [],
+        'evaluator_samples': 1,
+        'prescore_gate': False,
+        'prefix_stable_eval_prompt': False, # Same default as batch_optimize.py (--prompt-layout template)
+        'json_evaluation': False,
+        'budget_minutes': 0.0, # Convergence control (convergence.py); 0 = no limit / off
+        'budget_tokens': 0,
+        'budget_cost_usd': 0.0,
+        'convergence_patience': 0,
+        'convergence_min_improvement': CONVERGENCE_MIN_IMPROVEMENT,
+        'beam_search': False, # Beam search over candidate prompts instead of the sequential loop
+        'beam_width': 2,
+        'beam_proposals': 2,
+        'minibatch_batch_size': 4, # Profiles per step of a minibatch optimization (0 = all)
+        'run_journal_id': None,
+        'optimization_stop_reason': None,
+        'optimization_metrics': None, # Run LLM usage by phase/model (call_metrics.py)
+        'optimization_job_id': None, # Background optimization job of this session (see optimization_jobs.py)
+        'optimization_history': HistoryStore(),
         'prompt_library_selector_key': 0, # Used to force re-render of selectbox if list changes
+        'warm_start_from_library': False, # Opt-in: it replaces the editor's prompt
+        'warm_start_profile_key': None, # Profile the warm-start prompt was last picked for
+        'warm_start_prompt_text': None, # Prompt the last warm start loaded (may be replaced by the next one)
         'selected_prompt_from_library_name': "Use Initial Default Prompt", # Initial state for dropdown
+        'profiling_mode': False, # Trace pipeline stages and rendering of every rerun (tracing.py)
+        'tracer': None, # The session's Tracer while profiling
     }
     for key, value in defaults.items():
         if key not in st.session_state:
@@ -86,37 +133,42 @@ def initialize_session_state():
         st.session_state.evaluator_llm_name = list(AVAILABLE_MODELS.keys())[eval_idx]
 
 
+def current_session_id():
+    ctx = get_script_run_ctx()
+    return ctx.session_id if ctx else None
+
+
 initialize_session_state()
+# LLM calls of this session queue fairly against other sessions when a model's quota is exhausted
+set_scheduler_session(current_session_id() or "default")
+# Re-attach to a background optimization job after a browser refresh (its ID is kept in the URL)
+if (not st.session_state.optimization_job_id and hasattr(st, "query_params")
+        and get_job(st.query_params.get("job")) is not None):
+    st.session_state.optimization_job_id = st.query_params.get("job")
+# Profiling mode: the checkbox's new value applies to this rerun already
+if st.session_state.get('profiling_mode_checkbox', st.session_state.profiling_mode):
+    if st.session_state.tracer is None:
+        st.session_state.tracer = Tracer("app")
+    activate_tracer(st.session_state.tracer)
+else:
+    activate_tracer(None)
+rerun_span = start_span("streamlit_rerun")
+section_span = start_span("render: sidebar")
 
 # --- Helper: Display Table ---
 
 
+@traced("try_display_table")
 def try_display_table(table_text, key_suffix="display", download_filename="generated_report"):
     if not table_text or not isinstance(table_text, str): # Added check for isinstance
         st.info("No table content to display.")
         return
 
     try:
-        lines = table_text.strip().split('\n')
-        header_index = 0
-        # More robust header detection: find the line that *starts* with "Strategic Imperative" or similar
-        # and contains multiple tab characters, suggesting it's a header row.
-        for i, line in enumerate(lines):
-            # Check if the line starts with a known header and has tabs (likely a TSV header)
-            if line.strip().lower().startswith('"strategic imperative"') and '\t' in line:
-                header_index = i
-                break
-            # Fallback for slightly different quoting, if necessary
-            elif line.strip().lower().startswith('strategic imperative') and '\t' in line:
-                 header_index = i
-                 break
-        
-        processed_table_text = "\n".join(lines[header_index:])
-
-        table_io = io.StringIO(processed_table_text)
+        df, processed_table_text, parse_error = parse_table_cached(table_text)
+        if parse_error:
+            raise ValueError(parse_error)
 
-        df = pd.read_csv(table_io, sep='\t', quotechar='"', quoting=csv.QUOTE_MINIMAL, keep_default_na=False, dtype=str, skipinitialspace=True)
-        
         # Check if DataFrame is empty or has only headers after processing
         if df.empty and processed_table_text.strip():
              st.warning("Could not parse table into DataFrame structure. Displaying raw text. Please check TSV format and quoting.")
@@ -140,6 +192,119 @@ def try_display_table(table_text, key_suffix="display", download_filename="gener
             key_suffix=f"raw_table_error_{key_suffix}",
             filename=f"{download_filename}_raw_error.txt"
         )
+# --- Helper: Store Optimization Result ---
+def store_optimization_result(opt_result):
+    """Copies a run_optimization result into session state for Sections 4 and 5."""
+    st.session_state.learnable_system_prompt_var = opt_result["system_prompt_var"]
+    # Compressed, with older steps spilled to disk (history_store.py); the job's own copy is released
+    st.session_state.optimization_history = HistoryStore(opt_result["history"])
+    st.session_state.run_journal_id = opt_result.get("run_id")
+    st.session_state.optimization_stop_reason = opt_result.get("stop_reason")
+    st.session_state.optimization_metrics = opt_result.get("metrics")
+
+    st.session_state.best_optimized_system_prompt_text = opt_result["best_prompt"]
+    st.session_state.best_optimized_table_text = opt_result["best_table"]
+    st.session_state.best_optimized_score = opt_result["best_score"]
+    st.session_state.best_optimized_description = opt_result["best_description"]
+    st.session_state.best_optimized_feedback = opt_result["best_feedback"]
+    st.session_state.best_optimized_step = opt_result["best_step"]
+
+    # Update the main editable system prompt to the *final* state of the learnable variable
+    if st.session_state.get('learnable_system_prompt_var') is not None:
+       st.session_state.current_system_prompt_text = st.session_state.learnable_system_prompt_var.value
+
+    st.session_state.app_step = 3
+    # Increment key to force prompt library selectbox to re-fetch options if a new prompt was saved during optimization (though save is manual after)
+    st.session_state.prompt_library_selector_key += 1
+
+# --- Helpers: Background Optimization Jobs ---
+JOB_POLL_SECONDS = 2
+
+
+def optimization_job_active():
+    job = get_job(st.session_state.optimization_job_id)
+    return job is not None and not job.finished
+
+
+def start_optimization_job(run_func, total_steps, label, **run_kwargs):
+    """Submits an optimization run to the background workers and remembers its job ID (also in the URL)."""
+    job = submit_job(run_func, total_steps, label=label, session_id=current_session_id(), **run_kwargs)
+    st.session_state.optimization_job_id = job.job_id
+    if hasattr(st, "query_params"):
+        st.query_params["job"] = job.job_id # A browser refresh re-attaches to the running job
+    return job
+
+
+def convergence_settings():
+    """Budgets and early-stopping settings of Section 3 for run_optimization(convergence=...)."""
+    return {
+        "max_seconds": st.session_state.budget_minutes * 60 or None,
+        "max_tokens": st.session_state.budget_tokens or None,
+        "max_cost_usd": st.session_state.budget_cost_usd or None,
+        "patience": st.session_state.convergence_patience or None,
+        "min_improvement": st.session_state.convergence_min_improvement,
+    }
+
+
+def clear_optimization_job():
+    st.session_state.optimization_job_id = None
+    if hasattr(st, "query_params") and "job" in st.query_params:
+        del st.query_params["job"]
+
+
+def optimization_job_panel():
+    """Progress of this session's background optimization job; polled while the job runs."""
+    job = get_job(st.session_state.optimization_job_id)
+    if job is None:
+        st.info("The background optimization job is no longer available (server restarted or result expired). "
+                "Interrupted runs can be resumed from the run journal.")
+        clear_optimization_job()
+        return
+    snapshot = job.snapshot()
+    if job.finished:
+        if snapshot["status"] == "failed":
+            st.error(f"Optimization job failed: {snapshot['error']}")
+            clear_optimization_job()
+            return
+        if job.released: # Already taken over (e.g. by another tab of this session)
+            clear_optimization_job()
+            return
+        store_optimization_result(job.result)
+        job.release()
+        clear_optimization_job()
+        st.rerun()
+
+    status_label = {"queued": "Waiting for a free worker", "running": "Running", "cancelling": "Cancelling"}
+    st.markdown(f"**Background optimization** `{snapshot['job_id']}` — {snapshot['label']}: "
+                f"{status_label.get(snapshot['status'], snapshot['status'])} "
+                f"(step {snapshot['current_step']}/{snapshot['num_steps']}, {snapshot['elapsed_seconds']:.0f}s)")
+    st.progress(min(len(snapshot["history"]) / max(snapshot["num_steps"], 1), 1.0))
+    if snapshot["best"]:
+        st.caption(f"Best so far: {snapshot['best']['score']}/100 at step {snapshot['best']['step']}.")
+    if snapshot["history"]:
+        st.dataframe(pd.DataFrame([{
+            "Step": entry["step"], "Score": entry.get("score"), "Description": (entry.get("description") or "")[:120],
+            "Seconds": (entry.get("timings") or {}).get("total_seconds"),
+        } for entry in snapshot["history"]]), hide_index=True)
+    live_table = snapshot["live_table"]
+    if live_table and live_table["restart"]:
+        st.warning(f"Generation attempt {live_table['restart'][0]} broke the table format and was restarted: "
+                   f"{live_table['restart'][1]}")
+    elif live_table and live_table["rows"]:
+        st.caption(f"Table being generated in step {snapshot['current_step']} ({len(live_table['rows'])} rows so far):")
+        st.dataframe(pd.DataFrame(live_table["rows"], columns=live_table["header"]), use_container_width=True)
+    for _, level, message in snapshot["messages"][-3:]:
+        if level == "error":
+            st.error(message)
+        elif level == "warning":
+            st.warning(message)
+        else:
+            st.text(message)
+    if st.button("⏹️ Cancel Optimization", disabled=snapshot["status"] == "cancelling", key="cancel_optimization_job"):
+        job.cancel()
+        st.toast("Cancelling after the current step; the best result so far will be kept.")
+
+
 # --- Sidebar: User Inputs (Remains the same as your last version) ---
 with st.sidebar:
     st.header("0. Define User Inputs")
@@ -157,22 +322,54 @@ with st.sidebar:
     user_input_data["unrelated_keywords"] = st.text_input("Unrelated Keywords", value=user_input_data.get("unrelated_keywords", ""), key='unrelated_keywords_input')
 
     st.subheader("External Data Inputs (Paste Here - At least one required)")
-    external_data_keys = ["google_agent_output", "bard_outputs", "web_content", "url_output", "gnews_output"]
     external_data_provided_flag = False
-    for key in external_data_keys:
+    for key in EXTERNAL_DATA_KEYS:
         user_input_data[key] = st.text_area(key.replace("_", " ").title(), value=user_input_data.get(key, ""), height=100, key=f'{key}_input')
         if user_input_data[key] and user_input_data[key].strip(): # Check if not None and not empty string
             external_data_provided_flag = True
 
+    user_input_data["dedupe_sources"] = st.checkbox(
+        "Collapse near-duplicate content across sources", value=user_input_data.get("dedupe_sources", False),
+        key='dedupe_sources_input',
+        help="Sentences repeated (nearly verbatim) in several sources are kept once, tagged with the other sources "
+             "and their URLs. Shrinks both the generator and the evaluator prompts, but rewrites the source text "
+             "they receive, so it is off by default (as `--dedupe-sources` in batch_optimize.py)."
+    )
+    if user_input_data["dedupe_sources"] and external_data_provided_flag:
+        dedup_report = source_dedup_report(user_input_data)
+        st.caption(
+            f"Removed {dedup_report['passages_removed']} duplicate passage(s): ~{dedup_report['saved_tokens']} of "
+            f"{dedup_report['tokens_before']} source tokens saved ({dedup_report['saved_pct']}%) per prompt."
+        )
+        if dedup_report["merges"]:
+            with st.expander("View collapsed passages"):
+                for kept_source, dropped_source, similarity, snippet in dedup_report["merges"]:
+                    st.markdown(f"- `{dropped_source}` → kept in `{kept_source}` ({similarity:.0%} similar): _{snippet}…_")
+
     st.session_state.user_input_data = user_input_data
     st.session_state.external_data_provided = external_data_provided_flag
 
+    st.subheader("Profiling")
+    st.session_state.profiling_mode = st.checkbox(
+        "Profiling mode", value=st.session_state.profiling_mode, key='profiling_mode_checkbox',
+        help="Record nested timing spans (prompt formatting, LLM calls, parsing, backward/optimizer, rendering) "
+             "for every rerun and optimization run. Summary and trace file at the bottom of the page."
+    )
+
+section_span.end()
+section_span = start_span("render: engine selection")
+
 # --- Main Application ---
 st.title(" Table Report Generator & Optimizer Using ---**TextGrad**---")
 
 # --- LLM Engine Selection (Remains the same as your last version) ---
 st.markdown("---")
 st.header("LLM Engine Selection")
+st.session_state.hedge_slow_calls = st.checkbox(
+    "Hedge slow LLM calls", value=st.session_state.hedge_slow_calls, key='hedge_slow_calls_checkbox',
+    help="Send a duplicate request when a call takes longer than 95% of recent calls of its kind and use whichever "
+         "answers first. Cuts tail latency at the cost of some extra quota. Not applied to streamed generations."
+)
 col_gen, col_eval = st.columns(2)
 with col_gen:
     # Ensure index is valid
@@ -190,7 +387,20 @@ with col_gen:
         help="Choose the LLM for generating table reports."
     )
     st.session_state.generator_llm_name = selected_generator_llm_key
-    llm_engine = get_generator_engine(AVAILABLE_MODELS[selected_generator_llm_key])
+    st.session_state.cache_generator_responses = st.checkbox(
+        "Cache generator responses", value=st.session_state.cache_generator_responses, key='cache_generator_checkbox',
+        help="Serve identical generator calls (same model, prompts and parameters) from the local response cache."
+    )
+    st.session_state.stream_generation = st.checkbox(
+        "Stream table generation", value=st.session_state.stream_generation, key='stream_generation_checkbox',
+        help="Show rows as they are generated and restart a generation early if it breaks the table format."
+    )
+    llm_engine = get_generator_engine(
+        AVAILABLE_MODELS[selected_generator_llm_key],
+        use_cache=st.session_state.cache_generator_responses,
+        streaming=st.session_state.stream_generation,
+        hedge=st.session_state.hedge_slow_calls
+    )
 
 with col_eval:
     eval_llm_keys = list(AVAILABLE_MODELS.keys())
@@ -211,19 +421,89 @@ with col_eval:
     # This is conceptual, actual TextGrad API for model_kwargs might differ
     # evaluator_model_kwargs = {"temperature": 0.1} # Example
     # llm_evaluator = get_evaluator_engine(AVAILABLE_MODELS[selected_evaluator_llm_key], model_kwargs=evaluator_model_kwargs)
-    llm_evaluator = get_evaluator_engine(AVAILABLE_MODELS[selected_evaluator_llm_key]) # Simpler for now
+    st.session_state.cache_evaluator_responses = st.checkbox(
+        "Cache evaluator responses", value=st.session_state.cache_evaluator_responses, key='cache_evaluator_checkbox',
+        help="Also caches backward/optimizer calls. Leave off to draw fresh evaluation samples."
+    )
+    llm_evaluator = get_evaluator_engine(AVAILABLE_MODELS[selected_evaluator_llm_key], use_cache=st.session_state.cache_evaluator_responses,
+                                         hedge=st.session_state.hedge_slow_calls) # Simpler for now
     # llm_evaluator = tg.get_engine(AVAILABLE_MODELS[selected_evaluator_llm_key],cache=False) # Simpler for now
-    tg.set_backward_engine(llm_evaluator, override=True)
-
+    set_backward_engine(llm_evaluator)
+
+if st.session_state.cache_generator_responses or st.session_state.cache_evaluator_responses:
+    cache_stats = get_response_cache().stats()
+    st.caption(
+        f"Response cache: {cache_stats['hits']} hits / {cache_stats['misses']} misses "
+        f"({cache_stats['hit_ratio']:.0%} hit ratio), {cache_stats['entries']} entries, "
+        f"{cache_stats['bytes'] / (1024 * 1024):.1f} MB of {cache_stats['max_bytes'] / (1024 * 1024):.0f} MB, "
+        f"{cache_stats['evictions']} evictions."
+    )
+for limiter_stats in rate_limit_stats():
+    if limiter_stats["calls"]:
+        st.caption(
+            f"Rate limit {limiter_stats['model']}: {limiter_stats['rpm']:g} req/min x {limiter_stats['keys']} key(s); "
+            f"{limiter_stats['calls']} calls, {limiter_stats['waited_calls']} waited "
+            f"(max {limiter_stats['max_wait_seconds']:.1f}s), {limiter_stats['queued']} queued now, "
+            f"{limiter_stats['quota_errors']} quota errors."
+        )
+policy_stats = call_policy_stats()
+if policy_stats["calls"]:
+    st.caption(
+        f"LLM calls: {policy_stats['calls']} calls, {policy_stats['attempts']} attempts, "
+        f"{sum(policy_stats['retries'].values())} retries, {policy_stats['hedges']} hedged "
+        f"({policy_stats['hedge_wins']} won), {policy_stats['failures'] + policy_stats['deadline_exceeded']} failed."
+    )
     
 
 st.markdown("---")
+section_span.end()
+section_span = start_span("render: section 1")
 
 # --- Section 1: Initial Table Generation (WITH PROMPT LIBRARY) ---
 st.header("1. Initial Table Generation")
 
 st.subheader("Load or Define System Prompt") # <-- SUBHEADER FOR THIS SECTION
-saved_prompts_files = get_saved_prompts_list() 
+saved_prompts_index = get_saved_prompts_index()
+library_sort_labels = {"Newest first": "saved", "Highest score": "score", "Name": "name"}
+library_sort = "saved"
+library_min_score = library_industry = library_region = None
+if saved_prompts_index:
+    with st.expander(f"Sort / filter the prompt library ({len(saved_prompts_index)} saved)", expanded=False):
+        lib_col1, lib_col2, lib_col3, lib_col4 = st.columns(4)
+        library_sort = library_sort_labels[lib_col1.selectbox("Sort by", list(library_sort_labels), key="library_sort_by")]
+        library_min_score = lib_col2.number_input("Min. score", min_value=0, max_value=100, value=0, step=5,
+                                                  key="library_min_score") or None
+        library_industry = lib_col3.text_input("Industry contains", key="library_industry_filter").strip() or None
+        library_region = lib_col4.text_input("Region contains", key="library_region_filter").strip() or None
+# Warm start: pick the library prompt saved for the most similar context (and highest score)
+if saved_prompts_index:
+    warm_start_matches = suggest_warm_start_prompts(st.session_state.user_input_data)
+    st.checkbox("Warm-start from the best library match for this profile", key="warm_start_from_library",
+                help="Ranks saved prompts by similarity of their industry/region/journey to the sidebar inputs, "
+                     "blended with the score they were saved with, and loads the best match when the profile changes. "
+                     "Only replaces the initial default prompt or an earlier warm-start prompt, never your edits.")
+    if warm_start_matches:
+        st.caption("Library matches for this profile: " + "; ".join(
+            f"{m['name']} (similarity {m['similarity']:.2f}, score {m['score'] if m['score'] is not None else 'n/a'})"
+            for m in warm_start_matches))
+    profile_key = tuple(st.session_state.user_input_data.get(k) for k in ("industry", "region", "transformational_journey"))
+    editor_unmodified = st.session_state.current_system_prompt_text in (INITIAL_SYSTEM_PROMPT_TEXT,
+                                                                        st.session_state.warm_start_prompt_text)
+    if (st.session_state.warm_start_from_library and warm_start_matches and st.session_state.app_step == 0
+            and st.session_state.warm_start_profile_key != profile_key and editor_unmodified):
+        warm_start_prompt, warm_start_match = load_warm_start_prompt(st.session_state.user_input_data)
+        if warm_start_prompt:
+            st.session_state.current_system_prompt_text = warm_start_prompt
+            st.session_state.current_system_prompt_text_backup = warm_start_prompt
+            st.session_state.warm_start_prompt_text = warm_start_prompt
+            st.session_state.selected_prompt_from_library_name = warm_start_match["filename"]
+            if 'prompt_library_selector_actual' in st.session_state:
+                del st.session_state['prompt_library_selector_actual'] # Re-created below with the match selected
+            st.session_state.warm_start_profile_key = profile_key
+            st.toast(f"Warm start: loaded '{warm_start_match['name']}' (similarity {warm_start_match['similarity']:.2f}).")
+
+saved_prompts_files = get_saved_prompts_list(sort_by=library_sort, min_score=library_min_score,
+                                             industry=library_industry, region=library_region)
 prompt_options_map = {"Use Initial Default Prompt": INITIAL_SYSTEM_PROMPT_TEXT, 
                       "Use Current Editor Content": st.session_state.current_system_prompt_text}
 display_options = ["Use Initial Default Prompt", "Use Current Editor Content"]
@@ -266,12 +546,23 @@ def on_prompt_selection_change():
     st.session_state.current_system_prompt_text_backup = st.session_state.current_system_prompt_text
 
 
+def format_library_option(option, library_index):
+    entry = library_index.get(option)
+    if not entry:
+        return option
+    context = entry["context_inputs"]
+    details = [f"score {entry['score']}" if entry["score"] is not None else "no score"]
+    details += [context[k] for k in ("industry", "region") if context.get(k)]
+    return f"{entry['name']} ({' | '.join(details)})"
+
+
 selected_prompt_source_actual = st.selectbox( # <--- THIS IS THE DROPDOWN
     "Choose System Prompt Source:",
     display_options,
     index=default_index_selectbox,
     key='prompt_library_selector_actual', 
     on_change=on_prompt_selection_change,
+    format_func=lambda option: format_library_option(option, saved_prompts_index),
     help="Select a pre-saved prompt, the initial default, or use/edit the content currently in the editor below."
 )
 
@@ -287,11 +578,7 @@ if st.session_state.app_step == 0:
     # ... (Generate Initial Table button and logic remains the same as your provided version) ...
     st.info("Define inputs in the sidebar, select LLMs, choose/edit the System Prompt, then click below.")
     if st.button("🚀 Generate Initial Table", type="primary"):
-        mandatory_fields = ["industry", "region", "transformational_journey", "program_area"]
-        validation_errors = [f"- **{field.replace('_', ' ').title()}** cannot be empty."
-                             for field in mandatory_fields if not st.session_state.user_input_data.get(field, "").strip()]
-        if not st.session_state.external_data_provided:
-            validation_errors.append("- At least one **External Data Input** must be provided.")
+        validation_errors = validate_user_inputs(st.session_state.user_input_data)
 
         if validation_errors:
             st.error("Please fix the following input errors before proceeding:")
@@ -299,25 +586,18 @@ if st.session_state.app_step == 0:
         else:
             with st.spinner(f"Generating initial table using {st.session_state.generator_llm_name}... This may take a moment."):
                 try:
-                    current_year = datetime.now().year
-                    future_year_delta = st.session_state.user_input_data.get("future_year", 20)
-                    absolute_future_year = current_year + future_year_delta
-
-                    format_data = st.session_state.user_input_data.copy()
-                    format_data["current_year"] = current_year
-                    format_data["future_year"] = absolute_future_year
-
-                    st.session_state.formatted_user_prompt_text = USER_QUERY_TEMPLATE.format(**format_data)
+                    st.session_state.formatted_user_prompt_text = format_user_query(st.session_state.user_input_data)
                     st.session_state.learnable_system_prompt_var = tg.Variable(
                         st.session_state.current_system_prompt_text, 
                         requires_grad=True, role_description="System prompt for generating the table report"
                     )
-                    st.session_state.formatted_user_prompt_var = tg.Variable(
-                        st.session_state.formatted_user_prompt_text, requires_grad=False,
-                        role_description="User inputs and contextual data for table generation"
-                    )
-                    model = tg.BlackboxLLM(llm_engine, system_prompt=st.session_state.learnable_system_prompt_var)
-                    generated_table_variable = model(st.session_state.formatted_user_prompt_var)
+                    st.session_state.formatted_user_prompt_var = make_user_prompt_var(st.session_state.formatted_user_prompt_text)
+                    live_table_placeholder = st.empty()
+                    with stream_listener(*live_table_callbacks(live_table_placeholder)):
+                        generated_table_variable = generate_table(
+                            llm_engine, st.session_state.learnable_system_prompt_var, st.session_state.formatted_user_prompt_var
+                        )
+                    st.session_state.last_stream_stats = getattr(llm_engine, "last_stream_stats", None) if st.session_state.stream_generation else None
 
                     st.session_state.last_generated_table_text = generated_table_variable.value
                     st.session_state.last_generated_table_variable = generated_table_variable
@@ -333,11 +613,24 @@ if st.session_state.app_step == 0:
 
 if st.session_state.app_step >= 1:
     st.subheader("Generated Table:")
+    stream_stats = st.session_state.last_stream_stats
+    if stream_stats and stream_stats.get("time_to_first_row") is not None:
+        st.caption(
+            f"Streamed: first row after {stream_stats['time_to_first_row']:.1f}s, {stream_stats['rows']} rows, "
+            f"{len(stream_stats['aborts'])} malformed attempt(s) aborted."
+        )
     try_display_table(st.session_state.last_generated_table_text, "initial_gen", "initial_report")
+    if st.session_state.last_generated_table_text:
+        format_data = build_format_data(st.session_state.user_input_data)
+        display_prescore_report(prescore_table_cached(
+            st.session_state.last_generated_table_text, format_data["current_year"], format_data["future_year"]
+        ))
 elif st.session_state.app_step >= 1 and not st.session_state.last_generated_table_text: # Check type
     st.warning("Table generation was attempted but did not produce valid content. Please check logs or try again.")
 
 st.markdown("---")
+section_span.end()
+section_span = start_span("render: section 2")
 
 # --- Section 2: Evaluation (Ensure download buttons are active) ---
 st.header("2. Evaluate Generated Table")
@@ -357,38 +650,21 @@ if st.session_state.app_step >= 1:
         else:
             with st.spinner(f"Running evaluation using {st.session_state.evaluator_llm_name}... This may take a moment."):
                 try:
-                    eval_user_inputs = st.session_state.user_input_data
-                    current_year = datetime.now().year
-                    future_year_delta = eval_user_inputs.get("future_year", 20)
-                    absolute_future_year = current_year + future_year_delta
-
-                    format_data_for_eval = eval_user_inputs.copy()
-                    format_data_for_eval["current_year"] = current_year
-                    format_data_for_eval["future_year"] = absolute_future_year
-
-                    eval_instruction_text = st.session_state.evaluation_prompt_template_text.format(
-                        system_prompt_text=st.session_state.generated_prompt_for_eval, 
-                        user_query_text=st.session_state.formatted_user_prompt_text,
-                        generated_table_text=st.session_state.last_generated_table_text,
-                        **format_data_for_eval
-                    )
-                    
-
-                    st.session_state.loss_instruction_var = tg.Variable(
-                        eval_instruction_text, requires_grad=False,
-                        role_description="Instruction for evaluating the system prompt's output against the evaluation criteria and providing feedback to SYSTEM PROMPT for improvement." 
-                    )
-                    st.session_state.loss_fn = tg.TextLoss(st.session_state.loss_instruction_var, engine=llm_evaluator)
                     # Ensure last_generated_table_variable is valid
                     if not st.session_state.last_generated_table_variable or not hasattr(st.session_state.last_generated_table_variable, 'value'):
                         st.error("Error: `last_generated_table_variable` is not set up correctly for evaluation.")
                         raise ValueError("Generated table variable is missing or invalid.")
 
-                    loss = st.session_state.loss_fn(st.session_state.last_generated_table_variable)
+                    loss, score, desc, feedback = evaluate_table(
+                        llm_evaluator, st.session_state.evaluation_prompt_template_text,
+                        st.session_state.generated_prompt_for_eval, st.session_state.formatted_user_prompt_text,
+                        st.session_state.last_generated_table_variable, st.session_state.user_input_data,
+                        role_description="Instruction for evaluating the system prompt's output against the evaluation criteria and providing feedback to SYSTEM PROMPT for improvement.",
+                        prompt_layout="prefix_stable" if st.session_state.prefix_stable_eval_prompt else "template",
+                        evaluation_format="json" if st.session_state.json_evaluation else "markdown"
+                    )
 
                     st.session_state.last_evaluation_output = loss.value
-                    st.session_state.last_loss_object = loss # Store for potential backward pass
-                    score, desc, feedback = parse_evaluation_output(loss.value)
                     st.session_state.last_evaluation_score = score
                     st.session_state.last_evaluation_description = desc
                     st.session_state.last_evaluation_feedback = feedback
@@ -428,9 +704,32 @@ if st.session_state.app_step >= 2:
         )
 
 st.markdown("---")
+section_span.end()
+section_span = start_span("render: section 3")
 
 # --- Section 3: System Prompt Optimization (Ensure download button for prompt) ---
 st.header("3. System Prompt Optimization")
+interrupted_runs = list_runs(incomplete_only=True)
+if interrupted_runs:
+    with st.expander(f"Resume an interrupted optimization run ({len(interrupted_runs)} found in the run journal)"):
+        run_labels = {
+            f"{r['run_id']} — {r['steps_completed']}/{r['num_steps']} steps done, best score {r['best_score']}": r
+            for r in interrupted_runs
+        }
+        selected_run_label = st.selectbox("Interrupted run", list(run_labels.keys()), key='resume_run_select')
+        st.caption("Completed steps are restored from the journal; the remaining steps run with the engines selected above.")
+        if st.button("⏯️ Resume Selected Run", disabled=optimization_job_active()):
+            selected_run = run_labels[selected_run_label]
+            start_optimization_job(
+                resume_optimization, selected_run["num_steps"], f"Resume of {selected_run['run_id']}",
+                journal_path=selected_run["path"], generator_engine=llm_engine, evaluator_engine=llm_evaluator,
+            )
+            st.rerun()
+if st.session_state.optimization_job_id:
+    if hasattr(st, "fragment"):
+        st.fragment(run_every=JOB_POLL_SECONDS)(optimization_job_panel)()
+    else:
+        optimization_job_panel()
 if st.session_state.app_step >= 2 and st.session_state.last_evaluation_score is not None:
     st.info("The system prompt below (from selected source or last optimized state) will be improved. Adjust parameters as needed.")
     view_edit_prompt_ui(
@@ -441,7 +740,7 @@ if st.session_state.app_step >= 2 and st.session_state.last_evaluation_score is
         filename_base="system_prompt_for_optimization" # Pass filename_base
     )
     # ... (Optimization parameters and Run Optimization button/logic remains the same as your provided version) ...
-    col_opt_params1, col_opt_params2 = st.columns(2)
+    col_opt_params1, col_opt_params2, col_opt_params3 = st.columns(3)
     with col_opt_params1:
         st.session_state.num_opt_steps = st.number_input(
             "Number of Optimization Steps", min_value=1, max_value=20, 
@@ -454,116 +753,166 @@ if st.session_state.app_step >= 2 and st.session_state.last_evaluation_score is
             value=st.session_state.target_score_thresh, format="%d", key='target_score_thresh_input',
             help="Optimization will stop if a score >= this value is achieved."
         )
+    with col_opt_params3:
+        st.session_state.evaluator_samples = st.number_input(
+            "Evaluator Samples per Step", min_value=1, max_value=7,
+            value=st.session_state.evaluator_samples, format="%d", key='evaluator_samples_input',
+            help="Score each step by the median of up to this many evaluator samples, drawn in parallel. "
+                 "Sampling stops early once the score is clearly above or below the current best. "
+                 "Needs the evaluator response cache to be off."
+        )
+    st.session_state.prefix_stable_eval_prompt = st.checkbox(
+        "Prefix-stable evaluation prompt (provider prompt caching)", value=st.session_state.prefix_stable_eval_prompt,
+        key='prefix_stable_eval_prompt_input',
+        help="Moves the per-step parts of the evaluation prompt (system prompt, generated table) after the rubric and "
+             "user query, so most of each evaluator request repeats a prefix the provider can cache. Off by default "
+             "(as `--prompt-layout template` in batch_optimize.py) since it changes what the evaluator reads first."
+    )
+    st.session_state.json_evaluation = st.checkbox(
+        "Structured (JSON) evaluator output", value=st.session_state.json_evaluation, key='json_evaluation_input',
+        help="Ask the evaluator for a schema-validated JSON result (points per sub-criterion, total, description, "
+             "feedback) instead of markdown. Invalid JSON gets one correction request, then falls back to markdown."
+    )
+    st.session_state.prescore_gate = st.checkbox(
+        "Pre-score tables locally before evaluation", value=st.session_state.prescore_gate, key='prescore_gate_input',
+        help="Run the rule-based format checks on each generated table first. Failing tables are regenerated once; "
+             "if they still fail, the step skips the evaluator and the failed checks become the optimizer's feedback."
+    )
 
-    if st.button("✨ Run Optimization", type="primary"):
+    st.session_state.beam_search = st.checkbox(
+        "Beam search over candidate prompts", value=st.session_state.beam_search, key='beam_search_input',
+        help="Keep several prompts instead of one: each step every kept prompt gets several optimizer proposals, all "
+             "candidates are generated and evaluated in parallel, and only the best-scoring prompts are kept."
+    )
+    if st.session_state.beam_search:
+        col_beam1, col_beam2 = st.columns(2)
+        with col_beam1:
+            st.session_state.beam_width = st.number_input(
+                "Beam Width (prompts kept)", min_value=1, max_value=6, value=st.session_state.beam_width,
+                format="%d", key='beam_width_input')
+        with col_beam2:
+            st.session_state.beam_proposals = st.number_input(
+                "Proposals per Prompt and Step", min_value=1, max_value=4, value=st.session_state.beam_proposals,
+                format="%d", key='beam_proposals_input',
+                help="Each step evaluates up to width × proposals new candidates (evaluator samples and the "
+                     "pre-score gate are not used in beam search).")
+
+    with st.expander("Budgets and early stopping"):
+        st.caption("Stops a run before a step that would exceed a budget (projected from the recent steps), or once the "
+                   "score has not improved for a number of steps and its smoothed trend is flat. Close to either limit, "
+                   "steps use a single evaluator sample and no regenerations. 0 = off.")
+        col_budget1, col_budget2, col_budget3 = st.columns(3)
+        with col_budget1:
+            st.session_state.budget_minutes = st.number_input(
+                "Time Budget (minutes)", min_value=0.0, value=float(st.session_state.budget_minutes), step=1.0,
+                key='budget_minutes_input')
+        with col_budget2:
+            st.session_state.budget_tokens = st.number_input(
+                "Token Budget (estimated)", min_value=0, value=st.session_state.budget_tokens, step=10000, format="%d",
+                key='budget_tokens_input')
+        with col_budget3:
+            st.session_state.budget_cost_usd = st.number_input(
+                "Cost Budget (USD, estimated)", min_value=0.0, value=float(st.session_state.budget_cost_usd), step=0.05,
+                format="%.2f", key='budget_cost_input', help="Priced with MODEL_PRICING (config.py).")
+        col_patience1, col_patience2 = st.columns(2)
+        with col_patience1:
+            st.session_state.convergence_patience = st.number_input(
+                "Patience (steps without improvement)", min_value=0, max_value=20,
+                value=st.session_state.convergence_patience, format="%d", key='convergence_patience_input')
+        with col_patience2:
+            st.session_state.convergence_min_improvement = st.number_input(
+                "Minimum Improvement (score points)", min_value=0.0, max_value=20.0,
+                value=float(st.session_state.convergence_min_improvement), step=0.5, key='convergence_min_improvement_input',
+                help="A step only counts as progress if it beats the best score by at least this much.")
+
+    if st.button("✨ Run Optimization", type="primary", disabled=optimization_job_active()):
         if not st.session_state.get('formatted_user_prompt_var') or st.session_state.last_evaluation_score is None:
             st.warning("Cannot optimize. Ensure a table has been generated and successfully evaluated in prior steps.")
         else:
-            with st.spinner(f"Running optimization for {st.session_state.num_opt_steps} steps... This will take time."):
-                st.session_state.learnable_system_prompt_var = tg.Variable(
-                    st.session_state.current_system_prompt_text, # Uses the potentially loaded/edited prompt
-                    requires_grad=True, role_description="System prompt being optimized by TextGrad"
+            st.session_state.optimization_history = HistoryStore() # Clear history for a new run
+            if st.session_state.beam_search:
+                start_optimization_job(
+                    run_beam_optimization, st.session_state.num_opt_steps,
+                    f"{st.session_state.num_opt_steps}-step beam search (width {st.session_state.beam_width})",
+                    system_prompt_text=st.session_state.current_system_prompt_text,
+                    user_input_data=dict(st.session_state.user_input_data),
+                    generator_engine=llm_engine, evaluator_engine=llm_evaluator,
+                    evaluation_template=st.session_state.evaluation_prompt_template_text,
+                    num_steps=st.session_state.num_opt_steps,
+                    target_score=st.session_state.target_score_thresh,
+                    beam_width=st.session_state.beam_width,
+                    proposals_per_prompt=st.session_state.beam_proposals,
+                    prompt_layout="prefix_stable" if st.session_state.prefix_stable_eval_prompt else "template",
+                    evaluation_format="json" if st.session_state.json_evaluation else "markdown",
+                    journal=RunJournal(),
+                    convergence=convergence_settings(),
+                )
+            else:
+                start_optimization_job(
+                    run_optimization, st.session_state.num_opt_steps, f"{st.session_state.num_opt_steps}-step optimization",
+                    system_prompt_text=st.session_state.current_system_prompt_text, # Uses the potentially loaded/edited prompt
+                    user_input_data=dict(st.session_state.user_input_data), # Consistent inputs for optimization
+                    generator_engine=llm_engine, evaluator_engine=llm_evaluator,
+                    evaluation_template=st.session_state.evaluation_prompt_template_text,
+                    num_steps=st.session_state.num_opt_steps,
+                    target_score=st.session_state.target_score_thresh,
+                    # Starting point: the last manually evaluated prompt/table
+                    initial_result={
+                        "prompt": st.session_state.generated_prompt_for_eval, # Prompt that achieved the last manual score
+                        "table": st.session_state.last_generated_table_text,
+                        "score": st.session_state.last_evaluation_score,
+                        "description": st.session_state.last_evaluation_description,
+                        "feedback": st.session_state.last_evaluation_feedback,
+                    },
+                    evaluator_samples=st.session_state.evaluator_samples,
+                    prescore_gate=st.session_state.prescore_gate,
+                    prompt_layout="prefix_stable" if st.session_state.prefix_stable_eval_prompt else "template",
+                    evaluation_format="json" if st.session_state.json_evaluation else "markdown",
+                    journal=RunJournal(),
+                    convergence=convergence_settings(),
+                )
+            st.rerun()
+
+    with st.expander("Minibatch optimization across several input profiles"):
+        st.caption("Optimizes one system prompt for several profiles at once: each step generates and evaluates a table "
+                   "per profile of the batch in parallel and applies a single update from all their feedback. "
+                   "Profiles use the JSON/JSONL format of batch_optimize.py (external data inline, not as *_file).")
+        minibatch_file = st.file_uploader("Profiles file", type=["json", "jsonl"], key='minibatch_profiles_file')
+        include_current_profile = st.checkbox("Include the current profile from the sidebar", value=True,
+                                              key='minibatch_include_current')
+        st.session_state.minibatch_batch_size = st.number_input(
+            "Profiles per Step (0 = all)", min_value=0, max_value=50,
+            value=st.session_state.minibatch_batch_size, format="%d", key='minibatch_batch_size_input',
+            help="Steps rotate through the profiles in batches of this size; the best prompt is picked by mean batch score."
+        )
+        if st.button("🧮 Run Minibatch Optimization", disabled=optimization_job_active()):
+            minibatch_profiles = []
+            try:
+                if minibatch_file is not None:
+                    minibatch_profiles = parse_profiles(minibatch_file.getvalue().decode("utf-8"))
+            except (ValueError, OSError) as e:
+                st.error(f"Could not read the profiles file: {e}")
+            if include_current_profile:
+                minibatch_profiles.insert(0, dict(st.session_state.user_input_data, id="current_profile"))
+            if not minibatch_profiles:
+                st.warning("Upload a profiles file or include the current profile.")
+            else:
+                st.session_state.optimization_history = HistoryStore()
+                start_optimization_job(
+                    run_minibatch_optimization, st.session_state.num_opt_steps,
+                    f"{st.session_state.num_opt_steps}-step minibatch optimization over {len(minibatch_profiles)} profiles",
+                    system_prompt_text=st.session_state.current_system_prompt_text,
+                    profiles=minibatch_profiles,
+                    generator_engine=llm_engine, evaluator_engine=llm_evaluator,
+                    evaluation_template=st.session_state.evaluation_prompt_template_text,
+                    num_steps=st.session_state.num_opt_steps,
+                    target_score=st.session_state.target_score_thresh,
+                    batch_size=st.session_state.minibatch_batch_size or None,
+                    prompt_layout="prefix_stable" if st.session_state.prefix_stable_eval_prompt else "template",
+                    evaluation_format="json" if st.session_state.json_evaluation else "markdown",
+                    journal=RunJournal(),
+                    convergence=convergence_settings(),
                 )
-                model = tg.BlackboxLLM(llm_engine, system_prompt=st.session_state.learnable_system_prompt_var)
-                optimizer = tg.TGD(parameters=[st.session_state.learnable_system_prompt_var])
-
-                # Initialize tracking for best result, starting with the last manually evaluated one
-                best_score = st.session_state.last_evaluation_score
-                best_prompt = st.session_state.generated_prompt_for_eval # Prompt that achieved the last manual score
-                best_table = st.session_state.last_generated_table_text
-                best_description = st.session_state.last_evaluation_description
-                best_feedback = st.session_state.last_evaluation_feedback
-                best_step_num = 0 # 0 for initial state before optimization loop
-
-                st.session_state.optimization_history = [] # Clear history for a new run
-                optimization_progress = st.progress(0)
-                status_text = st.empty()
-                opt_user_inputs = st.session_state.user_input_data # Consistent inputs for optimization
-
-                for step in range(st.session_state.num_opt_steps):
-                    current_opt_step_display = step + 1
-                    status_text.text(f"Optimization Step {current_opt_step_display}/{st.session_state.num_opt_steps}...")
-                    optimization_progress.progress(current_opt_step_display / st.session_state.num_opt_steps)
-
-                    try:
-                        prompt_before_update_this_step = st.session_state.learnable_system_prompt_var.value
-                        generated_table_var_opt = model(st.session_state.formatted_user_prompt_var)
-                        current_table_text_opt = generated_table_var_opt.value
-
-                        current_year = datetime.now().year
-                        future_year_delta = opt_user_inputs.get("future_year", 20)
-                        abs_future_year = current_year + future_year_delta
-                        format_data_eval_opt = opt_user_inputs.copy()
-                        format_data_eval_opt["current_year"] = current_year
-                        format_data_eval_opt["future_year"] = abs_future_year
-
-                        eval_instr_opt = st.session_state.evaluation_prompt_template_text.format(
-                            system_prompt_text=prompt_before_update_this_step, 
-                            user_query_text=st.session_state.formatted_user_prompt_text,
-                            generated_table_text=current_table_text_opt,
-                            **format_data_eval_opt
-                        )
-                        loss_instr_var_opt = tg.Variable(eval_instr_opt, requires_grad=False, role_description="Evaluation instruction for optimization step")
-                        loss_fn_opt = tg.TextLoss(loss_instr_var_opt, engine=llm_evaluator)
-                        loss_opt = loss_fn_opt(generated_table_var_opt)
-                        current_eval_output_opt = loss_opt.value
-
-                        score_opt, desc_opt, feedback_opt = parse_evaluation_output(current_eval_output_opt)
-
-                        history_entry = {
-                            "step": current_opt_step_display, "prompt": prompt_before_update_this_step,
-                            "table": current_table_text_opt, "score": score_opt,
-                            "description": desc_opt, "feedback": feedback_opt,
-                            "evaluation_raw": current_eval_output_opt
-                        }
-                        st.session_state.optimization_history.append(history_entry)
-
-                        if score_opt is not None and score_opt > best_score:
-                            best_score, best_prompt, best_table = score_opt, prompt_before_update_this_step, current_table_text_opt
-                            best_description, best_feedback, best_step_num = desc_opt, feedback_opt, current_opt_step_display
-                            status_text.text(f"Step {current_opt_step_display}: New best score {best_score}!")
-
-                        if score_opt is not None and score_opt >= st.session_state.target_score_thresh:
-                            status_text.text(f"Target score reached at step {current_opt_step_display}! Score: {score_opt}.")
-                            st.session_state.current_system_prompt_text = prompt_before_update_this_step 
-                            break 
-
-                        if score_opt is not None: 
-                            loss_opt.backward()
-                            optimizer.step()
-                            optimizer.zero_grad()
-                        else:
-                            st.warning(f"Step {current_opt_step_display}: Invalid score parsed. Skipping optimizer update for this step.")
-                            
-                    except Exception as e_opt:
-                        st.error(f"Error in optimization step {current_opt_step_display}: {e_opt}")
-                        # Log the error in history
-                        error_history_entry = {
-                            "step": current_opt_step_display, 
-                            "prompt": st.session_state.learnable_system_prompt_var.value if 'learnable_system_prompt_var' in st.session_state and st.session_state.learnable_system_prompt_var else "N/A",
-                            "table": "Error during this step.", "score": None,
-                            "description": f"Error: {e_opt}", "feedback": "Optimization step failed.",
-                            "evaluation_raw": f"Error: {e_opt}"
-                        }
-                        st.session_state.optimization_history.append(error_history_entry)
-                        
-                status_text.text("Optimization process finished.")
-                optimization_progress.progress(1.0)
-
-                st.session_state.best_optimized_system_prompt_text = best_prompt
-                st.session_state.best_optimized_table_text = best_table
-                st.session_state.best_optimized_score = best_score
-                st.session_state.best_optimized_description = best_description
-                st.session_state.best_optimized_feedback = best_feedback
-                st.session_state.best_optimized_step = best_step_num
-
-                # Update the main editable system prompt to the *final* state of the learnable variable
-                if st.session_state.get('learnable_system_prompt_var') is not None:
-                   st.session_state.current_system_prompt_text = st.session_state.learnable_system_prompt_var.value
-
-                st.session_state.app_step = 3
-                # Increment key to force prompt library selectbox to re-fetch options if a new prompt was saved during optimization (though save is manual after)
-                st.session_state.prompt_library_selector_key += 1
                 st.rerun()
 
 elif st.session_state.app_step >= 2:
@@ -571,11 +920,19 @@ elif st.session_state.app_step >= 2:
 
 
 st.markdown("---")
+section_span.end()
+section_span = start_span("render: section 4")
 
 # --- Section 4: Best Optimization Result (Ensure download and SAVE buttons are active) ---
 st.header("4. Best Optimization Result")
 if st.session_state.app_step >= 3 and st.session_state.best_optimized_score is not None:
-    st.success(f"Optimization run complete. The best result achieved is shown below.")
+    if st.session_state.optimization_stop_reason == "cancelled":
+        st.warning("Optimization run was cancelled. The best result found before cancelling is shown below.")
+    elif st.session_state.optimization_stop_reason in ("time_budget", "token_budget", "cost_budget", "plateau"):
+        st.success(f"Optimization stopped early: {describe_stop_reason(st.session_state.optimization_stop_reason)}. "
+                   "The best result achieved is shown below.")
+    else:
+        st.success("Optimization run complete. The best result achieved is shown below.")
     st.metric(
         "Highest Score Achieved During Optimization",
         f"{st.session_state.best_optimized_score}/100",
@@ -583,6 +940,15 @@ if st.session_state.app_step >= 3 and st.session_state.best_optimized_score is n
               if st.session_state.best_optimized_step > 0
               else "This was the score from the initial evaluation before optimization steps.")
     )
+    if st.session_state.optimization_metrics:
+        display_usage_metrics(
+            st.session_state.optimization_metrics, st.session_state.optimization_history.summaries(),
+            run_info={"run_id": st.session_state.run_journal_id, "stop_reason": st.session_state.optimization_stop_reason,
+                      "generator_model": st.session_state.generator_llm_name,
+                      "evaluator_model": st.session_state.evaluator_llm_name,
+                      "best_score": st.session_state.best_optimized_score},
+            key_suffix=st.session_state.run_journal_id or "run"
+        )
 
     with st.expander("View Best Optimized System Prompt", expanded=True): # Expanded by default
         display_text_with_copy_and_download( 
@@ -652,14 +1018,40 @@ elif st.session_state.app_step >= 3:
     st.info("Optimization was run, but no valid best score was recorded or an error occurred. Check the history for details.")
 
 st.markdown("---")
+section_span.end()
+section_span = start_span("render: section 5")
 
 # --- Section 5: Optimization History (Ensure download buttons are active) ---
 st.header("5. Optimization History")
 if 'optimization_history' in st.session_state and st.session_state.optimization_history:
+    history_store = st.session_state.optimization_history
+    display_beam_lineage(history_store.summaries(), key_suffix=st.session_state.run_journal_id or "run",
+                         load_candidate=history_store.find_candidate)
+    # One summary row per step; built from the light per-step fields, no step is decoded for it
+    st.dataframe(pd.DataFrame(summary_rows(history_store.summaries(), st.session_state.best_optimized_step)),
+                 hide_index=True, use_container_width=True)
+    display_run_bundle_download(
+        history_store, run_info={"run_id": st.session_state.run_journal_id,
+                                 "stop_reason": st.session_state.optimization_stop_reason,
+                                 "best_step": st.session_state.best_optimized_step,
+                                 "best_score": st.session_state.best_optimized_score},
+        key_suffix=st.session_state.run_journal_id or "run"
+    )
     with st.expander("View Step-by-Step Optimization Details", expanded=False):
-        # Display history in reverse chronological order (most recent step first)
-        history_list = st.session_state.optimization_history
-        for i, entry in enumerate(reversed(history_list)): # Iterate reversed list
+        # Most recent step first, one page of HISTORY_PAGE_SIZE steps at a time: only those are decoded and rendered
+        page_count = -(-len(history_store) // HISTORY_PAGE_SIZE)
+        history_page = 0
+        if page_count > 1:
+            step_numbers = [summary['step'] for summary in history_store.summaries()]
+            page_newest = lambda page: len(step_numbers) - 1 - page * HISTORY_PAGE_SIZE
+            history_page = st.selectbox(
+                "Steps", range(page_count), key='history_page_select',
+                format_func=lambda page: (f"Steps {step_numbers[page_newest(page)]} to "
+                                          f"{step_numbers[max(page_newest(page) - HISTORY_PAGE_SIZE + 1, 0)]}")
+            )
+        newest_index = len(history_store) - 1 - history_page * HISTORY_PAGE_SIZE
+        for i in range(newest_index, max(newest_index - HISTORY_PAGE_SIZE, -1), -1):
+            entry = history_store.get(i) # Decoded on demand (history_store.py)
             actual_step_number = entry['step'] # Use the step number from the entry
             is_best_this_entry = (actual_step_number == st.session_state.best_optimized_step and
                                   entry['score'] == st.session_state.best_optimized_score and
@@ -672,28 +1064,88 @@ if 'optimization_history' in st.session_state and st.session_state.optimization_
             with st.container(): # Use container for better visual separation
                 st.markdown(header_md)
                 score_display = f"{entry['score']}/100" if entry['score'] is not None else "N/A (Error or Parse Issue)"
+                prescore_info = entry.get('prescore')
+                if entry['score'] is None and prescore_info and not prescore_info.get('passed'):
+                    score_display = f"N/A (Rejected by local checks: {prescore_info['local_score']}/{prescore_info['local_max']} local pts)"
+                ensemble_info = entry.get('evaluation_samples')
+                if entry['score'] is not None and ensemble_info and ensemble_info.get('n', 0) > 1:
+                    score_display += (f" (median of {ensemble_info['n']} evaluator samples {ensemble_info['scores']}, "
+                                      f"spread ±{ensemble_info['spread']:.1f}"
+                                      f"{', stopped early' if ensemble_info.get('stopped_early') else ''})")
+                if entry.get('candidate'): # Beam search: the step's best new candidate
+                    new_candidates = [c for c in entry.get('beam', []) if not c.get('carried')]
+                    score_display += f" (candidate {entry['candidate']}, best of {len(new_candidates)} new candidates)"
+                check_info = entry.get('score_check')
+                if check_info and check_info.get('repair') == 'sum_mismatch':
+                    score_display += (f" ⚠️ stated {check_info['stated_score']}, but the awarded points add up to "
+                                      f"{check_info['computed_score']}; the sum is used")
+                elif check_info and check_info.get('repair') == 'missing_score':
+                    score_display += " ⚠️ no readable overall score; sum of the awarded points used"
+                elif check_info and check_info.get('repair') == 'restated':
+                    score_display += " ⚠️ overall score unreadable; restated by the evaluator"
+                elif check_info and check_info.get('mismatch'):
+                    score_display += (f" ⚠️ stated score differs from the {check_info['criteria']} awarded sub-criteria "
+                                      f"({check_info['computed_score']}/{check_info['max_points']} pts)")
+                evaluation_info = entry.get('evaluation')
+                if evaluation_info and evaluation_info.get('fallback'):
+                    score_display += " · JSON evaluation invalid; markdown fallback used"
+                elif evaluation_info:
+                    score_display += (f" · JSON evaluation (schema {evaluation_info['result']['schema_version']}"
+                                      f"{', corrected' if evaluation_info.get('corrected') else ''})")
+                cache_info = entry.get('prompt_cache')
+                if cache_info and cache_info.get('prompt_tokens'):
+                    score_display += (f" · ~{cache_info['cached_tokens']:,}/{cache_info['prompt_tokens']:,} prompt tokens "
+                                      f"cache-eligible ({cache_eligible_pct(cache_info)}%)")
+                metrics_info = entry.get('metrics')
+                if metrics_info and metrics_info['total']['calls']:
+                    score_display += (f" · {metrics_info['total']['calls']} LLM calls, "
+                                      f"~{metrics_info['total']['input_tokens'] + metrics_info['total']['output_tokens']:,} tokens, "
+                                      f"~${metrics_info['total']['cost_usd']:.4f} ("
+                                      + ", ".join(f"{phase} {c['llm_seconds']:.1f}s" for phase, c in metrics_info['phases'].items())
+                                      + ")")
+                convergence_info = entry.get('convergence')
+                if convergence_info and convergence_info.get('smoothed_score') is not None:
+                    score_display += (f" · smoothed {convergence_info['smoothed_score']} (trend {convergence_info['trend']:+}), "
+                                      f"{convergence_info['stale_steps']} steps without improvement"
+                                      f"{', reduced effort' if convergence_info.get('reduced_effort') else ''}")
+                call_info = entry.get('calls')
+                if call_info and (sum(call_info['retries'].values()) or call_info['hedges'] or call_info['deadline_exceeded']):
+                    score_display += (f" · {sum(call_info['retries'].values())} retries "
+                                      f"({', '.join(f'{n} {c}' for c, n in call_info['retries'].items() if n) or 'none'}), "
+                                      f"{call_info['hedges']} hedged ({call_info['hedge_wins']} won)"
+                                      f"{', ' + str(call_info['deadline_exceeded']) + ' past deadline' if call_info['deadline_exceeded'] else ''}")
                 if is_best_this_entry:
                     st.markdown(f"**Score:** <span style='color:green; font-weight:bold;'>🌟 {score_display}</span>", unsafe_allow_html=True)
                 else:
                     st.markdown(f"**Score:** {score_display}")
+                if entry.get('batch'): # Minibatch run: the step's per-profile scores
+                    st.dataframe(pd.DataFrame([{"profile": r["id"], "score": r["score"], "description": r["description"]}
+                                               for r in entry['batch']]), hide_index=True, use_container_width=True)
+                if evaluation_info and evaluation_info.get('result'): # Structured evaluation: points per sub-criterion
+                    with st.expander(f"Points per criterion (Step {actual_step_number})"):
+                        st.dataframe(pd.DataFrame(evaluation_info['result']['criteria']), hide_index=True,
+                                     use_container_width=True)
 
                 col_hist_prompt, col_hist_details = st.columns([0.6, 0.4]) 
                 with col_hist_prompt:
                     display_text_with_copy_and_download( 
                         f"System Prompt Used (Step {actual_step_number})", entry.get('prompt',""), height=250,
                         key_suffix=f"hist_prompt_{actual_step_number}_{i}", # Ensure unique key
-                        filename=f"history_step_{actual_step_number}_prompt.txt"
+                        filename=f"history_step_{actual_step_number}_prompt.txt",
+                        download=False # In the run bundle instead of one eager download per text
                     )
                 with col_hist_details:
                     display_text_with_copy_and_download( 
                         f"Evaluator Feedback (Step {actual_step_number})", entry.get('feedback',""), height=100,
                         key_suffix=f"hist_feed_{actual_step_number}_{i}",  # Ensure unique key
-                        filename=f"history_step_{actual_step_number}_feedback.txt"
+                        filename=f"history_step_{actual_step_number}_feedback.txt",
+                        download=False # In the run bundle instead of one eager download per text
                     )
                     display_text_with_copy_and_download( 
                         f"Scoring Description (Step {actual_step_number})", entry.get('description',""), height=100,
                         key_suffix=f"hist_desc_{actual_step_number}_{i}", # Ensure unique key
-                        filename=f"history_step_{actual_step_number}_description.txt"
+                        filename=f"history_step_{actual_step_number}_description.txt",
+                        download=False # In the run bundle instead of one eager download per text
                     )
                 
                 show_full_table_key = f"show_full_table_step_{actual_step_number}_{i}" # Ensure unique key
@@ -710,4 +1162,18 @@ else:
 st.markdown("---")
 
 # --- Section 6: Understanding Optimization (Remains the same) ---
-render_understanding_optimization_section()
\ No newline at end of file
+section_span.end()
+with span("render: section 6"):
+    render_understanding_optimization_section()
+rerun_span.end()
+
+# --- Profiling Results (profiling mode) ---
+if st.session_state.profiling_mode and st.session_state.tracer is not None:
+    st.markdown("---")
+    display_trace_summary(st.session_state.tracer)
+
+
+# Without st.fragment (older Streamlit), poll a running background job by rerunning the whole script
+if not hasattr(st, "fragment") and optimization_job_active():
+    time.sleep(JOB_POLL_SECONDS)
+    st.rerun()
@@ -0,0 +1,85 @@
+import asyncio
+import contextvars
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from config import MAX_CONCURRENT_LLM_CALLS
+
+# TextGrad engines (and the HTTP clients behind them) are synchronous. All LLM calls made through
+# this module run on one shared, bounded thread pool, so every session in the process reuses the
+# same worker threads/connections and at most MAX_CONCURRENT_LLM_CALLS requests are in flight.
+_engine_pool = None
+_engine_pool_lock = threading.Lock()
+
+
+def get_engine_pool():
+    """Returns the process-wide thread pool used for blocking LLM calls (created on first use)."""
+    global _engine_pool
+    if _engine_pool is None:
+        with _engine_pool_lock:
+            if _engine_pool is None:
+                _engine_pool = ThreadPoolExecutor(
+                    max_workers=MAX_CONCURRENT_LLM_CALLS, thread_name_prefix="llm-call"
+                )
+    return _engine_pool
+
+
+async def run_in_engine_pool(func, *args, **kwargs):
+    """
+    Awaits a blocking call (engine call, BlackboxLLM forward, TextLoss, loss.backward(), optimizer.step())
+    on the shared engine pool.
+    NOTE: Functions submitted here must not themselves wait on the pool, or the pool can deadlock.
+    """
+    loop = asyncio.get_running_loop()
+    # Run in a copy of the caller's context so per-run trackers (contextvars) see pooled calls
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(get_engine_pool(), functools.partial(context.run, func, *args, **kwargs))
+
+
+class AsyncEngine:
+    """
+    Async-capable wrapper around a TextGrad engine.
+    `await engine.generate(...)` runs the wrapped engine on the shared pool; every other
+    attribute is delegated, so the wrapped engine can still be used synchronously.
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+
+    async def generate(self, prompt, system_prompt=None, **kwargs):
+        return await run_in_engine_pool(self.engine, prompt, system_prompt=system_prompt, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.engine, name)
+
+
+async def gather_calls(*awaitables, return_exceptions=False):
+    """Runs independent LLM calls concurrently; the shared pool bounds how many are actually in flight."""
+    return await asyncio.gather(*awaitables, return_exceptions=return_exceptions)
+
+
+def run_async(coro):
+    """
+    Runs a coroutine to completion from synchronous code (e.g. the Streamlit script thread).
+    If an event loop is already running in this thread, the coroutine is run on a helper thread.
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+
+    result = {}
+
+    def _runner():
+        try:
+            result["value"] = asyncio.run(coro)
+        except BaseException as e:
+            result["error"] = e
+
+    thread = threading.Thread(target=contextvars.copy_context().run, args=(_runner,), name="run-async")
+    thread.start()
+    thread.join()
+    if "error" in result:
+        raise result["error"]
+    return result["value"]
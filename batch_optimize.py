@@ -0,0 +1,392 @@
+"""
+Headless batch optimizer.
+
+Runs the same generate -> evaluate -> TGD loop as Section 3 of the Streamlit app for every
+profile in a JSON / JSONL file, spreading the profiles over worker processes.
+
+Each profile is a `user_input_data` dict as built by the sidebar, e.g.:
+    {"id": "uae_ride_hailing", "industry": "mobility", "region": "middle east",
+     "transformational_journey": "shared mobility", "program_area": "ride hailing",
+     "google_agent_output_file": "GOOGLE AGENT OURPUT.txt", "gnews_output": "..."}
+External sources can be given inline (e.g. "bard_outputs") or as a path ("bard_outputs_file").
+
+Usage:
+    python batch_optimize.py profiles.jsonl --workers 4 --steps 5 --output-dir logs/batch_run
+"""
+import argparse
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import nullcontext
+from datetime import datetime
+
+from dotenv import load_dotenv
+
+from config import AVAILABLE_MODELS, INITIAL_SYSTEM_PROMPT_TEXT, EVALUATION_PROMPT_TEMPLATE, CONVERGENCE_MIN_IMPROVEMENT
+from pipeline import (
+    parse_profiles, validate_user_inputs, run_optimization, resume_optimization, run_minibatch_optimization,
+    run_beam_optimization, source_dedup_report
+)
+from run_journal import RunJournal, read_journal
+from textgrad_utils import create_engine
+from engine_wrappers import set_backward_engine
+from rate_limiter import configure_limit_share
+from prompt_cache import PROMPT_LAYOUTS
+from evaluation_schema import EVALUATION_FORMATS
+from utils import load_warm_start_prompt
+from call_metrics import metrics_report
+from tracing import tracing_session
+
+DEFAULT_OUTPUT_ROOT = "logs"
+
+
+def load_profiles(profiles_path):
+    """
+    Loads user input profiles from a JSON list or a JSONL file.
+    '<source>_file' entries are resolved relative to the profiles file and inlined as '<source>'.
+    Returns:
+        list: Profile dicts, each with an 'id'.
+    """
+    with open(profiles_path, "r", encoding="utf-8") as f:
+        raw = f.read()
+    return parse_profiles(raw, base_dir=os.path.dirname(os.path.abspath(profiles_path)))
+
+
+def _init_worker(workers):
+    # Each worker process needs its own API keys in the environment
+    load_dotenv()
+    # Quotas are per API key, not per process: each worker paces itself to its share
+    configure_limit_share(1.0 / workers)
+
+
+def optimize_profile(profile, generator_model, evaluator_model, system_prompt_text,
+                     evaluation_template, num_steps, target_score, output_dir,
+                     cache_generator=False, cache_evaluator=False, evaluator_samples=1, stream_generation=False,
+                     prescore_gate=False, prompt_layout="template", resume=False, warm_start=False, hedge=False,
+                     trace=False, convergence=None, beam_width=1, proposals_per_prompt=2, evaluation_format="markdown"):
+    """
+    Runs one profile end to end inside a worker process and writes its results.
+    `convergence` (budgets, patience; see convergence.py) applies to each profile's run separately.
+    With `beam_width` above 1, each profile runs a beam search (pipeline.run_beam_optimization) instead
+    of the sequential loop.
+    With `trace`, the profile's pipeline stages are traced to <output_dir>/<id>/trace.json (tracing.py).
+    With `warm_start`, the profile starts from its best prompt library match (if any) instead of
+    `system_prompt_text`.
+    Every completed step is journaled to <output_dir>/<id>/journal.jsonl; with `resume`, an interrupted
+    journal is continued from its last completed step instead of starting over.
+    Returns:
+        dict: Summary row for the batch report.
+    """
+    profile_id = profile["id"]
+    if trace:
+        with tracing_session(profile_id, path=os.path.join(output_dir, profile_id, "trace.json")):
+            return optimize_profile(
+                profile, generator_model, evaluator_model, system_prompt_text, evaluation_template, num_steps,
+                target_score, output_dir, cache_generator=cache_generator, cache_evaluator=cache_evaluator,
+                evaluator_samples=evaluator_samples, stream_generation=stream_generation, prescore_gate=prescore_gate,
+                prompt_layout=prompt_layout, resume=resume, warm_start=warm_start, hedge=hedge,
+                convergence=convergence, beam_width=beam_width, proposals_per_prompt=proposals_per_prompt,
+                evaluation_format=evaluation_format,
+            )
+    user_input_data = {k: v for k, v in profile.items() if k != "id"}
+    started_at = datetime.now()
+    summary = {"id": profile_id, "status": "ok", "best_score": None, "best_step": None, "steps_run": 0}
+
+    try:
+        generator_engine = create_engine(AVAILABLE_MODELS[generator_model], use_cache=cache_generator,
+                                         streaming=stream_generation, hedge=hedge)
+        evaluator_engine = create_engine(AVAILABLE_MODELS[evaluator_model], use_cache=cache_evaluator, hedge=hedge)
+        set_backward_engine(evaluator_engine)
+
+        profile_dir = os.path.join(output_dir, profile_id)
+        os.makedirs(profile_dir, exist_ok=True)
+        journal_path = os.path.join(profile_dir, "journal.jsonl")
+        status_callback = lambda message, level: print(f"[{profile_id}] {level.upper()}: {message}")
+        if resume and os.path.exists(journal_path) and read_journal(journal_path)["start"]:
+            result = resume_optimization(journal_path, generator_engine, evaluator_engine, status_callback=status_callback)
+            summary["resumed"] = True
+        else:
+            if os.path.exists(journal_path):
+                os.remove(journal_path)  # A fresh run must not mix with an old journal
+            if warm_start:
+                warm_start_prompt, warm_start_match = load_warm_start_prompt(user_input_data)
+                if warm_start_prompt:
+                    system_prompt_text = warm_start_prompt
+                    summary["warm_start"] = warm_start_match["filename"]
+                    status_callback(f"Warm start from library prompt '{warm_start_match['name']}' "
+                                    f"(similarity {warm_start_match['similarity']:.2f}).", "info")
+            if beam_width > 1:
+                result = run_beam_optimization(
+                    system_prompt_text, user_input_data, generator_engine, evaluator_engine,
+                    evaluation_template=evaluation_template, num_steps=num_steps, target_score=target_score,
+                    beam_width=beam_width, proposals_per_prompt=proposals_per_prompt, prompt_layout=prompt_layout,
+                    evaluation_format=evaluation_format, status_callback=status_callback, journal=RunJournal(run_id=profile_id, path=journal_path),
+                    convergence=convergence,
+                )
+            else:
+                result = run_optimization(
+                    system_prompt_text, user_input_data, generator_engine, evaluator_engine,
+                    evaluation_template=evaluation_template, num_steps=num_steps, target_score=target_score,
+                    evaluator_samples=evaluator_samples, prescore_gate=prescore_gate, prompt_layout=prompt_layout,
+                    evaluation_format=evaluation_format, status_callback=status_callback, journal=RunJournal(run_id=profile_id, path=journal_path),
+                    convergence=convergence,
+                )
+
+        with open(os.path.join(profile_dir, "best_prompt.txt"), "w", encoding="utf-8") as f:
+            f.write(result["best_prompt"] or "")
+        with open(os.path.join(profile_dir, "best_table.tsv"), "w", encoding="utf-8") as f:
+            f.write(result["best_table"] or "")
+        with open(os.path.join(profile_dir, "history.json"), "w", encoding="utf-8") as f:
+            json.dump({
+                "profile": user_input_data,
+                "best_score": result["best_score"], "best_step": result["best_step"],
+                "best_description": result["best_description"], "best_feedback": result["best_feedback"],
+                "final_prompt": result["final_prompt"], "history": result["history"],
+            }, f, indent=2, default=str)
+
+        with open(os.path.join(profile_dir, "metrics.json"), "w", encoding="utf-8") as f:
+            json.dump(metrics_report(result["history"], result["metrics"], {
+                "profile_id": profile_id, "generator_model": generator_model, "evaluator_model": evaluator_model,
+                "best_score": result["best_score"], "stop_reason": result["stop_reason"],
+                "convergence": result["convergence"],
+            }), f, indent=2, default=str)
+
+        summary.update(best_score=result["best_score"], best_step=result["best_step"],
+                       steps_run=len(result["history"]), stop_reason=result["stop_reason"])
+        summary["llm_calls"] = result["metrics"]["total"]["calls"]
+        summary["estimated_cost_usd"] = round(result["metrics"]["total"]["cost_usd"], 6)
+        step_usage = [entry["prompt_cache"] for entry in result["history"] if entry.get("prompt_cache")]
+        summary["prompt_tokens"] = sum(u["prompt_tokens"] for u in step_usage)
+        summary["cache_eligible_tokens"] = sum(u["cached_tokens"] for u in step_usage)
+        step_calls = [entry["calls"] for entry in result["history"] if entry.get("calls")]
+        summary["llm_retries"] = sum(sum(c["retries"].values()) for c in step_calls)
+        summary["llm_hedges"] = sum(c["hedges"] for c in step_calls)
+        evaluations = [entry["evaluation"] for entry in result["history"] if entry.get("evaluation")]
+        if evaluations:
+            summary["json_evaluations"] = {"valid": sum(1 for e in evaluations if e["format"] == "json"),
+                                           "corrected": sum(1 for e in evaluations if e["corrected"]),
+                                           "markdown_fallbacks": sum(1 for e in evaluations if e["fallback"])}
+        if user_input_data.get("dedupe_sources"):
+            summary["source_tokens_saved"] = source_dedup_report(user_input_data)["saved_tokens"]
+    except Exception as e:
+        print(f"[{profile_id}] Failed: {e}")
+        summary.update(status="error", error=str(e))
+
+    summary["duration_seconds"] = round((datetime.now() - started_at).total_seconds(), 2)
+    return summary
+
+
+def run_batch(profiles, generator_model, evaluator_model, system_prompt_text=INITIAL_SYSTEM_PROMPT_TEXT,
+              evaluation_template=EVALUATION_PROMPT_TEMPLATE, num_steps=3, target_score=90,
+              workers=None, output_dir=None, cache_generator=False, cache_evaluator=False, evaluator_samples=1,
+              stream_generation=False, prescore_gate=False, prompt_layout="template", resume=False, warm_start=False,
+              hedge=False, trace=False, convergence=None, beam_width=1, proposals_per_prompt=2,
+              evaluation_format="markdown"):
+    """
+    Optimizes all valid profiles concurrently across worker processes.
+    With `resume` (and the output_dir of an earlier batch), finished profiles are skipped and
+    interrupted ones continue from their journals.
+    Returns:
+        tuple: (output directory, list of per-profile summaries)
+    """
+    output_dir = output_dir or os.path.join(DEFAULT_OUTPUT_ROOT, f"batch_{datetime.now().strftime('%Y%m%d_%H%M%S')}")
+    os.makedirs(output_dir, exist_ok=True)
+
+    summaries = []
+    runnable = []
+    for profile in profiles:
+        errors = validate_user_inputs(profile)
+        if errors:
+            print(f"[{profile['id']}] Skipped: {' '.join(e.replace('*', '').lstrip('- ') for e in errors)}")
+            summaries.append({"id": profile["id"], "status": "invalid", "error": errors})
+        elif resume and os.path.exists(os.path.join(output_dir, profile["id"], "history.json")):
+            with open(os.path.join(output_dir, profile["id"], "history.json"), "r", encoding="utf-8") as f:
+                finished = json.load(f)
+            print(f"[{profile['id']}] Already finished; skipped.")
+            summaries.append({"id": profile["id"], "status": "ok", "best_score": finished["best_score"],
+                              "best_step": finished["best_step"], "steps_run": len(finished["history"]),
+                              "skipped": True})
+        else:
+            runnable.append(profile)
+
+    workers = workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(min(workers, max(len(runnable), 1)),)) as executor:
+        futures = {
+            executor.submit(optimize_profile, profile, generator_model, evaluator_model, system_prompt_text,
+                            evaluation_template, num_steps, target_score, output_dir,
+                            cache_generator, cache_evaluator, evaluator_samples, stream_generation,
+                            prescore_gate, prompt_layout, resume, warm_start, hedge, trace, convergence,
+                            beam_width, proposals_per_prompt, evaluation_format): profile["id"]
+            for profile in runnable
+        }
+        for future in as_completed(futures):
+            summary = future.result()
+            summaries.append(summary)
+            print(f"[{summary['id']}] Done ({summary['status']}): best score {summary.get('best_score')}")
+
+    with open(os.path.join(output_dir, "summary.json"), "w", encoding="utf-8") as f:
+        json.dump(sorted(summaries, key=lambda s: s["id"]), f, indent=2, default=str)
+    return output_dir, summaries
+
+
+def run_minibatch(profiles, generator_model, evaluator_model, system_prompt_text=INITIAL_SYSTEM_PROMPT_TEXT,
+                  evaluation_template=EVALUATION_PROMPT_TEMPLATE, num_steps=3, target_score=90, batch_size=None,
+                  output_dir=None, cache_generator=False, cache_evaluator=False, stream_generation=False,
+                  prompt_layout="template", resume=False, hedge=False, trace=False, convergence=None,
+                  evaluation_format="markdown"):
+    """
+    Optimizes one shared system prompt for all valid profiles (pipeline.run_minibatch_optimization),
+    in this process; parallelism comes from the shared engine pool. Results go to <output_dir>/minibatch/.
+    With `resume`, an interrupted minibatch journal in that folder is continued.
+    Returns:
+        tuple: (output directory, summary dict)
+    """
+    output_dir = output_dir or os.path.join(DEFAULT_OUTPUT_ROOT, f"batch_{datetime.now().strftime('%Y%m%d_%H%M%S')}")
+    run_dir = os.path.join(output_dir, "minibatch")
+    os.makedirs(run_dir, exist_ok=True)
+    valid = []
+    for profile in profiles:
+        errors = validate_user_inputs(profile)
+        if errors:
+            print(f"[{profile['id']}] Skipped: {' '.join(e.replace('*', '').lstrip('- ') for e in errors)}")
+        else:
+            valid.append(profile)
+
+    generator_engine = create_engine(AVAILABLE_MODELS[generator_model], use_cache=cache_generator,
+                                     streaming=stream_generation, hedge=hedge)
+    evaluator_engine = create_engine(AVAILABLE_MODELS[evaluator_model], use_cache=cache_evaluator, hedge=hedge)
+    set_backward_engine(evaluator_engine)
+    journal_path = os.path.join(run_dir, "journal.jsonl")
+    status_callback = lambda message, level: print(f"[minibatch] {level.upper()}: {message}")
+    with (tracing_session("minibatch", path=os.path.join(run_dir, "trace.json")) if trace else nullcontext()):
+        if resume and os.path.exists(journal_path) and read_journal(journal_path)["start"]:
+            result = resume_optimization(journal_path, generator_engine, evaluator_engine, status_callback=status_callback)
+        else:
+            if os.path.exists(journal_path):
+                os.remove(journal_path)
+            result = run_minibatch_optimization(
+                system_prompt_text, valid, generator_engine, evaluator_engine, evaluation_template=evaluation_template,
+                num_steps=num_steps, target_score=target_score, batch_size=batch_size, prompt_layout=prompt_layout,
+                evaluation_format=evaluation_format, status_callback=status_callback, journal=RunJournal(run_id="minibatch", path=journal_path),
+                convergence=convergence,
+            )
+
+    with open(os.path.join(run_dir, "best_prompt.txt"), "w", encoding="utf-8") as f:
+        f.write(result["best_prompt"] or "")
+    with open(os.path.join(run_dir, "history.json"), "w", encoding="utf-8") as f:
+        json.dump({"profiles": result["profiles"], "best_score": result["best_score"], "best_step": result["best_step"],
+                   "final_prompt": result["final_prompt"], "history": result["history"]}, f, indent=2, default=str)
+    with open(os.path.join(run_dir, "metrics.json"), "w", encoding="utf-8") as f:
+        json.dump(metrics_report(result["history"], result["metrics"], {
+            "profiles": result["profiles"], "generator_model": generator_model, "evaluator_model": evaluator_model,
+            "best_score": result["best_score"], "stop_reason": result["stop_reason"],
+            "convergence": result["convergence"],
+        }), f, indent=2, default=str)
+
+    best_entry = next((e for e in result["history"] if e["step"] == result["best_step"]), None)
+    summary = {
+        "profiles": result["profiles"], "skipped": [p["id"] for p in profiles if p not in valid],
+        "best_mean_score": result["best_score"], "best_step": result["best_step"],
+        "best_step_scores": {r["id"]: r["score"] for r in best_entry.get("batch", [])} if best_entry else {},
+        "steps_run": len(result["history"]), "stop_reason": result["stop_reason"],
+        "convergence": result["convergence"],
+        "estimated_cost_usd": round(result["metrics"]["total"]["cost_usd"], 6),
+    }
+    with open(os.path.join(output_dir, "summary.json"), "w", encoding="utf-8") as f:
+        json.dump(summary, f, indent=2, default=str)
+    return output_dir, summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run TextGrad system prompt optimization for many input profiles.")
+    parser.add_argument("profiles", help="JSON list or JSONL file of user input profiles.")
+    parser.add_argument("--generator", default="Gemini 1.5 Flash", choices=list(AVAILABLE_MODELS.keys()))
+    parser.add_argument("--evaluator", default="Gemini 2.5 Flash Preview", choices=list(AVAILABLE_MODELS.keys()))
+    parser.add_argument("--system-prompt-file", help="Starting system prompt (defaults to INITIAL_SYSTEM_PROMPT_TEXT).")
+    parser.add_argument("--evaluation-template-file", help="Evaluation prompt template (defaults to EVALUATION_PROMPT_TEMPLATE).")
+    parser.add_argument("--steps", type=int, default=3, help="Optimization steps per profile.")
+    parser.add_argument("--target-score", type=int, default=90, help="Stop a profile once this score is reached.")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes (defaults to CPU count).")
+    parser.add_argument("--output-dir", default=None, help="Where to write results (defaults to logs/batch_<timestamp>).")
+    parser.add_argument("--cache-generator", action="store_true", help="Serve repeated generator calls from the response cache.")
+    parser.add_argument("--cache-evaluator", action="store_true", help="Serve repeated evaluator calls from the response cache.")
+    parser.add_argument("--evaluator-samples", type=int, default=1, help="Evaluator samples per step (median, early stopping).")
+    parser.add_argument("--stream-generation", action="store_true", help="Abort and retry generations that break the table format.")
+    parser.add_argument("--dedupe-sources", action="store_true", help="Collapse near-duplicate passages across external sources.")
+    parser.add_argument("--prompt-layout", default="template", choices=PROMPT_LAYOUTS,
+                        help="Evaluation prompt layout; 'prefix_stable' keeps a cacheable prefix across steps.")
+    parser.add_argument("--evaluation-format", default="markdown", choices=EVALUATION_FORMATS,
+                        help="Evaluator output; 'json' asks for a schema-validated JSON result (markdown as fallback).")
+    parser.add_argument("--resume", action="store_true",
+                        help="With --output-dir of an earlier batch: skip finished profiles, continue interrupted ones.")
+    parser.add_argument("--warm-start", action="store_true",
+                        help="Start each profile from its most similar, best-scored saved prompt in the library.")
+    parser.add_argument("--prescore-gate", action="store_true", help="Check tables locally and skip the evaluator for failing ones.")
+    parser.add_argument("--hedge", action="store_true",
+                        help="Send a duplicate request for LLM calls slower than the recent p95 (extra quota, lower tail latency).")
+    parser.add_argument("--minibatch", action="store_true",
+                        help="Optimize ONE system prompt for all profiles together (mean batch score) instead of one per profile.")
+    parser.add_argument("--batch-size", type=int, default=None,
+                        help="With --minibatch: profiles per step, rotating through the list (default: all every step).")
+    parser.add_argument("--trace", action="store_true",
+                        help="Profile each profile's pipeline stages into <output-dir>/<id>/trace.json (Chrome trace format).")
+    parser.add_argument("--beam-width", type=int, default=1,
+                        help="Keep this many candidate prompts per profile (beam search); 1 = the sequential loop.")
+    parser.add_argument("--proposals", type=int, default=2,
+                        help="With --beam-width > 1: TGD proposals per beam prompt and step, evaluated concurrently.")
+    parser.add_argument("--max-minutes", type=float, default=None,
+                        help="Time budget per run; no step is started that would end past it.")
+    parser.add_argument("--max-tokens", type=int, default=None, help="Estimated LLM token budget per run.")
+    parser.add_argument("--max-cost", type=float, default=None, help="Estimated LLM cost budget per run (USD, MODEL_PRICING).")
+    parser.add_argument("--patience", type=int, default=None,
+                        help="Stop after this many steps without improving the best score by --min-improvement "
+                             "(unless the smoothed score trend is still rising).")
+    parser.add_argument("--min-improvement", type=float, default=CONVERGENCE_MIN_IMPROVEMENT,
+                        help="Score points a step must add to the best score to count as progress.")
+    args = parser.parse_args()
+
+    load_dotenv()
+    system_prompt_text = INITIAL_SYSTEM_PROMPT_TEXT
+    if args.system_prompt_file:
+        with open(args.system_prompt_file, "r", encoding="utf-8") as f:
+            system_prompt_text = f.read()
+    evaluation_template = EVALUATION_PROMPT_TEMPLATE
+    if args.evaluation_template_file:
+        with open(args.evaluation_template_file, "r", encoding="utf-8") as f:
+            evaluation_template = f.read()
+
+    profiles = load_profiles(args.profiles)
+    convergence = {
+        "max_seconds": args.max_minutes * 60 if args.max_minutes else None, "max_tokens": args.max_tokens,
+        "max_cost_usd": args.max_cost, "patience": args.patience, "min_improvement": args.min_improvement,
+    }
+    if args.dedupe_sources:
+        for profile in profiles:
+            profile.setdefault("dedupe_sources", True)  # A profile's own setting wins
+    if args.minibatch:
+        output_dir, summary = run_minibatch(
+            profiles, args.generator, args.evaluator, system_prompt_text, evaluation_template,
+            num_steps=args.steps, target_score=args.target_score, batch_size=args.batch_size,
+            output_dir=args.output_dir, cache_generator=args.cache_generator, cache_evaluator=args.cache_evaluator,
+            stream_generation=args.stream_generation, prompt_layout=args.prompt_layout, resume=args.resume,
+            hedge=args.hedge, trace=args.trace, convergence=convergence, evaluation_format=args.evaluation_format,
+        )
+        print(f"Best mean score {summary['best_mean_score']} over {len(summary['profiles'])} profiles "
+              f"(step {summary['best_step']}). Results written to '{output_dir}'.")
+        return
+    output_dir, summaries = run_batch(
+        profiles, args.generator, args.evaluator, system_prompt_text, evaluation_template,
+        num_steps=args.steps, target_score=args.target_score, workers=args.workers, output_dir=args.output_dir,
+        cache_generator=args.cache_generator, cache_evaluator=args.cache_evaluator,
+        evaluator_samples=args.evaluator_samples, stream_generation=args.stream_generation,
+        prescore_gate=args.prescore_gate, prompt_layout=args.prompt_layout, resume=args.resume,
+        warm_start=args.warm_start, hedge=args.hedge, trace=args.trace, convergence=convergence,
+        beam_width=args.beam_width, proposals_per_prompt=args.proposals, evaluation_format=args.evaluation_format,
+    )
+    succeeded = sum(1 for s in summaries if s["status"] == "ok")
+    print(f"Finished {succeeded}/{len(summaries)} profiles. Results written to '{output_dir}'.")
+
+
+if __name__ == "__main__":
+    main()
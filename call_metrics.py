@@ -0,0 +1,172 @@
+"""
+Token, latency and cost accounting of LLM calls per optimization phase, step and run.
+
+MeteredEngine sits directly on top of the provider engine (below rate limiting, retries and caches),
+so it sees exactly the requests that reach the provider: every attempt and hedged duplicate is
+counted, response-cache hits are not (a streamed generation counts once, restarts included).
+Each call is attributed to the phase set with metrics_phase() (generate / evaluate / backward /
+optimizer) and to its model; tokens are estimated from the text (utils.estimate_tokens) and priced
+with config.MODEL_PRICING.
+
+usage_metrics() collects the calls of a context (a step, a run) into a metrics dict; contexts nest,
+so a step's calls also count towards its run. metrics_rows()/metrics_report() turn the metrics of a
+run's history into a flat table / JSON report for export.
+"""
+import contextvars
+import csv
+import io
+import threading
+import time
+from contextlib import contextmanager
+
+from config import AVAILABLE_MODELS, MODEL_PRICING
+from engine_wrappers import EngineWrapper
+from tracing import span
+from utils import estimate_tokens
+
+PHASES = ["generate", "evaluate", "backward", "optimizer"]
+COUNTERS = ["calls", "errors", "input_tokens", "output_tokens", "llm_seconds", "cost_usd"]
+
+_phase = contextvars.ContextVar("metrics_phase", default=None)
+# Accumulators of the enclosing usage_metrics() contexts, innermost last
+_collectors = contextvars.ContextVar("usage_metrics", default=())
+_lock = threading.Lock()
+
+
+@contextmanager
+def metrics_phase(phase):
+    """Attributes the LLM calls made in this context (including pooled calls) to an optimization phase."""
+    token = _phase.set(phase)
+    try:
+        yield
+    finally:
+        _phase.reset(token)
+
+
+def new_counters():
+    return {name: 0 for name in COUNTERS}
+
+
+def new_metrics():
+    return {"total": new_counters(), "phases": {}, "models": {}}
+
+
+@contextmanager
+def usage_metrics():
+    """Collects the calls of this context; yields the metrics dict, filled in as calls complete."""
+    metrics = new_metrics()
+    token = _collectors.set(_collectors.get() + (metrics,))
+    try:
+        yield metrics
+    finally:
+        _collectors.reset(token)
+
+
+def model_pricing(model_string):
+    """USD per million input/output tokens for a model string or AVAILABLE_MODELS name (zero if unknown)."""
+    for name, pricing in MODEL_PRICING.items():
+        if name == model_string or AVAILABLE_MODELS.get(name) == model_string:
+            return pricing
+    return {"input": 0.0, "output": 0.0}
+
+
+def estimate_cost(model_string, input_tokens, output_tokens):
+    pricing = model_pricing(model_string)
+    return (input_tokens * pricing["input"] + output_tokens * pricing["output"]) / 1e6
+
+
+def _add(counters, call):
+    for name in COUNTERS:
+        total = counters[name] + call[name]
+        counters[name] = round(total, 6) if isinstance(total, float) else total
+
+
+def record_call(model_string, phase, input_tokens, output_tokens, seconds, error=False):
+    call = {"calls": 1, "errors": int(error), "input_tokens": input_tokens, "output_tokens": output_tokens,
+            "llm_seconds": float(seconds), "cost_usd": estimate_cost(model_string, input_tokens, output_tokens)}
+    with _lock:
+        for metrics in _collectors.get():
+            _add(metrics["total"], call)
+            _add(metrics["phases"].setdefault(phase, new_counters()), call)
+            _add(metrics["models"].setdefault(model_string, new_counters()), call)
+
+
+def merge_metrics(metrics_list):
+    """Sums several metrics dicts (e.g. the steps of a run)."""
+    merged = new_metrics()
+    for metrics in metrics_list:
+        if not metrics:
+            continue
+        _add(merged["total"], metrics["total"])
+        for group in ("phases", "models"):
+            for name, counters in metrics[group].items():
+                _add(merged[group].setdefault(name, new_counters()), counters)
+    return merged
+
+
+def _prompt_text(prompt):
+    if isinstance(prompt, str):
+        return prompt
+    return "".join(item for item in prompt if isinstance(item, str))  # Multimodal: text parts only
+
+
+class MeteredEngine(EngineWrapper):
+    """Engine wrapper recording estimated tokens, latency and cost of every call that reaches the provider."""
+
+    def generate(self, prompt, system_prompt=None, **kwargs):
+        input_tokens = estimate_tokens((system_prompt or self.system_prompt or "") + _prompt_text(prompt))
+        phase = _phase.get() or "other"
+        started = time.perf_counter()
+        try:
+            with span(f"llm.{phase}", model=self.model_string, input_tokens=input_tokens):
+                response = self.engine(prompt, system_prompt=system_prompt, **kwargs)
+        except Exception:
+            record_call(self.model_string, phase, input_tokens, 0, time.perf_counter() - started, error=True)
+            raise
+        output_tokens = estimate_tokens(response if isinstance(response, str) else "")
+        record_call(self.model_string, phase, input_tokens, output_tokens, time.perf_counter() - started)
+        return response
+
+
+def metrics_rows(history):
+    """
+    One row per step and phase (plus a 'total' row per step) from the 'metrics' of history entries.
+    Returns:
+        list: dicts with step, score, phase and the COUNTERS.
+    """
+    rows = []
+    for entry in history:
+        metrics = entry.get("metrics")
+        if not metrics:
+            continue
+        phases = [(p, metrics["phases"][p]) for p in PHASES + sorted(set(metrics["phases"]) - set(PHASES))
+                  if p in metrics["phases"]]
+        for phase, counters in phases + [("total", metrics["total"])]:
+            rows.append(dict({"step": entry["step"], "score": entry.get("score"), "phase": phase}, **counters))
+    return rows
+
+
+def metrics_report(history, run_metrics=None, run_info=None):
+    """
+    JSON-serializable metrics report of a run: run totals (by phase and model), per-step metrics and timings.
+    Args:
+        history (list): Optimization history entries.
+        run_metrics (dict, optional): Metrics of the whole run (includes calls outside the steps, e.g. the
+            initial evaluation); defaults to the sum of the steps.
+        run_info (dict, optional): Extra fields for the report header (run ID, models, stop reason, ...).
+    """
+    return {
+        **(run_info or {}),
+        "run": run_metrics or merge_metrics([entry.get("metrics") for entry in history]),
+        "steps": [{"step": entry["step"], "score": entry.get("score"), "timings": entry.get("timings"),
+                   "metrics": entry.get("metrics")} for entry in history],
+    }
+
+
+def metrics_csv(history):
+    """metrics_rows() as CSV text."""
+    output = io.StringIO()
+    writer = csv.DictWriter(output, fieldnames=["step", "score", "phase"] + COUNTERS)
+    writer.writeheader()
+    writer.writerows(metrics_rows(history))
+    return output.getvalue()
@@ -0,0 +1,223 @@
+"""
+Resilient call policy for generator, loss (evaluation) and backward/optimizer calls.
+
+ResilientEngine wraps a provider engine (below the caches, above rate limiting) and gives every call:
+    - classified errors: rate_limit / timeout / transient are retried, fatal (auth, invalid request,
+      blocked content) and deadline errors are raised at once;
+    - jittered exponential backoff between attempts (longer after quota errors);
+    - a deadline per call over all attempts, passed to the provider as its request timeout;
+    - optionally, a hedged duplicate request once an attempt runs longer than the recent p95 latency
+      of calls of the same model and kind; the first response wins.
+Retries, hedges, deadlines and latencies are counted process-wide (call_policy_stats) and per
+optimization step (call_telemetry, stored in each history entry under 'calls').
+"""
+import contextvars
+import random
+import re
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import contextmanager
+
+from config import (
+    MAX_CONCURRENT_LLM_CALLS, CALL_MAX_ATTEMPTS, CALL_DEADLINE_SECONDS, CALL_BACKOFF_BASE_SECONDS,
+    CALL_BACKOFF_MAX_SECONDS, HEDGE_LATENCY_PERCENTILE, HEDGE_MIN_SAMPLES
+)
+from engine_wrappers import EngineWrapper, call_timeout
+from tracing import span
+
+RETRYABLE_ERRORS = ("rate_limit", "timeout", "transient")
+LATENCY_WINDOW = 200  # Recent successful attempts kept per (model, kind) for the hedging percentile
+
+_RATE_LIMIT_RE = re.compile(r"\b429\b|rate.?limit|quota|resource.?(has been )?exhausted", re.IGNORECASE)
+_TIMEOUT_RE = re.compile(r"\b504\b|timed? ?out|deadline exceeded", re.IGNORECASE)
+_TRANSIENT_RE = re.compile(r"\b(500|502|503)\b|overloaded|unavailable|connection|reset by peer|internal error|"
+                           r"try again", re.IGNORECASE)
+
+
+class CallDeadlineExceeded(TimeoutError):
+    """A call (including its retries, hedges and quota waits) did not finish within its deadline."""
+
+
+def classify_error(error):
+    """Returns 'deadline', 'rate_limit', 'timeout', 'transient' or 'fatal'."""
+    if isinstance(error, CallDeadlineExceeded):
+        return "deadline"
+    text = f"{type(error).__name__}: {error}"
+    if _RATE_LIMIT_RE.search(text):
+        return "rate_limit"
+    if isinstance(error, TimeoutError) or _TIMEOUT_RE.search(text):
+        return "timeout"
+    if isinstance(error, ConnectionError) or _TRANSIENT_RE.search(text):
+        return "transient"
+    return "fatal"
+
+
+def classify_call(prompt, system_prompt):
+    """
+    Returns 'optimizer', 'backward', 'evaluate' or 'generate' based on the call's prompts.
+    Hedging latencies are kept per kind; the fake engine (fake_engine.py) answers by kind.
+    """
+    system_text = system_prompt or ""
+    prompt_text = prompt if isinstance(prompt, str) else ""
+    if "<IMPROVED_VARIABLE>" in system_text or "<IMPROVED_VARIABLE>" in prompt_text:
+        return "optimizer"
+    # Backward prompts embed the evaluated conversation, so check them before evaluation
+    if ("You are part of an optimization system" in system_text
+            or any(tag in prompt_text for tag in ("<LM_INPUT>", "<LM_OUTPUT>", "<VARIABLE>"))):
+        return "backward"
+    if "EVALUATION OUTPUT STRUCTURE" in system_text or "## Overall Score" in system_text:
+        return "evaluate"
+    if "restate the score" in prompt_text:  # Score repair (pipeline.repair_evaluation_score)
+        return "evaluate"
+    if "schema_version" in prompt_text:  # JSON evaluation correction (pipeline.evaluate_table)
+        return "evaluate"
+    return "generate"
+
+
+def backoff_delay(attempt, error_class, base=CALL_BACKOFF_BASE_SECONDS, cap=CALL_BACKOFF_MAX_SECONDS):
+    """Equal-jitter exponential backoff: half the step fixed, half random. Quota errors back off 4x longer."""
+    step = min(cap, base * (4 if error_class == "rate_limit" else 1) * 2 ** (attempt - 1))
+    return step / 2 + random.uniform(0, step / 2)
+
+
+def new_call_stats():
+    return {"calls": 0, "attempts": 0, "retries": {c: 0 for c in RETRYABLE_ERRORS}, "failures": 0,
+            "deadline_exceeded": 0, "hedges": 0, "hedge_wins": 0, "backoff_seconds": 0.0, "max_call_seconds": 0.0}
+
+
+_stats_lock = threading.Lock()
+_totals = new_call_stats()
+_latencies = {}  # (model, kind) -> recent successful attempt latencies
+# Stats accumulator of the current optimization step (see call_telemetry)
+_step_stats = contextvars.ContextVar("call_stats", default=None)
+
+
+@contextmanager
+def call_telemetry():
+    """Collects call-policy events of every call made in this context (including pooled calls)."""
+    stats = new_call_stats()
+    token = _step_stats.set(stats)
+    try:
+        yield stats
+    finally:
+        _step_stats.reset(token)
+
+
+def _record(field, amount=1, retry_class=None):
+    with _stats_lock:
+        for stats in (_totals, _step_stats.get()):
+            if stats is None:
+                continue
+            if retry_class:
+                stats["retries"][retry_class] += amount
+            elif field == "max_call_seconds":
+                stats[field] = round(max(stats[field], amount), 3)
+            else:
+                stats[field] = round(stats[field] + amount, 3) if isinstance(amount, float) else stats[field] + amount
+
+
+def _percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))]
+
+
+def latency_percentile(model_string, kind, pct=HEDGE_LATENCY_PERCENTILE):
+    """Recent latency percentile of successful calls, or None while fewer than HEDGE_MIN_SAMPLES are known."""
+    with _stats_lock:
+        samples = list(_latencies.get((model_string, kind), ()))
+    return _percentile(samples, pct) if len(samples) >= HEDGE_MIN_SAMPLES else None
+
+
+def call_policy_stats():
+    """Process-wide counters plus p50/p95/p99 latency per (model, kind)."""
+    with _stats_lock:
+        totals = dict(_totals, retries=dict(_totals["retries"]))
+        latency = {f"{model} {kind}": {"samples": len(v), "p50": round(_percentile(v, 50), 2),
+                                       "p95": round(_percentile(v, 95), 2), "p99": round(_percentile(v, 99), 2)}
+                   for (model, kind), v in _latencies.items() if v}
+    return dict(totals, latency=latency)
+
+
+_hedge_pool = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_LLM_CALLS * 2, thread_name_prefix="llm-hedge")
+
+
+class ResilientEngine(EngineWrapper):
+    """Engine wrapper applying retries with backoff, per-call deadlines and optional hedged requests."""
+
+    def __init__(self, engine, max_attempts=CALL_MAX_ATTEMPTS, deadline_seconds=CALL_DEADLINE_SECONDS, hedge=False):
+        super().__init__(engine)
+        self.max_attempts = max_attempts
+        self.deadline_seconds = deadline_seconds
+        self.hedge = hedge
+
+    def generate(self, prompt, system_prompt=None, **kwargs):
+        kind = classify_call(prompt, system_prompt)
+        started = time.monotonic()
+        deadline = started + self.deadline_seconds
+        _record("calls")
+        for attempt in range(1, self.max_attempts + 1):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            attempt_started = time.monotonic()
+            _record("attempts")
+            try:
+                response = self._attempt(kind, prompt, system_prompt, kwargs, remaining)
+            except Exception as e:
+                error_class = classify_error(e)
+                delay = backoff_delay(attempt, error_class)
+                retryable = error_class in RETRYABLE_ERRORS and attempt < self.max_attempts
+                past_deadline = retryable and time.monotonic() + delay >= deadline  # The backoff would cross it
+                if not retryable or past_deadline:
+                    _record("deadline_exceeded" if error_class == "deadline" or past_deadline else "failures")
+                    raise
+                _record(None, retry_class=error_class)
+                _record("backoff_seconds", delay)
+                print(f"Retrying {self.model_string} {kind} call in {delay:.1f}s after {error_class} error "
+                      f"(attempt {attempt}/{self.max_attempts}): {e}")
+                with span("retry_backoff", error_class=error_class, attempt=attempt):
+                    time.sleep(delay)
+                continue
+            with _stats_lock:
+                _latencies.setdefault((self.model_string, kind), deque(maxlen=LATENCY_WINDOW)).append(
+                    time.monotonic() - attempt_started)
+            _record("max_call_seconds", time.monotonic() - started)
+            return response
+        _record("deadline_exceeded")
+        raise CallDeadlineExceeded(f"{self.model_string} {kind} call exceeded its {self.deadline_seconds:.0f}s deadline.")
+
+    def _call(self, prompt, system_prompt, kwargs, deadline):
+        with call_timeout(max(deadline - time.monotonic(), 0.001)):
+            return self.engine(prompt, system_prompt=system_prompt, **kwargs)
+
+    def _submit(self, prompt, system_prompt, kwargs, deadline):
+        # Own context copy per request, so each sees the caller's trackers/session/deadline
+        return _hedge_pool.submit(contextvars.copy_context().run, self._call, prompt, system_prompt, kwargs, deadline)
+
+    def _attempt(self, kind, prompt, system_prompt, kwargs, remaining):
+        deadline = time.monotonic() + remaining
+        hedge_after = latency_percentile(self.model_string, kind) if self.hedge else None
+        if hedge_after is None or hedge_after >= remaining:
+            return self._call(prompt, system_prompt, kwargs, deadline)
+
+        primary = self._submit(prompt, system_prompt, kwargs, deadline)
+        done, _ = wait([primary], timeout=hedge_after)
+        if done:
+            return primary.result()
+        _record("hedges")
+        hedge = self._submit(prompt, system_prompt, kwargs, deadline)
+        pending = {primary, hedge}
+        error = None
+        while pending:
+            done, pending = wait(pending, timeout=max(deadline - time.monotonic(), 0), return_when=FIRST_COMPLETED)
+            if not done:
+                raise CallDeadlineExceeded(f"{self.model_string} {kind} call and its hedge exceeded the deadline.")
+            for future in done:
+                if future.exception() is None:
+                    if future is hedge:
+                        _record("hedge_wins")
+                    return future.result()  # The slower request is left to finish in the background
+                error = future.exception()
+        raise error
@@ -1,3 +1,6 @@
+import json
+import os
+
 AVAILABLE_MODELS = {
     "Gemini 1.5 Flash": "experimental:gemini/gemini-1.5-flash",
     "Gemini 1.5 Pro": "experimental:gemini/gemini-1.5-pro",
@@ -6,6 +9,120 @@ AVAILABLE_MODELS = {
     "Gemini 2.0 Flash": "experimental:gemini/gemini-2.0-flash",
 }
 
+# Local latency-injecting stand-ins (see fake_engine.py), for load testing without API quota
+if os.getenv("ENABLE_FAKE_ENGINES", "").lower() in ("1", "true", "yes"):
+    AVAILABLE_MODELS.update({
+        "Fake Engine (Load Test)": "fake:default",
+        "Fake Engine - Slow (Load Test)": "fake:slow",
+        "Fake Engine - Flaky (Load Test)": "fake:flaky",
+    })
+
+# - Concurrency -
+# Upper bound on LLM calls in flight at once from this process (shared by all sessions).
+MAX_CONCURRENT_LLM_CALLS = int(os.getenv("MAX_CONCURRENT_LLM_CALLS", "8"))
+
+# - Rate Limits and API Key Pool -
+# Quotas per API key, by AVAILABLE_MODELS name: requests/min and tokens/min (prompt + response).
+# Calls beyond them wait in a fair queue instead of failing with quota errors; unlisted models are not paced.
+# Defaults are the Gemini free tier; set MODEL_RATE_LIMITS_JSON (same shape, names or model strings) to override.
+MODEL_RATE_LIMITS = {
+    "Gemini 1.5 Flash": {"rpm": 15, "tpm": 1000000},
+    "Gemini 1.5 Pro": {"rpm": 2, "tpm": 32000},
+    "Gemini 2.5 Flash Preview": {"rpm": 10, "tpm": 250000},
+    "Gemini 2.5 Pro Preview": {"rpm": 5, "tpm": 250000},
+    "Gemini 2.0 Flash": {"rpm": 15, "tpm": 1000000},
+}
+if os.getenv("MODEL_RATE_LIMITS_JSON"):
+    MODEL_RATE_LIMITS.update(json.loads(os.getenv("MODEL_RATE_LIMITS_JSON")))
+# Comma-separated keys in GOOGLE_API_KEYS are used as a pool (each key has its own quota); read when first needed
+API_KEY_POOL_ENV = "GOOGLE_API_KEYS"
+RATE_LIMIT_MAX_WAIT_SECONDS = int(os.getenv("RATE_LIMIT_MAX_WAIT_SECONDS", "300"))
+RATE_LIMIT_COOLDOWN_SECONDS = int(os.getenv("RATE_LIMIT_COOLDOWN_SECONDS", "20"))  # a key is rested after a quota error
+
+# - Cost Accounting -
+# Estimated USD per million input/output tokens, by AVAILABLE_MODELS name (list prices; unlisted models count as free).
+# Set MODEL_PRICING_JSON (same shape, names or model strings) to override.
+MODEL_PRICING = {
+    "Gemini 1.5 Flash": {"input": 0.075, "output": 0.30},
+    "Gemini 1.5 Pro": {"input": 1.25, "output": 5.00},
+    "Gemini 2.5 Flash Preview": {"input": 0.15, "output": 0.60},
+    "Gemini 2.5 Pro Preview": {"input": 1.25, "output": 10.00},
+    "Gemini 2.0 Flash": {"input": 0.10, "output": 0.40},
+}
+if os.getenv("MODEL_PRICING_JSON"):
+    MODEL_PRICING.update(json.loads(os.getenv("MODEL_PRICING_JSON")))
+
+# - Profiling Mode (tracing.py) -
+TRACE_DIR = os.getenv("TRACE_DIR", os.path.join("logs", "traces"))
+TRACE_MAX_SPANS = int(os.getenv("TRACE_MAX_SPANS", "200000"))  # spans kept per trace; later ones are dropped
+
+# - Convergence Control (convergence.py) -
+CONVERGENCE_SMOOTHING = float(os.getenv("CONVERGENCE_SMOOTHING", "0.5"))  # weight of the newest score in the smoothed trend
+CONVERGENCE_MIN_IMPROVEMENT = float(os.getenv("CONVERGENCE_MIN_IMPROVEMENT", "1"))  # score points that count as progress
+CONVERGENCE_PROJECTION_STEPS = int(os.getenv("CONVERGENCE_PROJECTION_STEPS", "3"))  # recent steps averaged to project the next one
+
+# - Beam Search (pipeline.run_beam_optimization) -
+# TGD constraints of a beam member's successive proposals (cycled), so one set of gradients yields
+# different rewrites. None: a plain TGD update, as in the sequential loop.
+BEAM_PROPOSAL_CONSTRAINTS = [
+    None,
+    "Make the smallest edits that fix the most severe problems named in the feedback; keep all other instructions unchanged.",
+    "Address every point of the feedback, restructuring or reordering the instructions wherever that makes them clearer.",
+    "Turn the feedback into explicit, checkable rules (formatting, sourcing, numbers) and add them to the prompt.",
+]
+
+# - Call Policy (retries, deadlines, hedging) -
+CALL_MAX_ATTEMPTS = int(os.getenv("CALL_MAX_ATTEMPTS", "4"))
+CALL_DEADLINE_SECONDS = float(os.getenv("CALL_DEADLINE_SECONDS", "240"))  # per call, over all attempts
+CALL_BACKOFF_BASE_SECONDS = float(os.getenv("CALL_BACKOFF_BASE_SECONDS", "1.0"))
+CALL_BACKOFF_MAX_SECONDS = float(os.getenv("CALL_BACKOFF_MAX_SECONDS", "30"))
+# Hedged requests: a duplicate is sent once a call is slower than this percentile of recent calls of its kind
+HEDGE_LATENCY_PERCENTILE = float(os.getenv("HEDGE_LATENCY_PERCENTILE", "95"))
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", "20"))  # no hedging until this many latencies are known
+
+# - LLM Response Cache (opt-in per engine) -
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", os.path.join(".llm_cache", "responses.sqlite"))
+LLM_CACHE_MAX_BYTES = int(os.getenv("LLM_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))  # compressed size cap
+LLM_CACHE_TTL_SECONDS = int(os.getenv("LLM_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))  # 0 disables expiry
+
+# - Provider Prompt (Prefix) Caching Telemetry -
+# Mirrors typical provider rules: prefixes shorter than the minimum are not cached; reuse is
+# counted in whole blocks; an unused prefix expires after the TTL.
+PROMPT_CACHE_MIN_TOKENS = int(os.getenv("PROMPT_CACHE_MIN_TOKENS", "1024"))
+PROMPT_CACHE_BLOCK_TOKENS = int(os.getenv("PROMPT_CACHE_BLOCK_TOKENS", "128"))
+PROMPT_CACHE_TTL_SECONDS = int(os.getenv("PROMPT_CACHE_TTL_SECONDS", "300"))
+
+# - Run Journal (crash-safe resume) -
+RUN_JOURNAL_DIR = os.getenv("RUN_JOURNAL_DIR", os.path.join("logs", "runs"))
+
+# - Background Optimization Jobs -
+# Concurrent optimization runs per server process (their LLM calls still share the engine pool above)
+OPTIMIZATION_JOB_WORKERS = int(os.getenv("OPTIMIZATION_JOB_WORKERS", "8"))
+OPTIMIZATION_JOB_RETENTION_SECONDS = int(os.getenv("OPTIMIZATION_JOB_RETENTION_SECONDS", "3600"))  # finished jobs kept for polling
+
+# - Parsed Table Cache (Streamlit reruns) -
+# Max parsed tables kept in memory, shared by all sessions (each entry is one table's DataFrame).
+TABLE_PARSE_CACHE_MAX_ENTRIES = int(os.getenv("TABLE_PARSE_CACHE_MAX_ENTRIES", "128"))
+
+# - Optimization History Store (history_store.py) -
+# Compressed history bytes kept in memory per session; older steps spill to a file in HISTORY_SPILL_DIR
+HISTORY_MEMORY_BUDGET_BYTES = int(os.getenv("HISTORY_MEMORY_BUDGET_BYTES", str(256 * 1024)))
+HISTORY_SPILL_DIR = os.getenv("HISTORY_SPILL_DIR", os.path.join("logs", "history_spill"))
+HISTORY_KEYFRAME_INTERVAL = 8  # Every Nth step stores its full prompt instead of a delta (bounds reconstruction)
+HISTORY_PAGE_SIZE = 5  # Steps shown with full details per page of Section 5
+HISTORY_HOT_ENTRIES = HISTORY_PAGE_SIZE  # Recently viewed steps kept decoded, besides the latest and the best
+
+# - Table Report Structure (must match INITIAL_SYSTEM_PROMPT_TEXT) -
+TABLE_COLUMNS = [
+    "Strategic Imperative", "Event or Development", "Impact Score", "Impact Start", "Impact Duration",
+    "Impact Nature", "Potential Impact on Revenue", "Side details", "Source",
+]
+SI8_CATEGORIES = [
+    "Innovative Business Models", "Compression of Value Chains", "Transformative Mega Trends",
+    "Disruptive Technologies", "Internal Challenges", "Competitive Intensity",
+    "Geopolitical Chaos", "Industry Convergence",
+]
+
 # - Initial Prompt Definitions -
 # You can modify this initial system prompt based on your best findings.
 # The application allows editing this in the UI for the current session.
@@ -169,6 +286,34 @@ Example format for feedback:
 
 
 
+# Targeted repair of an evaluation whose Overall Score is missing or unreadable (and cannot be summed
+# locally from its "Awarded X/Y pts" lines): a short call that restates the score instead of re-evaluating.
+SCORE_REPAIR_PROMPT_TEMPLATE = """Below is an expert evaluation of a generated table. Its `Overall Score` is missing or unreadable.
+Add up all points awarded in its scoring description (sections A and B, 100 points in total) and restate the score.
+Reply with ONLY one line in exactly this format:
+`score`: <integer from 0 to 100>
+
+EVALUATION:
+---
+{evaluation_text}
+---
+"""
+
+# Structured (JSON) evaluation mode, see evaluation_schema.py: one correction call when the evaluator's JSON
+# fails schema validation, before falling back to a markdown evaluation.
+JSON_EVALUATION_CORRECTION_PROMPT_TEMPLATE = """Your evaluation below is not valid against the required JSON schema (schema_version {schema_version}).
+Problems found:
+{problems}
+
+Fix ONLY these problems and keep your judgement otherwise unchanged. Reply with ONLY the corrected JSON object
+(keys: schema_version, criteria, total, description, feedback; every criterion exactly once; total = sum of awarded).
+
+YOUR EVALUATION:
+---
+{evaluation_text}
+---
+"""
+
 INITIAL_SYSTEM_PROMPT_TEXT = """----------
 # YOUR PRIMARY ROLE: You are a meticulous Data Analyst and Researcher. Your task is to generate a highly factual, concise, and well-sourced table report. The report must be in raw CSV format, strictly using TAB (i.e., '\\t') as a delimiter.
 
@@ -0,0 +1,156 @@
+"""
+Budget-aware convergence control for optimization runs.
+
+Without it a run only stops at num_steps or on reaching the target score, and keeps paying for
+steps after the scores have plateaued or started to oscillate. A ConvergenceController watches
+the run's history and decides before each step whether the next one is worth starting:
+    - time / token / cost budgets: stop when the next step (projected from the recent steps'
+      duration and LLM usage, see call_metrics.py) would exceed the budget;
+    - patience and minimum improvement: stop after `patience` steps without beating the best
+      score by at least `min_improvement` points, unless the smoothed score trend (an exponential
+      moving average, so a single lucky or unlucky evaluation does not decide) is still rising;
+    - effort: halfway to the patience limit, or with budget for less than two more steps,
+      reduce_effort() tells the run to use its cheaper step variant (a single evaluator sample,
+      no pre-score regenerations).
+The reason a run stopped ends up in its result/journal ('stop_reason') and summary().
+"""
+import time
+
+from config import CONVERGENCE_SMOOTHING, CONVERGENCE_MIN_IMPROVEMENT, CONVERGENCE_PROJECTION_STEPS
+
+STOP_REASONS = {
+    "max_steps": "the maximum number of steps was run",
+    "target_score": "the target score was reached",
+    "cancelled": "the run was cancelled",
+    "time_budget": "the next step would exceed the time budget",
+    "token_budget": "the next step would exceed the token budget",
+    "cost_budget": "the next step would exceed the cost budget",
+    "plateau": "the score stopped improving (patience exhausted, smoothed trend flat or falling)",
+}
+
+SETTING_KEYS = ("max_seconds", "max_tokens", "max_cost_usd", "patience", "min_improvement", "smoothing")
+
+
+def describe_stop_reason(stop_reason):
+    return STOP_REASONS.get(stop_reason, stop_reason or "unknown")
+
+
+class ConvergenceController:
+    """Tracks budgets and the score trend of one run; check() before each step says whether to stop."""
+
+    def __init__(self, max_seconds=None, max_tokens=None, max_cost_usd=None, patience=None,
+                 min_improvement=CONVERGENCE_MIN_IMPROVEMENT, smoothing=CONVERGENCE_SMOOTHING):
+        self.max_seconds = max_seconds or None  # 0 / None: no limit
+        self.max_tokens = max_tokens or None
+        self.max_cost_usd = max_cost_usd or None
+        self.patience = patience or None
+        self.min_improvement = min_improvement
+        self.smoothing = smoothing
+        self.started = time.monotonic()
+        self.prior_seconds = 0.0  # Steps run before a resume
+        self.tokens = 0
+        self.cost_usd = 0.0
+        self.recent_steps = []  # (seconds, tokens, cost_usd) per step
+        self.best_score = None
+        self.stale_steps = 0
+        self.smoothed_score = None
+        self.trend = 0.0
+        self.reduced_effort_steps = 0
+
+    @classmethod
+    def from_settings(cls, settings):
+        """Controller for a settings dict (SETTING_KEYS; as journaled), or None if nothing is limited."""
+        settings = {k: v for k, v in (settings or {}).items() if k in SETTING_KEYS and v is not None}
+        if not any(settings.get(k) for k in ("max_seconds", "max_tokens", "max_cost_usd", "patience")):
+            return None
+        return cls(**settings)
+
+    def settings(self):
+        return {k: getattr(self, k) for k in SETTING_KEYS}
+
+    def start(self, best_score=None, history=(), initial_metrics=None):
+        """Sets the starting point: the initial score and usage, plus the completed steps of a resumed run."""
+        self.best_score = best_score
+        if initial_metrics:
+            self._add_usage(initial_metrics)
+        for entry in history:
+            self.observe(entry, timed=False)
+            self.prior_seconds += (entry.get("timings") or {}).get("total_seconds", 0.0)
+
+    def _add_usage(self, metrics):
+        tokens = metrics["total"]["input_tokens"] + metrics["total"]["output_tokens"]
+        self.tokens += tokens
+        self.cost_usd += metrics["total"]["cost_usd"]
+        return tokens, metrics["total"]["cost_usd"]
+
+    def observe(self, entry, timed=True):
+        """Records a completed history entry (its score, 'metrics' and 'timings')."""
+        tokens, cost = self._add_usage(entry["metrics"]) if entry.get("metrics") else (0, 0.0)
+        seconds = (entry.get("timings") or {}).get("total_seconds", 0.0)
+        self.recent_steps = (self.recent_steps + [(seconds, tokens, cost)])[-CONVERGENCE_PROJECTION_STEPS:]
+
+        score = entry.get("score")
+        if score is None:
+            self.stale_steps += 1  # A failed or rejected step is no progress either
+            return
+        if self.best_score is None or score >= self.best_score + self.min_improvement:
+            self.stale_steps = 0
+        else:
+            self.stale_steps += 1
+        if self.best_score is None or score > self.best_score:
+            self.best_score = score
+        previous = self.smoothed_score
+        self.smoothed_score = score if previous is None else self.smoothing * score + (1 - self.smoothing) * previous
+        if previous is not None:
+            self.trend = self.smoothing * (self.smoothed_score - previous) + (1 - self.smoothing) * self.trend
+
+    def elapsed_seconds(self):
+        return self.prior_seconds + time.monotonic() - self.started
+
+    def projected_step(self):
+        """Expected (seconds, tokens, cost_usd) of the next step: the mean of the recent steps."""
+        if not self.recent_steps:
+            return 0.0, 0, 0.0
+        n = len(self.recent_steps)
+        return tuple(sum(step[i] for step in self.recent_steps) / n for i in range(3))
+
+    def _steps_left_in_budget(self):
+        seconds, tokens, cost = self.projected_step()
+        left = []
+        for limit, spent, per_step in ((self.max_seconds, self.elapsed_seconds(), seconds),
+                                       (self.max_tokens, self.tokens, tokens), (self.max_cost_usd, self.cost_usd, cost)):
+            if limit:
+                left.append((limit - spent) / per_step if per_step > 0 else (float("inf") if spent < limit else 0))
+        return min(left) if left else float("inf")
+
+    def check(self):
+        """Stop reason if the next step should not run, else None."""
+        seconds, tokens, cost = self.projected_step()
+        if self.max_seconds and self.elapsed_seconds() + seconds > self.max_seconds:
+            return "time_budget"
+        if self.max_tokens and self.tokens + tokens > self.max_tokens:
+            return "token_budget"
+        if self.max_cost_usd and self.cost_usd + cost > self.max_cost_usd:
+            return "cost_budget"
+        if self.patience and self.stale_steps >= self.patience and self.trend < self.min_improvement:
+            return "plateau"
+        return None
+
+    def reduce_effort(self):
+        """True if the next step should use the cheaper variant (counted in summary())."""
+        reduce = ((self.patience and self.stale_steps >= max(1, self.patience // 2) and self.trend <= 0)
+                  or self._steps_left_in_budget() < 2)
+        if reduce:
+            self.reduced_effort_steps += 1
+        return bool(reduce)
+
+    def state(self):
+        """Per-step snapshot stored in history entries under 'convergence'."""
+        return {"smoothed_score": None if self.smoothed_score is None else round(self.smoothed_score, 2),
+                "trend": round(self.trend, 2), "stale_steps": self.stale_steps}
+
+    def summary(self, stop_reason=None):
+        return dict(self.settings(), **self.state(), stop_reason=stop_reason,
+                    stop_reason_text=describe_stop_reason(stop_reason) if stop_reason else None,
+                    elapsed_seconds=round(self.elapsed_seconds(), 2), tokens=self.tokens,
+                    cost_usd=round(self.cost_usd, 6), reduced_effort_steps=self.reduced_effort_steps)
@@ -0,0 +1,103 @@
+import contextvars
+import threading
+from contextlib import contextmanager
+
+import textgrad as tg
+from textgrad.config import SingletonBackwardEngine
+from textgrad.engine.base import EngineLM
+
+
+class EngineWrapper(EngineLM):
+    """
+    Base class for engines that wrap another TextGrad engine (caching, pacing, instrumentation, ...).
+    Subclasses override `generate`; everything else is delegated to the wrapped engine, so a wrapper
+    can be passed anywhere TextGrad expects an engine (BlackboxLLM, TextLoss, set_backward_engine, TGD).
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.model_string = getattr(engine, "model_string", str(engine))
+        self.system_prompt = getattr(engine, "system_prompt", EngineLM.system_prompt)
+
+    def generate(self, prompt, system_prompt=None, **kwargs):
+        return self.engine(prompt, system_prompt=system_prompt, **kwargs)
+
+    def __call__(self, prompt, system_prompt=None, **kwargs):
+        return self.generate(prompt, system_prompt=system_prompt, **kwargs)
+
+    def __getattr__(self, name):
+        # Only called for attributes not found on the wrapper itself
+        if name == "engine":
+            raise AttributeError(name)
+        return getattr(self.engine, name)
+
+    def unwrap(self):
+        """Returns the innermost (provider) engine."""
+        engine = self.engine
+        while isinstance(engine, EngineWrapper):
+            engine = engine.engine
+        return engine
+
+
+# TextGrad has one process-wide backward engine (tg.set_backward_engine), but every session and
+# background run may use a different evaluator. The global engine is therefore a router: a run pins
+# its own engine for the duration (pinned_backward_engine), everything else uses the last one set.
+_pinned_backward_engine = contextvars.ContextVar("pinned_backward_engine", default=None)
+
+
+class BackwardEngineRouter(EngineWrapper):
+    """Global backward engine that forwards to the engine pinned in the current context, if any."""
+
+    def generate(self, prompt, system_prompt=None, **kwargs):
+        engine = _pinned_backward_engine.get() or self.engine
+        return engine(prompt, system_prompt=system_prompt, **kwargs)
+
+
+_backward_router = None
+_backward_router_lock = threading.Lock()
+
+
+def set_backward_engine(engine):
+    """Sets the default backward engine (use instead of tg.set_backward_engine so runs can pin theirs)."""
+    global _backward_router
+    with _backward_router_lock:
+        if _backward_router is None:
+            _backward_router = BackwardEngineRouter(engine)
+            tg.set_backward_engine(_backward_router, override=True)
+        else:
+            _backward_router.engine = engine
+            _backward_router.model_string = getattr(engine, "model_string", str(engine))
+
+
+@contextmanager
+def pinned_backward_engine(engine):
+    """Routes all backward/optimizer calls made in this context (and pooled calls it starts) to `engine`."""
+    token = _pinned_backward_engine.set(engine)
+    try:
+        yield engine
+    finally:
+        _pinned_backward_engine.reset(token)
+
+
+def current_backward_engine():
+    """The default backward engine (the engine behind the router, if set_backward_engine was used)."""
+    engine = SingletonBackwardEngine().get_engine()
+    return engine.engine if isinstance(engine, BackwardEngineRouter) else engine
+
+
+# Time left for the provider call in progress (set by call_policy.ResilientEngine); providers that
+# support a request timeout use it so a hung request cannot outlive its deadline.
+_call_timeout = contextvars.ContextVar("call_timeout", default=None)
+
+
+@contextmanager
+def call_timeout(seconds):
+    token = _call_timeout.set(seconds)
+    try:
+        yield
+    finally:
+        _call_timeout.reset(token)
+
+
+def current_call_timeout():
+    return _call_timeout.get()
@@ -0,0 +1,38 @@
+"""
+Score aggregation and the sequential stopping rule for multi-sample evaluation
+(see pipeline.evaluate_table_ensemble).
+"""
+import math
+import statistics
+
+# Assumed evaluator score standard deviation (points) until a step has 2+ samples of its own
+PRIOR_SCORE_SD = 6.0
+# z-value for "clearly above/below the current best" (~90% one-sided)
+DECISION_Z = 1.28
+# Differences smaller than this are never treated as decisive
+MIN_DECISIVE_MARGIN = 2.0
+
+
+def summarize_scores(scores):
+    """
+    Aggregates evaluator sample scores.
+    Returns:
+        dict: median, mean, spread (sample standard deviation, 0 for a single sample), min, max, n.
+    """
+    return {
+        "median": statistics.median(scores), "mean": statistics.fmean(scores),
+        "spread": statistics.stdev(scores) if len(scores) > 1 else 0.0,
+        "min": min(scores), "max": max(scores), "n": len(scores),
+    }
+
+
+def is_decisive(scores, best_score):
+    """
+    Sequential stopping rule: True once the sample mean is clearly above or below `best_score`,
+    i.e. further evaluator samples are unlikely to change the best-score decision.
+    """
+    if best_score is None or not scores:
+        return False
+    sd = statistics.stdev(scores) if len(scores) > 1 else PRIOR_SCORE_SD
+    standard_error = sd / math.sqrt(len(scores))
+    return abs(statistics.fmean(scores) - best_score) > max(MIN_DECISIVE_MARGIN, DECISION_Z * standard_error)
@@ -0,0 +1,225 @@
+"""
+Structured (JSON) evaluation mode: a versioned result schema, its strict validator and the typed result.
+
+In this mode the evaluator answers with one JSON object instead of the markdown of
+EVALUATION_PROMPT_TEMPLATE:
+    {"schema_version": "1.0",
+     "criteria": [{"id": "A1.1", "awarded": 4, "max": 5, "rationale": "..."}, ...],   # every rubric item once
+     "total": 87, "description": "...", "feedback": "..."}
+validate_evaluation() checks it strictly (exact keys, every rubric criterion exactly once with its
+maximum, 0 <= awarded <= max, total == sum of awarded) and returns an EvaluationResult, which is
+stored in history entries under 'evaluation' (to_dict()), so analytics can read per-criterion points
+without scraping text. to_markdown() renders the result in the markdown structure, used as the loss
+text for the backward pass. The markdown mode stays the default and the fallback (pipeline.evaluate_table).
+"""
+import json
+import re
+from functools import lru_cache
+
+EVALUATION_SCHEMA_VERSION = "1.0"
+EVALUATION_FORMATS = ["markdown", "json"]
+
+# (criterion ID, short title, max points), as in the ANALYSIS MEASURES of EVALUATION_PROMPT_TEMPLATE (100 in total)
+RUBRIC_CRITERIA = [
+    ("A1.1", "Event relevance to sector, industry and region", 5),
+    ("A1.2", "Event specificity and headline-like phrasing", 5),
+    ("A2.1", "Awareness necessity for the company", 6),
+    ("A2.2", "Novelty / insight", 4),
+    ("A3.1", "Events derived from the provided sources, all sources weighted", 7),
+    ("A3.2", "Actual URLs used in the Source column", 5),
+    ("A3.3", "Source names when no URL; gnews_output item included", 3),
+    ("A4.1", "Side details factual, >= 30 words, verifiable", 5),
+    ("A4.2", "Side details formatting, no conversational filler", 5),
+    ("A5.1", "Impact scores analytical, not divisible by 5, diverse", 5),
+    ("A5.2", "Impact start/duration numeric, impact nature sound", 5),
+    ("A6", "Overall factuality, no hallucinations", 10),
+    ("A7.1", "Correct Strategic Imperative classification", 3),
+    ("A7.2", "At least 3 diverse events per SI8 category", 2),
+    ("B1.1", "Only the TAB-delimited table, no extra text", 10),
+    ("B1.2", "All fields double-quoted, no parsing issues", 5),
+    ("B2.1", "Minimum 3 diverse events per SI8", 5),
+    ("B2.2", "Event or Development phrasing concise and specific", 5),
+    ("B2.3", "Side details formatting and no filler", 5),
+]
+RUBRIC_MAX = {criterion_id: max_points for criterion_id, _, max_points in RUBRIC_CRITERIA}
+RESULT_KEYS = {"schema_version", "criteria", "total", "description", "feedback"}
+CRITERION_KEYS = {"id", "awarded", "max", "rationale"}
+
+_OUTPUT_STRUCTURE_RE = re.compile(r"^# --- EVALUATION OUTPUT STRUCTURE ---.*\Z", re.MULTILINE | re.DOTALL)
+_JSON_FENCE_RE = re.compile(r"```(?:json)?\s*(\{.*\})\s*```", re.DOTALL)
+_FEEDBACK_GUIDELINES_RE = re.compile(r"\*\*Feedback Guidelines.*", re.DOTALL)
+
+
+class EvaluationValidationError(ValueError):
+    """The evaluator's JSON does not match the evaluation schema; `problems` lists every violation."""
+
+    def __init__(self, problems):
+        super().__init__("; ".join(problems))
+        self.problems = problems
+
+
+class EvaluationResult:
+    """A validated structured evaluation."""
+
+    def __init__(self, criteria, total, description, feedback, schema_version=EVALUATION_SCHEMA_VERSION):
+        self.schema_version = schema_version
+        self.criteria = criteria  # [{"id", "awarded", "max", "rationale"}], in rubric order
+        self.total = total
+        self.description = description
+        self.feedback = feedback
+
+    @property
+    def score(self):
+        return int(round(self.total))
+
+    def points(self):
+        """Awarded points per criterion ID."""
+        return {c["id"]: c["awarded"] for c in self.criteria}
+
+    def to_dict(self):
+        return {"schema_version": self.schema_version, "criteria": [dict(c) for c in self.criteria],
+                "total": self.total, "description": self.description, "feedback": self.feedback}
+
+    @classmethod
+    def from_dict(cls, data):
+        return validate_evaluation(data)
+
+    def to_markdown(self):
+        """The result in the markdown structure of EVALUATION_PROMPT_TEMPLATE (loss text for the backward pass)."""
+        lines = ["## Scoring Description:", "`scoring description`:", self.description, ""]
+        for c in self.criteria:
+            lines.append(f"*   **{c['id']} - Awarded {_number(c['awarded'])}/{_number(c['max'])} pts**: {c['rationale']}")
+        lines += ["", "## Overall Score:", f"`score`: {self.score}", "",
+                  "## System Prompt Improvement Feedback:", "`feedback`:", self.feedback]
+        return "\n".join(lines)
+
+
+def _number(value):
+    return int(value) if float(value).is_integer() else value
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def validate_evaluation(data):
+    """
+    Strictly validates a decoded evaluation against schema EVALUATION_SCHEMA_VERSION.
+    Returns:
+        EvaluationResult
+    Raises:
+        EvaluationValidationError: listing every problem found (fed back to the evaluator on retry).
+    """
+    if not isinstance(data, dict):
+        raise EvaluationValidationError([f"expected a JSON object, got {type(data).__name__}"])
+    problems = []
+    if set(data) != RESULT_KEYS:
+        missing, extra = RESULT_KEYS - set(data), set(data) - RESULT_KEYS
+        problems.append(f"top-level keys must be exactly {sorted(RESULT_KEYS)}"
+                        + (f"; missing {sorted(missing)}" if missing else "") + (f"; unexpected {sorted(extra)}" if extra else ""))
+    if data.get("schema_version") != EVALUATION_SCHEMA_VERSION:
+        problems.append(f"schema_version must be \"{EVALUATION_SCHEMA_VERSION}\"")
+    for key in ("description", "feedback"):
+        if not isinstance(data.get(key), str) or not data.get(key).strip():
+            problems.append(f"'{key}' must be a non-empty string")
+
+    criteria = data.get("criteria")
+    by_id = {}
+    if not isinstance(criteria, list):
+        problems.append("'criteria' must be a list")
+        criteria = []
+    for index, item in enumerate(criteria):
+        if not isinstance(item, dict) or set(item) != CRITERION_KEYS:
+            problems.append(f"criteria[{index}] must be an object with exactly the keys {sorted(CRITERION_KEYS)}")
+            continue
+        criterion_id = item["id"]
+        if criterion_id not in RUBRIC_MAX:
+            problems.append(f"criteria[{index}]: unknown criterion id {criterion_id!r}")
+            continue
+        if criterion_id in by_id:
+            problems.append(f"criterion {criterion_id} appears more than once")
+            continue
+        if item["max"] != RUBRIC_MAX[criterion_id]:
+            problems.append(f"criterion {criterion_id}: 'max' must be {RUBRIC_MAX[criterion_id]}")
+        if not _is_number(item["awarded"]) or not 0 <= item["awarded"] <= RUBRIC_MAX[criterion_id]:
+            problems.append(f"criterion {criterion_id}: 'awarded' must be a number from 0 to {RUBRIC_MAX[criterion_id]}")
+        if not isinstance(item["rationale"], str) or not item["rationale"].strip():
+            problems.append(f"criterion {criterion_id}: 'rationale' must be a non-empty string")
+        by_id[criterion_id] = item
+    missing_ids = [criterion_id for criterion_id in RUBRIC_MAX if criterion_id not in by_id]
+    if missing_ids:
+        problems.append(f"missing criteria: {', '.join(missing_ids)}")
+
+    total = data.get("total")
+    if not _is_number(total):
+        problems.append("'total' must be a number")
+    elif not problems:
+        awarded_sum = sum(item["awarded"] for item in by_id.values())
+        if abs(total - awarded_sum) > 1e-6:
+            problems.append(f"'total' is {_number(total)} but the awarded points add up to {_number(awarded_sum)}")
+
+    if problems:
+        raise EvaluationValidationError(problems)
+    ordered = [dict(by_id[criterion_id]) for criterion_id in RUBRIC_MAX]
+    return EvaluationResult(ordered, total, data["description"].strip(), data["feedback"].strip())
+
+
+def parse_evaluation_json(text):
+    """
+    Decodes and validates an evaluator response in JSON mode (a bare object, optionally in a ``` fence).
+    Raises:
+        EvaluationValidationError: if there is no decodable JSON object or it violates the schema.
+    """
+    if not text or not isinstance(text, str):
+        raise EvaluationValidationError(["empty response"])
+    fenced = _JSON_FENCE_RE.search(text)
+    candidate = fenced.group(1) if fenced else text[text.find("{"):text.rfind("}") + 1]
+    try:
+        data = json.loads(candidate)
+    except ValueError as e:
+        raise EvaluationValidationError([f"not valid JSON ({e})"])
+    return validate_evaluation(data)
+
+
+def json_output_instructions():
+    """The output section of a JSON-mode evaluation prompt (braces escaped for str.format)."""
+    criteria = ",\n".join(
+        "    " + json.dumps({"id": criterion_id, "awarded": "<number 0..max>", "max": max_points, "rationale": f"<why: {title}>"})
+        for criterion_id, title, max_points in RUBRIC_CRITERIA
+    )
+    example = (
+        f'{{\n  "schema_version": "{EVALUATION_SCHEMA_VERSION}",\n  "criteria": [\n{criteria}\n  ],\n'
+        '  "total": "<exact sum of all awarded points>",\n'
+        '  "description": "<overall scoring description: strengths and where points were lost>",\n'
+        '  "feedback": "<actionable, specific changes to the INITIAL SYSTEM PROMPT, as a list of suggestions>"\n}'
+    )
+    text = (
+        "# --- EVALUATION OUTPUT STRUCTURE ---\n"
+        f"Respond with ONE JSON object (schema version {EVALUATION_SCHEMA_VERSION}) and nothing else: no markdown, "
+        "no text before or after it. Rules:\n"
+        "- 'criteria' lists EVERY criterion of the structure below exactly once, with its id and max exactly as given; 'awarded' is a "
+        "number from 0 to max; 'rationale' justifies the points for that criterion.\n"
+        "- 'total' MUST equal the exact sum of all 'awarded' values.\n"
+        "- 'description' summarizes the evaluation; 'feedback' holds the actionable, specific modifications to the "
+        "`INITIAL SYSTEM PROMPT` that would raise the score (target that prompt only, preserve its curly-bracket "
+        "placeholders, keep the 9 columns).\n"
+        "JSON structure:\n" + example + "\n"
+    )
+    return text.replace("{", "{{").replace("}", "}}")
+
+
+@lru_cache(maxsize=8)
+def json_evaluation_template(evaluation_template):
+    """
+    Turns a markdown evaluation template into its JSON-mode version: the output-structure section is
+    replaced by json_output_instructions() (appended if the template has no such section). The template's
+    feedback guidelines, if any, are kept as the guidelines for the 'feedback' field.
+    """
+    section = _OUTPUT_STRUCTURE_RE.search(evaluation_template)
+    if section is None:
+        return evaluation_template.rstrip("\n") + "\n\n" + json_output_instructions()
+    instructions = json_output_instructions()
+    guidelines = _FEEDBACK_GUIDELINES_RE.search(section.group(0))
+    if guidelines:
+        instructions += "\nFor 'feedback', follow these guidelines:\n" + guidelines.group(0).rstrip().rstrip("]").rstrip() + "\n"
+    return evaluation_template[:section.start()] + instructions
@@ -0,0 +1,246 @@
+"""
+Local stand-in for the Gemini engines, used for load testing without spending API quota.
+
+A fake engine is selected with a model string of the form
+    fake:<profile>[?param=value&...]
+e.g. "fake:default", "fake:slow", "fake:flaky?error_rate=0.2&mean=0.5".
+It recognises the four kinds of calls the app makes (table generation, TextLoss evaluation,
+loss.backward() feedback and TGD optimizer.step()) from their prompts and returns canned,
+well-formed responses after a randomly drawn latency.
+"""
+import json
+import math
+import random
+import re
+import threading
+import time
+from datetime import datetime
+
+from textgrad.engine.base import EngineLM
+
+from call_policy import classify_call
+from config import SI8_CATEGORIES, TABLE_COLUMNS
+from engine_wrappers import current_call_timeout
+
+# Latency distributions (seconds), injected error rates and malformed-table rates per profile
+FAKE_ENGINE_PROFILES = {
+    "default": {"distribution": "lognormal", "mean": 1.5, "sigma": 0.5, "error_rate": 0.0},
+    "fast": {"distribution": "uniform", "low": 0.05, "high": 0.2, "error_rate": 0.0},
+    "slow": {"distribution": "lognormal", "mean": 6.0, "sigma": 0.7, "error_rate": 0.0},
+    "flaky": {"distribution": "exponential", "mean": 2.0, "error_rate": 0.1, "malformed_rate": 0.2},
+    "instant": {"distribution": "fixed", "mean": 0.0, "error_rate": 0.0},
+}
+
+# (criterion, max points per sub-criterion) as in EVALUATION_PROMPT_TEMPLATE
+EVALUATION_RUBRIC = [
+    ("A1", [5, 5]), ("A2", [6, 4]), ("A3", [7, 5, 3]), ("A4", [5, 5]),
+    ("A5", [5, 5]), ("A6", [10]), ("A7", [3, 2]),
+    ("B1", [10, 5]), ("B2", [5, 5, 5]),
+]
+INJECTED_ERRORS = [
+    "429 Resource has been exhausted (e.g. check quota). [injected by fake engine]",
+    "503 The model is overloaded. Please try again later. [injected by fake engine]",
+    "504 Deadline Exceeded [injected by fake engine]",
+]
+
+
+class FakeEngineError(RuntimeError):
+    """Error injected by FakeEngine to simulate provider failures."""
+
+
+def parse_fake_model_string(model_string):
+    """
+    Parses 'fake:<profile>?k=v&...' into a settings dict.
+    Returns:
+        dict: The profile settings with any overrides applied.
+    """
+    spec = model_string.split(":", 1)[1] if ":" in model_string else "default"
+    profile_name, _, query = spec.partition("?")
+    settings = dict(FAKE_ENGINE_PROFILES.get(profile_name or "default", FAKE_ENGINE_PROFILES["default"]))
+    for pair in filter(None, query.split("&")):
+        key, _, value = pair.partition("=")
+        try:
+            settings[key] = float(value)
+        except ValueError:
+            settings[key] = value
+    return settings
+
+
+class FakeEngine(EngineLM):
+    """TextGrad-compatible engine returning canned tables/evaluations after simulated latency."""
+
+    def __init__(self, model_string="fake:default", seed=None):
+        self.model_string = model_string
+        self.settings = parse_fake_model_string(model_string)
+        self._rng = random.Random(seed)
+        self._rng_lock = threading.Lock()
+        self.calls = []  # (kind, latency_seconds, error) tuples, appended per call
+        self._calls_lock = threading.Lock()
+
+    def _draw(self, func, *args):
+        with self._rng_lock:
+            return func(*args)
+
+    def sample_latency(self):
+        s = self.settings
+        distribution = s.get("distribution", "fixed")
+        mean = float(s.get("mean", 0.0))
+        if distribution == "uniform":
+            return self._draw(self._rng.uniform, float(s.get("low", 0.0)), float(s.get("high", mean * 2)))
+        if distribution == "exponential":
+            return self._draw(self._rng.expovariate, 1.0 / mean) if mean > 0 else 0.0
+        if distribution == "lognormal" and mean > 0:
+            sigma = float(s.get("sigma", 0.5))
+            # Parameterised so that `mean` is the median latency
+            return self._draw(self._rng.lognormvariate, math.log(mean), sigma)
+        return mean
+
+    def _respond(self, kind, prompt, system_prompt=None):
+        if kind == "optimizer":
+            return self._fake_optimizer_update(prompt)
+        if kind == "evaluate":
+            if "schema_version" in (system_prompt or ""):  # Structured evaluation mode (evaluation_schema.py)
+                return self._fake_json_evaluation(malformed_allowed=True)
+            if "schema_version" in (prompt if isinstance(prompt, str) else ""):
+                return self._fake_json_evaluation()
+            return self._fake_evaluation()
+        if kind == "backward":
+            return self._fake_feedback()
+        table = self._fake_table()
+        if self._draw(self._rng.random) < float(self.settings.get("malformed_rate", 0.0)):
+            # Typical format violation: conversational intro before the table
+            table = "Here is the table report you requested:\n\n" + table
+        return table
+
+    def _maybe_fail(self):
+        if self._draw(self._rng.random) < float(self.settings.get("error_rate", 0.0)):
+            error = self._draw(self._rng.choice, INJECTED_ERRORS)
+            raise FakeEngineError(error)
+
+    def _record(self, kind, latency, error):
+        with self._calls_lock:
+            self.calls.append((kind, latency, error))
+
+    def generate(self, prompt, system_prompt=None, **kwargs):
+        kind = classify_call(prompt, system_prompt)
+        latency = self.sample_latency()
+        timeout = current_call_timeout()
+        if timeout is not None and latency > timeout:
+            # Like a provider client with a request timeout
+            time.sleep(timeout)
+            self._record(kind, timeout, "timeout")
+            raise TimeoutError(f"Request timed out after {timeout:.1f}s [fake engine]")
+        time.sleep(latency)
+        try:
+            self._maybe_fail()
+        except FakeEngineError as e:
+            self._record(kind, latency, str(e))
+            raise
+        self._record(kind, latency, None)
+        return self._respond(kind, prompt, system_prompt)
+
+    def stream_generate(self, prompt, system_prompt=None, chunk_chars=400, **kwargs):
+        """
+        Yields the response in chunks: ~30% of the sampled latency before the first chunk
+        (time to first token), the rest spread evenly over the remaining chunks.
+        """
+        kind = classify_call(prompt, system_prompt)
+        latency = self.sample_latency()
+        time.sleep(latency * 0.3)
+        try:
+            self._maybe_fail()
+        except FakeEngineError as e:
+            self._record(kind, latency * 0.3, str(e))
+            raise
+        text = self._respond(kind, prompt, system_prompt)
+        chunks = [text[i:i + chunk_chars] for i in range(0, len(text), chunk_chars)] or [""]
+        for index, chunk in enumerate(chunks):
+            if index:
+                time.sleep(latency * 0.7 / max(len(chunks) - 1, 1))
+            yield chunk
+        self._record(kind, latency, None)
+
+    def __call__(self, prompt, system_prompt=None, **kwargs):
+        return self.generate(prompt, system_prompt=system_prompt, **kwargs)
+
+    def _score(self, low, high):
+        # Scores in the app must not be divisible by 5
+        value = self._draw(self._rng.randint, low, high)
+        return value + 1 if value % 5 == 0 else value
+
+    def _fake_table(self):
+        rows = ["\t".join(f'"{c}"' for c in TABLE_COLUMNS)]
+        for si in SI8_CATEGORIES:
+            for n in range(3):
+                side_details = (
+                    f"**{si} Development {n + 1}** -- Regional operators announced a measurable expansion of "
+                    f"services tied to {si.lower()}, with multi-year investment commitments, new partnerships and "
+                    f"regulatory milestones expected to shift market share and customer expectations across major cities."
+                )
+                fields = [
+                    si, f"Launch of pilot program {n + 1} for {si.lower()}", str(self._score(11, 98)),
+                    str(datetime.now().year + n), str(self._draw(self._rng.randint, 2, 9)),
+                    self._draw(self._rng.choice, ["linear", "exponential", "logistic", "oscillatory", "polynomial"]),
+                    str(self._score(11, 98)), side_details,
+                    f"https://www.example.com/news/{si.lower().replace(' ', '-')}-{n + 1}",
+                ]
+                rows.append("\t".join(f'"{f}"' for f in fields))
+        return "\n".join(rows)
+
+    def _fake_evaluation(self):
+        lines = ["## Scoring Description:", "`scoring description`:"]
+        totals = {}
+        for criterion, maxima in EVALUATION_RUBRIC:
+            awarded = [self._draw(self._rng.randint, max(0, m - 3), m) for m in maxima]
+            totals[criterion] = awarded
+            lines.append(f"{criterion[1]}.  **{criterion} ({sum(awarded)}/{sum(maxima)} points)**:")
+            for a, m in zip(awarded, maxima):
+                lines.append(f"    *   **Awarded {a}/{m} pts**: Simulated assessment for load testing.")
+        section_a = sum(sum(v) for k, v in totals.items() if k.startswith("A"))
+        section_b = sum(sum(v) for k, v in totals.items() if k.startswith("B"))
+        lines += [
+            "", "## Overall Score:", f"`score`: {section_a + section_b}",
+            f"Total A = {section_a}", f"Total B = {section_b}",
+            f"Grand Total = {section_a} + {section_b} = {section_a + section_b}",
+            "", "## System Prompt Improvement Feedback:",
+            "`feedback`:",
+            "-   \"To improve A3 (Source URL Prioritization): In the `INITIAL SYSTEM_PROMPT`, modify Guideline 11 "
+            "to require the exact URL from gnews_output whenever one is present.\"",
+            "-   \"To improve A4 ('Side details' Quality): Add to Guideline 9: 'Include at least one quantitative fact.'\"",
+        ]
+        return "\n".join(lines)
+
+    def _fake_json_evaluation(self, malformed_allowed=False):
+        criteria = []
+        for criterion, maxima in EVALUATION_RUBRIC:
+            for index, m in enumerate(maxima, 1):
+                criteria.append({"id": f"{criterion}.{index}" if len(maxima) > 1 else criterion,
+                                 "awarded": self._draw(self._rng.randint, max(0, m - 3), m), "max": m,
+                                 "rationale": "Simulated assessment for load testing."})
+        total = sum(c["awarded"] for c in criteria)
+        if malformed_allowed and self._draw(self._rng.random) < float(self.settings.get("malformed_rate", 0.0)):
+            total += 7  # Typical schema violation: the total does not match the awarded points
+        return json.dumps({
+            "schema_version": "1.0", "criteria": criteria, "total": total,
+            "description": "Simulated structured evaluation for load testing.",
+            "feedback": "To improve A3 (Source URL Prioritization): In the `INITIAL SYSTEM_PROMPT`, modify Guideline 11 "
+                        "to require the exact URL from gnews_output whenever one is present.",
+        }, indent=2)
+
+    def _fake_feedback(self):
+        return ("Tighten guideline 9 so 'Side details' always include a quantitative fact, and require "
+                "gnews_output URLs in the Source column whenever they are present.")
+
+    def _fake_optimizer_update(self, prompt):
+        match = re.search(r"<VARIABLE>(.*?)</VARIABLE>", prompt if isinstance(prompt, str) else "", re.DOTALL)
+        current = match.group(1) if match else ""
+        improved = current.rstrip() + "\n19. **Quantitative Side details**: Include at least one verifiable figure per row."
+        constraint = re.search(r"Constraint 1: (.*)", prompt if isinstance(prompt, str) else "")
+        if constraint:  # Constrained proposals (beam search) differ from the plain update
+            improved += f"\n20. **Revision focus**: {constraint.group(1).strip()}"
+        return f"<IMPROVED_VARIABLE>{improved}</IMPROVED_VARIABLE>"
+
+    def call_stats(self):
+        """Returns a copy of the recorded (kind, latency, error) tuples."""
+        with self._calls_lock:
+            return list(self.calls)
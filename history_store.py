@@ -0,0 +1,282 @@
+"""
+Compact, memory-bounded store for an optimization run's history (Section 5 of the app).
+
+A plain history list keeps full copies of every step's prompt, table and raw evaluation for as long
+as the session lives. HistoryStore keeps each step as one zlib-compressed record instead:
+    - the prompt as a line delta against the previous step's prompt (consecutive prompts differ by a
+      few lines), with a full copy every HISTORY_KEYFRAME_INTERVAL steps so rebuilding one stays cheap;
+    - everything else (table, raw evaluation, beam/batch details, ...) compressed as JSON.
+Once the compressed records of a session exceed HISTORY_MEMORY_BUDGET_BYTES, the oldest are appended
+to a spill file in HISTORY_SPILL_DIR (deleted with the store) and read back on demand. The latest and
+the best step, plus the last HISTORY_HOT_ENTRIES steps read, stay decoded ("hot").
+summaries() gives the light per-step fields (score, timings, metrics, ...) without decoding anything;
+summary_rows() and run_bundle() build the Section 5 overview and the on-demand run download from them.
+"""
+import csv
+import difflib
+import io
+import json
+import os
+import threading
+import uuid
+import weakref
+import zipfile
+import zlib
+
+from config import (HISTORY_MEMORY_BUDGET_BYTES, HISTORY_SPILL_DIR, HISTORY_KEYFRAME_INTERVAL,
+                    HISTORY_HOT_ENTRIES)
+
+# Per-step fields that only live in the compressed records (also stripped from beam/batch items)
+HEAVY_KEYS = ("prompt", "table", "evaluation_raw", "description", "feedback")
+
+
+def prompt_delta(base, prompt):
+    """
+    Line delta turning `base` into `prompt`: ["c", i1, i2] copies base lines i1:i2, ["a", text] adds text.
+    """
+    base_lines, lines = base.splitlines(keepends=True), prompt.splitlines(keepends=True)
+    ops = []
+    for tag, i1, i2, j1, j2 in difflib.SequenceMatcher(None, base_lines, lines, autojunk=False).get_opcodes():
+        if tag == "equal":
+            ops.append(["c", i1, i2])
+        elif j2 > j1:  # replace / insert; deletions just skip the base lines
+            ops.append(["a", "".join(lines[j1:j2])])
+    return ops
+
+
+def apply_prompt_delta(base, ops):
+    base_lines = base.splitlines(keepends=True)
+    return "".join("".join(base_lines[op[1]:op[2]]) if op[0] == "c" else op[1] for op in ops)
+
+
+def _light(item):
+    return {k: v for k, v in item.items() if k not in HEAVY_KEYS}
+
+
+def summarize_entry(entry):
+    """The light fields of a history entry (no prompt/table/evaluation texts, no per-criterion results)."""
+    summary = _light(entry)
+    for key in ("beam", "batch"):
+        if summary.get(key):
+            summary[key] = [{k: v for k, v in _light(item).items() if k not in ("evaluation", "loss")}
+                            for item in summary[key]]
+    if summary.get("evaluation"):
+        summary["evaluation"] = {k: v for k, v in summary["evaluation"].items() if k != "result"}
+    return summary
+
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+class HistoryStore:
+    """History entries of one run, compressed, with bounded memory. Entries are appended in step order."""
+
+    def __init__(self, entries=(), memory_budget_bytes=HISTORY_MEMORY_BUDGET_BYTES, spill_dir=HISTORY_SPILL_DIR):
+        self.memory_budget_bytes = memory_budget_bytes
+        self.spill_dir = spill_dir
+        self.spill_path = None  # Created on the first spill
+        self._summaries = []
+        self._records = []  # Compressed record bytes, or None once spilled
+        self._spilled = []  # (offset, length) in the spill file, or None
+        self._memory_bytes = 0
+        self._last_prompt = ""
+        self._best_index = None
+        self._hot = {}  # index -> decoded entry; latest, best and recently read
+        self._recent = []  # Recently read indexes, newest last
+        self._prompt_cache = (None, None)  # (index, prompt) of the last prompt rebuilt
+        self._lock = threading.Lock()
+        self._finalizer = None
+        for entry in entries:
+            self.append(entry)
+
+    def __len__(self):
+        return len(self._summaries)
+
+    def __bool__(self):
+        return bool(self._summaries)
+
+    def append(self, entry):
+        prompt = entry.get("prompt") or ""
+        with self._lock:
+            index = len(self._summaries)
+            if index % HISTORY_KEYFRAME_INTERVAL == 0:
+                stored_prompt = {"text": prompt}
+            else:
+                stored_prompt = {"delta": prompt_delta(self._last_prompt, prompt)}
+            record = zlib.compress(json.dumps({"prompt": stored_prompt, "entry": {k: v for k, v in entry.items()
+                                                                                  if k != "prompt"}},
+                                              default=str).encode("utf-8"))
+            self._last_prompt = prompt
+            self._summaries.append(summarize_entry(entry))
+            self._records.append(record)
+            self._spilled.append(None)
+            self._memory_bytes += len(record)
+
+            score, best = entry.get("score"), self._best_index
+            if (score is not None and entry.get("batch_complete") is not False  # Partial minibatch steps never count
+                    and (best is None or score > self._summaries[best].get("score"))):
+                self._best_index = index
+            self._hot[index] = entry
+            self._evict_hot()
+            self._spill()
+
+    def summaries(self):
+        """Light per-step dicts (see summarize_entry), in step order."""
+        return list(self._summaries)
+
+    def get(self, index):
+        """The full entry at `index` (negative indexes count from the end)."""
+        with self._lock:
+            index = range(len(self._summaries))[index]
+            entry = self._hot.get(index)
+            if entry is None:
+                entry = self._decode(index)
+                self._hot[index] = entry
+            if index in self._recent:
+                self._recent.remove(index)
+            self._recent.append(index)
+            self._evict_hot()
+            return entry
+
+    def entries(self):
+        """All full entries, decoded one at a time (for exports; does not make them hot)."""
+        for index in range(len(self._summaries)):
+            with self._lock:
+                entry = self._hot.get(index) or self._decode(index)
+            yield entry
+
+    def latest(self):
+        return self.get(-1) if self._summaries else None
+
+    def best(self):
+        return self.get(self._best_index) if self._best_index is not None else None
+
+    def find_candidate(self, candidate_id):
+        """A beam search candidate (full, with its prompt) from the step that proposed it."""
+        for index, summary in enumerate(self._summaries):
+            for item in summary.get("beam") or []:
+                if item["id"] == candidate_id and not item.get("carried"):
+                    return next(c for c in self.get(index)["beam"] if c["id"] == candidate_id)
+        return None
+
+    def memory_usage(self):
+        """Compressed bytes in memory and on disk (decoded hot entries are not counted)."""
+        spilled = sum(location[1] for location in self._spilled if location)
+        return {"steps": len(self._summaries), "memory_bytes": self._memory_bytes, "spilled_bytes": spilled,
+                "spilled_steps": sum(1 for location in self._spilled if location), "hot_steps": len(self._hot)}
+
+    # --- Internals (called with the lock held) ---
+    def _evict_hot(self):
+        keep = {len(self._summaries) - 1, self._best_index} | set(self._recent[-HISTORY_HOT_ENTRIES:])
+        self._recent = [i for i in self._recent if i in keep]
+        for index in [i for i in self._hot if i not in keep]:
+            del self._hot[index]
+
+    def _spill(self):
+        # Oldest first; the newest record stays in memory
+        for index in range(len(self._records) - 1):
+            if self._memory_bytes <= self.memory_budget_bytes:
+                return
+            record = self._records[index]
+            if record is None:
+                continue
+            if self.spill_path is None:
+                os.makedirs(self.spill_dir, exist_ok=True)
+                self.spill_path = os.path.join(self.spill_dir, f"history_{uuid.uuid4().hex}.bin")
+                self._finalizer = weakref.finalize(self, _remove_file, self.spill_path)
+            with open(self.spill_path, "ab") as f:
+                offset = f.tell()
+                f.write(record)
+            self._spilled[index] = (offset, len(record))
+            self._records[index] = None
+            self._memory_bytes -= len(record)
+
+    def _record(self, index):
+        record = self._records[index]
+        if record is not None:
+            return json.loads(zlib.decompress(record))
+        offset, length = self._spilled[index]
+        with open(self.spill_path, "rb") as f:
+            f.seek(offset)
+            return json.loads(zlib.decompress(f.read(length)))
+
+    def _prompt(self, index, stored_prompt):
+        if "text" in stored_prompt:
+            prompt = stored_prompt["text"]
+        else:
+            cached_index, cached_prompt = self._prompt_cache
+            if cached_index == index - 1:
+                base = cached_prompt
+            elif (index - 1) in self._hot:
+                base = self._hot[index - 1].get("prompt") or ""
+            else:
+                base = self._prompt(index - 1, self._record(index - 1)["prompt"])
+            prompt = apply_prompt_delta(base, stored_prompt["delta"])
+        self._prompt_cache = (index, prompt)
+        return prompt
+
+    def _decode(self, index):
+        record = self._record(index)
+        entry = record["entry"]
+        entry["prompt"] = self._prompt(index, record["prompt"])
+        return entry
+
+    def close(self):
+        """Deletes the spill file (also done when the store is garbage collected)."""
+        if self._finalizer is not None:
+            self._finalizer()
+
+
+def summary_rows(summaries, best_step=None):
+    """
+    One row per step for the history overview: step, score, change against the previous scored step,
+    timings (seconds per stage) and estimated LLM usage.
+    """
+    rows = []
+    previous_score = None
+    for summary in summaries:
+        score = summary.get("score")
+        metrics_total = (summary.get("metrics") or {}).get("total") or {}
+        row = {"step": summary["step"], "score": score,
+               "delta": score - previous_score if score is not None and previous_score is not None else None,
+               "best": summary["step"] == best_step and score is not None}
+        for name, seconds in (summary.get("timings") or {}).items():
+            row[name.replace("_seconds", "") + " (s)"] = seconds
+        row["llm_calls"] = metrics_total.get("calls")
+        row["cost_usd"] = round(metrics_total["cost_usd"], 4) if "cost_usd" in metrics_total else None
+        rows.append(row)
+        if score is not None:
+            previous_score = score
+    return rows
+
+
+def run_bundle(store, run_info=None):
+    """
+    Zip archive of a whole run, built on request: summary.csv, history.json (all entries) and one folder
+    per step with its prompt, table, feedback, scoring description and raw evaluation.
+    Returns:
+        bytes
+    """
+    rows = summary_rows(store.summaries(), (run_info or {}).get("best_step"))
+    csv_text = io.StringIO()
+    if rows:
+        writer = csv.DictWriter(csv_text, fieldnames=list(dict.fromkeys(k for row in rows for k in row)))
+        writer.writeheader()
+        writer.writerows(rows)
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as bundle:
+        bundle.writestr("summary.csv", csv_text.getvalue())
+        entries = []
+        for entry in store.entries():
+            folder = f"step_{entry['step']:03d}" if isinstance(entry.get("step"), int) else f"step_{entry.get('step')}"
+            for name, key in (("prompt.txt", "prompt"), ("table.tsv", "table"), ("feedback.txt", "feedback"),
+                              ("description.txt", "description"), ("evaluation.txt", "evaluation_raw")):
+                if entry.get(key):
+                    bundle.writestr(f"{folder}/{name}", str(entry[key]))
+            entries.append(entry)
+        bundle.writestr("history.json", json.dumps(dict(run_info or {}, history=entries), indent=2, default=str))
+    return buffer.getvalue()
@@ -0,0 +1,147 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+from config import LLM_CACHE_PATH, LLM_CACHE_MAX_BYTES, LLM_CACHE_TTL_SECONDS
+from engine_wrappers import EngineWrapper
+
+
+def make_cache_key(engine_name, system_prompt, prompt, sampling_params=None):
+    """
+    Content-addressed key for one LLM call.
+    Args:
+        engine_name (str): Model string of the engine.
+        system_prompt (str): System prompt sent with the call.
+        prompt (str or list): User prompt (lists are used by multimodal engines).
+        sampling_params (dict, optional): Extra generation kwargs (temperature, max_tokens, ...).
+    Returns:
+        str: SHA-256 hex digest.
+    """
+    payload = json.dumps(
+        [engine_name, system_prompt, prompt, sampling_params or {}],
+        sort_keys=True, ensure_ascii=False, default=str
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    On-disk LLM response cache in a single SQLite file.
+    Responses are zlib-compressed; entries older than `ttl_seconds` are treated as misses and
+    the least recently used entries are evicted once the store grows past `max_bytes`.
+    """
+
+    def __init__(self, path=LLM_CACHE_PATH, max_bytes=LLM_CACHE_MAX_BYTES, ttl_seconds=LLM_CACHE_TTL_SECONDS):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " key TEXT PRIMARY KEY, engine TEXT, response BLOB, size INTEGER,"
+            " created_at REAL, last_access REAL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_last_access ON responses(last_access)")
+
+    def get(self, key):
+        """Returns the cached response for `key`, or None on a miss (expired entries count as misses)."""
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT response, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is not None and self.ttl_seconds and now - row[1] > self.ttl_seconds:
+                self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.evictions += 1
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+            self.hits += 1
+        return zlib.decompress(row[0]).decode("utf-8")
+
+    def put(self, key, engine_name, response):
+        """Stores a response and evicts least recently used entries if the size cap is exceeded."""
+        if not isinstance(response, str):
+            return
+        blob = zlib.compress(response.encode("utf-8"))
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, engine, response, size, created_at, last_access)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (key, engine_name, blob, len(blob), now, now)
+            )
+            self._evict_locked()
+
+    def _evict_locked(self):
+        if self.ttl_seconds:
+            cursor = self._conn.execute("DELETE FROM responses WHERE created_at < ?", (time.time() - self.ttl_seconds,))
+            self.evictions += max(cursor.rowcount, 0)
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if not self.max_bytes or total <= self.max_bytes:
+            return
+        # Evict down to 90% of the cap so we don't evict on every single insert
+        target = int(self.max_bytes * 0.9)
+        for key, size in self._conn.execute("SELECT key, size FROM responses ORDER BY last_access ASC").fetchall():
+            if total <= target:
+                break
+            self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            total -= size
+            self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM responses")
+
+    def stats(self):
+        """Returns hit/miss/eviction counters (since process start) and the current store size."""
+        with self._lock:
+            entries, total_bytes = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+            ).fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+            "hit_ratio": (self.hits / lookups) if lookups else 0.0,
+            "entries": entries, "bytes": total_bytes, "max_bytes": self.max_bytes,
+        }
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_response_cache(path=LLM_CACHE_PATH):
+    """Returns the process-wide ResponseCache for `path` (one store shared by all cached engines)."""
+    with _caches_lock:
+        if path not in _caches:
+            _caches[path] = ResponseCache(path)
+        return _caches[path]
+
+
+class CachedEngine(EngineWrapper):
+    """TextGrad engine wrapper that serves exact-repeat calls from a ResponseCache."""
+
+    def __init__(self, engine, cache=None):
+        super().__init__(engine)
+        self.cache = cache or get_response_cache()
+
+    def generate(self, prompt, system_prompt=None, **kwargs):
+        key = make_cache_key(self.model_string, system_prompt, prompt, kwargs)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached
+        response = self.engine(prompt, system_prompt=system_prompt, **kwargs)
+        self.cache.put(key, self.model_string, response)
+        return response
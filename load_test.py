@@ -0,0 +1,208 @@
+"""
+Load-test driver for sizing a Streamlit deployment.
+
+Simulates N concurrent users, each going through the app's flow (Section 1 generate,
+Section 2 evaluate, Section 3 optimize) on shared engines, the same way concurrent
+Streamlit sessions share the st.cache_resource engines. Use fake engines (see fake_engine.py)
+to avoid spending API quota.
+
+Usage:
+    python load_test.py --users 20 --steps 3 --generator fake:default --evaluator "fake:flaky?error_rate=0.05"
+"""
+import argparse
+import json
+import sys
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+import textgrad as tg
+from dotenv import load_dotenv
+
+from config import INITIAL_SYSTEM_PROMPT_TEXT, EVALUATION_PROMPT_TEMPLATE
+from pipeline import format_user_query, make_user_prompt_var, generate_table, evaluate_table, run_optimization
+from textgrad_utils import create_engine
+from engine_wrappers import set_backward_engine
+
+SAMPLE_PROFILE = {
+    "industry": "mobility", "region": "middle east", "transformational_journey": "shared mobility",
+    "program_area": "ride hailing", "company_name": "NOT PROVIDED", "future_year": 20, "unrelated_keywords": "",
+    "google_agent_output": "Ride-hailing demand in the Gulf keeps growing as cities invest in shared mobility.",
+    "bard_outputs": "", "web_content": "", "url_output": "",
+    "gnews_output": "Careem expands electric fleet in Dubai - https://www.example.com/careem-ev",
+}
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of numbers (None for an empty list)."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, int(round(pct / 100.0 * len(ordered) + 0.5)) - 1))
+    return ordered[rank]
+
+
+def deep_sizeof(obj, _seen=None):
+    """Approximate retained size in bytes of an object graph (what a session would keep in st.session_state)."""
+    _seen = _seen if _seen is not None else set()
+    if id(obj) in _seen:
+        return 0
+    _seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_sizeof(k, _seen) + deep_sizeof(v, _seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(deep_sizeof(item, _seen) for item in obj)
+    elif hasattr(obj, "__dict__"):
+        size += deep_sizeof(vars(obj), _seen)
+    return size
+
+
+def simulate_user(user_id, generator_engine, evaluator_engine, num_steps, latencies, latencies_lock):
+    """
+    Runs one simulated session end to end.
+    Returns:
+        dict: Per-session outcome (status, best score, retained memory, duration).
+    """
+    def record(phase, seconds):
+        with latencies_lock:
+            latencies.setdefault(phase, []).append(seconds)
+
+    started = time.perf_counter()
+    session_state = {}
+    try:
+        user_query_text = format_user_query(SAMPLE_PROFILE)
+        prompt_var = tg.Variable(INITIAL_SYSTEM_PROMPT_TEXT, requires_grad=True,
+                                 role_description="System prompt for generating the table report")
+        user_prompt_var = make_user_prompt_var(user_query_text)
+
+        t0 = time.perf_counter()
+        table_var = generate_table(generator_engine, prompt_var, user_prompt_var)
+        record("generate", time.perf_counter() - t0)
+
+        t0 = time.perf_counter()
+        loss, score, description, feedback = evaluate_table(
+            evaluator_engine, EVALUATION_PROMPT_TEMPLATE, INITIAL_SYSTEM_PROMPT_TEXT, user_query_text,
+            table_var, SAMPLE_PROFILE
+        )
+        record("evaluate", time.perf_counter() - t0)
+        session_state.update(table_var=table_var, loss=loss, score=score)
+        if score is None:
+            return {"user": user_id, "status": "unparsed_score", "duration": time.perf_counter() - started}
+
+        step_marks = []
+
+        def on_progress(step, total_steps):
+            step_marks.append(time.perf_counter())
+
+        t0 = time.perf_counter()
+        result = run_optimization(
+            INITIAL_SYSTEM_PROMPT_TEXT, SAMPLE_PROFILE, generator_engine, evaluator_engine,
+            num_steps=num_steps, target_score=101,  # never stop early: measure every step
+            initial_result={"prompt": INITIAL_SYSTEM_PROMPT_TEXT, "table": table_var.value, "score": score,
+                            "description": description, "feedback": feedback},
+            status_callback=lambda message, level: None, progress_callback=on_progress,
+        )
+        step_marks.append(time.perf_counter())
+        for start, end in zip(step_marks, step_marks[1:]):
+            record("optimization_step", end - start)
+        record("optimization_run", time.perf_counter() - t0)
+        session_state["optimization"] = result
+
+        errors = sum(1 for entry in result["history"] if entry["score"] is None)
+        return {
+            "user": user_id, "status": "ok", "best_score": result["best_score"], "failed_steps": errors,
+            "session_bytes": deep_sizeof(session_state), "duration": time.perf_counter() - started,
+        }
+    except Exception as e:
+        return {"user": user_id, "status": "error", "error": str(e), "duration": time.perf_counter() - started}
+
+
+def run_load_test(users, num_steps, generator_name, evaluator_name, ramp_up_seconds=0.0):
+    """
+    Runs `users` concurrent simulated sessions and returns a report dict.
+    """
+    generator_engine = create_engine(generator_name)
+    evaluator_engine = create_engine(evaluator_name)
+    set_backward_engine(evaluator_engine)
+
+    latencies, latencies_lock = {}, threading.Lock()
+    tracemalloc.start()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=users, thread_name_prefix="sim-user") as executor:
+        futures = []
+        for user_id in range(users):
+            futures.append(executor.submit(simulate_user, user_id, generator_engine, evaluator_engine,
+                                           num_steps, latencies, latencies_lock))
+            if ramp_up_seconds and users > 1:
+                time.sleep(ramp_up_seconds / (users - 1))
+        sessions = [f.result() for f in futures]
+    wall_seconds = time.perf_counter() - started
+    _, peak_traced_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    llm_calls = []
+    for engine in {id(generator_engine): generator_engine, id(evaluator_engine): evaluator_engine}.values():
+        llm_calls.extend(getattr(engine, "call_stats", lambda: [])())
+
+    completed = [s for s in sessions if s["status"] == "ok"]
+    session_bytes = [s["session_bytes"] for s in completed]
+    return {
+        "users": users, "steps_per_user": num_steps, "wall_seconds": round(wall_seconds, 2),
+        "sessions_completed": len(completed), "sessions_failed": len(sessions) - len(completed),
+        "throughput_sessions_per_min": round(len(completed) / wall_seconds * 60, 2) if wall_seconds else None,
+        "throughput_llm_calls_per_sec": round(len(llm_calls) / wall_seconds, 2) if wall_seconds else None,
+        "injected_errors": sum(1 for _, _, error in llm_calls if error),
+        "step_latency_seconds": {
+            phase: {"count": len(values), "p50": percentile(values, 50), "p95": percentile(values, 95),
+                    "p99": percentile(values, 99), "max": max(values)}
+            for phase, values in sorted(latencies.items())
+        },
+        "memory": {
+            "peak_traced_mb": round(peak_traced_bytes / (1024 * 1024), 2),
+            "peak_traced_mb_per_session": round(peak_traced_bytes / (1024 * 1024) / max(users, 1), 3),
+            "retained_session_kb_p50": round(percentile(session_bytes, 50) / 1024, 1) if session_bytes else None,
+            "retained_session_kb_max": round(max(session_bytes) / 1024, 1) if session_bytes else None,
+        },
+        "sessions": sessions,
+    }
+
+
+def print_report(report):
+    print(f"Users: {report['users']}  Steps/user: {report['steps_per_user']}  Wall time: {report['wall_seconds']}s")
+    print(f"Completed: {report['sessions_completed']}  Failed: {report['sessions_failed']}  "
+          f"Injected errors: {report['injected_errors']}")
+    print(f"Throughput: {report['throughput_sessions_per_min']} sessions/min, "
+          f"{report['throughput_llm_calls_per_sec']} LLM calls/s")
+    print(f"{'Phase':<20}{'count':>7}{'p50 (s)':>10}{'p95 (s)':>10}{'p99 (s)':>10}{'max (s)':>10}")
+    for phase, stats in report["step_latency_seconds"].items():
+        print(f"{phase:<20}{stats['count']:>7}{stats['p50']:>10.2f}{stats['p95']:>10.2f}"
+              f"{stats['p99']:>10.2f}{stats['max']:>10.2f}")
+    memory = report["memory"]
+    print(f"Memory: peak traced {memory['peak_traced_mb']} MB "
+          f"({memory['peak_traced_mb_per_session']} MB/session), retained session state "
+          f"p50 {memory['retained_session_kb_p50']} KB / max {memory['retained_session_kb_max']} KB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate concurrent users of the report optimizer.")
+    parser.add_argument("--users", type=int, default=10, help="Number of concurrent simulated sessions.")
+    parser.add_argument("--steps", type=int, default=3, help="Optimization steps per session.")
+    parser.add_argument("--generator", default="fake:default", help="Engine name for the generator (e.g. fake:fast).")
+    parser.add_argument("--evaluator", default="fake:default", help="Engine name for the evaluator.")
+    parser.add_argument("--ramp-up", type=float, default=0.0, help="Seconds over which sessions are started.")
+    parser.add_argument("--json-out", default=None, help="Optional path to write the full report as JSON.")
+    args = parser.parse_args()
+
+    load_dotenv()
+    report = run_load_test(args.users, args.steps, args.generator, args.evaluator, ramp_up_seconds=args.ramp_up)
+    print_report(report)
+    if args.json_out:
+        with open(args.json_out, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"Full report written to '{args.json_out}'.")
+
+
+if __name__ == "__main__":
+    main()
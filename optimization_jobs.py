@@ -0,0 +1,199 @@
+"""
+Background execution of optimization runs.
+
+An optimization run (pipeline.run_optimization / resume_optimization) takes minutes. Running it
+inside the Streamlit script freezes the session, cannot be cancelled and is killed by any rerun.
+submit_job() instead runs it on a process-wide worker pool and returns an OptimizationJob with a
+job ID. The script (any rerun, or a new session that knows the ID) polls job.snapshot() for
+progress, status messages, the completed steps and the rows of the table being generated in the
+current step (streamed generations, table_stream.py); job.cancel() asks the run to stop before its
+next step/evaluation, and the run still returns the best result found so far.
+"""
+import contextvars
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from config import OPTIMIZATION_JOB_WORKERS, OPTIMIZATION_JOB_RETENTION_SECONDS
+from rate_limiter import scheduler_session
+from table_stream import stream_listener
+from tracing import root_span
+
+MAX_JOB_MESSAGES = 50  # Status messages kept per job for display
+
+
+class OptimizationJob:
+    """State of one background optimization run, updated by the worker and read by the UI."""
+
+    def __init__(self, job_id, num_steps, label="", session_id=None):
+        self.job_id = job_id
+        self.label = label
+        self.session_id = session_id or job_id  # Fair-queueing identity of the job's LLM calls
+        self.status = "queued"  # queued -> running -> done | cancelled | failed
+        self.num_steps = num_steps
+        self.current_step = 0
+        self.messages = deque(maxlen=MAX_JOB_MESSAGES)
+        self.history = []  # Completed steps, in order
+        self.best = None
+        self.live_table = None  # {"header", "rows", "restart"} of the generation streaming in the current step
+        self._live_thread = None  # Thread whose generation live_table follows
+        self.result = None
+        self.error = None
+        self.released = False
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.cancel_event = threading.Event()
+        self._lock = threading.Lock()
+
+    # --- Callbacks passed to run_optimization (called from the worker thread) ---
+    def on_status(self, message, level="info"):
+        with self._lock:
+            self.messages.append((time.time(), level, message))
+
+    def on_progress(self, step, num_steps):
+        with self._lock:
+            self.current_step, self.num_steps = step, num_steps
+
+    def on_step(self, entry, best):
+        with self._lock:
+            self.history.append(entry)
+            self.best = dict(best)
+            self.live_table, self._live_thread = None, None
+
+    # --- Stream listener (table_stream.stream_listener), called from the generating thread ---
+    def on_stream_row(self, header, row, row_index):
+        thread = threading.get_ident()
+        with self._lock:
+            if row_index == 0 and self._live_thread in (None, thread):
+                # A new generation; with several concurrent ones (minibatch, beam) the first one is followed
+                self.live_table, self._live_thread = {"header": header, "rows": [], "restart": None}, thread
+            if self._live_thread == thread and self.live_table is not None:
+                self.live_table["rows"].append(row)
+
+    def on_stream_restart(self, reason, attempt):
+        with self._lock:
+            if self._live_thread in (None, threading.get_ident()):
+                self.live_table = {"header": None, "rows": [], "restart": (attempt, reason)}
+
+    def release(self):
+        """Drops the steps and result once the session has taken them over (keeps the job's memory bounded)."""
+        with self._lock:
+            self.history = []
+            self.live_table = None
+            self.result = None
+            self.released = True
+
+    def cancel(self):
+        """Requests cooperative cancellation; the run stops before its next step or evaluation."""
+        self.cancel_event.set()
+
+    @property
+    def finished(self):
+        return self.status in ("done", "cancelled", "failed")
+
+    def snapshot(self):
+        """Consistent copy of the job state for display (the lists keep referencing the step dicts)."""
+        with self._lock:
+            return {
+                "job_id": self.job_id, "label": self.label,
+                "status": "cancelling" if self.status == "running" and self.cancel_event.is_set() else self.status,
+                "current_step": self.current_step, "num_steps": self.num_steps,
+                "messages": list(self.messages), "history": list(self.history), "best": self.best,
+                "live_table": dict(self.live_table, rows=list(self.live_table["rows"])) if self.live_table else None,
+                "error": self.error, "submitted_at": self.submitted_at, "started_at": self.started_at,
+                "finished_at": self.finished_at,
+                "elapsed_seconds": round((self.finished_at or time.time()) - (self.started_at or time.time()), 1),
+            }
+
+
+class JobManager:
+    """Runs optimization jobs on a bounded thread pool shared by all sessions of the process."""
+
+    def __init__(self, max_workers=OPTIMIZATION_JOB_WORKERS, retention_seconds=OPTIMIZATION_JOB_RETENTION_SECONDS):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="optimization-job")
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self.retention_seconds = retention_seconds
+
+    def submit(self, run_func, total_steps, label="", session_id=None, **kwargs):
+        """
+        Starts run_func(**kwargs, status_callback=..., progress_callback=..., step_callback=..., cancel_event=...)
+        in the background.
+        Args:
+            run_func (callable): pipeline.run_optimization or pipeline.resume_optimization (or a compatible function).
+            total_steps (int): Expected number of steps, for the progress display.
+            session_id (str, optional): Session the job's LLM calls are queued under (rate_limiter.py);
+                defaults to the job ID.
+        Returns:
+            OptimizationJob
+        """
+        job = OptimizationJob(uuid.uuid4().hex[:12], total_steps, label=label, session_id=session_id)
+        with self._lock:
+            self._prune()
+            self._jobs[job.job_id] = job
+        # In a copy of the submitter's context, so e.g. a profiling session's tracer sees the job (tracing.py)
+        self._executor.submit(contextvars.copy_context().run, self._run, job, run_func, kwargs)
+        return job
+
+    def _run(self, job, run_func, kwargs):
+        job.started_at = time.time()
+        job.status = "running"
+        try:
+            with scheduler_session(job.session_id), root_span("optimization_job", job_id=job.job_id, label=job.label), \
+                    stream_listener(job.on_stream_row, job.on_stream_restart):
+                result = run_func(status_callback=job.on_status, progress_callback=job.on_progress,
+                                  step_callback=job.on_step, cancel_event=job.cancel_event, **kwargs)
+            job.result = result
+            status = "cancelled" if result.get("stop_reason") == "cancelled" else "done"
+        except Exception as e:
+            print(f"Optimization job {job.job_id} failed: {e}")
+            job.error = str(e)
+            job.on_status(f"Optimization failed: {e}", "error")
+            status = "failed"
+        job.finished_at = time.time()
+        job.status = status  # Set last: pollers treat a finished status as "result is ready"
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def cancel(self, job_id):
+        job = self.get(job_id)
+        if job is not None:
+            job.cancel()
+        return job
+
+    def list_jobs(self):
+        with self._lock:
+            return sorted(self._jobs.values(), key=lambda j: j.submitted_at, reverse=True)
+
+    def _prune(self):
+        # Finished jobs are only kept long enough for their session to pick up the result
+        cutoff = time.time() - self.retention_seconds
+        for job_id in [j.job_id for j in self._jobs.values() if j.finished and j.finished_at < cutoff]:
+            del self._jobs[job_id]
+
+
+_job_manager = None
+_job_manager_lock = threading.Lock()
+
+
+def get_job_manager():
+    """Returns the process-wide JobManager (created on first use)."""
+    global _job_manager
+    if _job_manager is None:
+        with _job_manager_lock:
+            if _job_manager is None:
+                _job_manager = JobManager()
+    return _job_manager
+
+
+def submit_job(run_func, total_steps, label="", session_id=None, **kwargs):
+    return get_job_manager().submit(run_func, total_steps, label=label, session_id=session_id, **kwargs)
+
+
+def get_job(job_id):
+    return get_job_manager().get(job_id) if job_id else None
@@ -0,0 +1,1170 @@
+import json
+import os
+import re
+import time
+import textgrad as tg
+from datetime import datetime
+
+from config import (USER_QUERY_TEMPLATE, EVALUATION_PROMPT_TEMPLATE, BEAM_PROPOSAL_CONSTRAINTS, SCORE_REPAIR_PROMPT_TEMPLATE,
+                    JSON_EVALUATION_CORRECTION_PROMPT_TEMPLATE)
+from utils import parse_evaluation_output, parse_evaluation_details, score_check
+from async_engines import run_in_engine_pool, gather_calls, run_async
+from evaluation_ensemble import summarize_scores, is_decisive
+from llm_cache import CachedEngine
+from engine_wrappers import current_backward_engine, pinned_backward_engine
+from table_validator import prescore_table, prescore_feedback
+from source_dedup import dedupe_sources_cached
+from prompt_cache import prefix_stable_template, prompt_cache_usage
+from call_policy import call_telemetry
+from call_metrics import metrics_phase, usage_metrics, merge_metrics
+from convergence import ConvergenceController, describe_stop_reason
+from evaluation_schema import (EVALUATION_SCHEMA_VERSION, EvaluationValidationError, parse_evaluation_json,
+                               json_evaluation_template)
+from tracing import span, traced
+from run_journal import RunJournal, read_journal, resume_state
+
+MANDATORY_INPUT_FIELDS = ["industry", "region", "transformational_journey", "program_area"]
+EXTERNAL_DATA_KEYS = ["google_agent_output", "bard_outputs", "web_content", "url_output", "gnews_output"]
+
+# Values the sidebar pre-fills; used so headless profiles format the same way as the UI.
+OPTIONAL_INPUT_DEFAULTS = {
+    "company_name": "NOT PROVIDED",
+    "future_year": 20,
+    "unrelated_keywords": "",
+}
+
+
+def validate_user_inputs(user_input_data):
+    """
+    Checks the mandatory fields and external data of a user input profile.
+    Args:
+        user_input_data (dict): Profile with industry, region, external sources, etc.
+    Returns:
+        list: Markdown-formatted validation error messages (empty if the profile is valid).
+    """
+    errors = [f"- **{field.replace('_', ' ').title()}** cannot be empty."
+              for field in MANDATORY_INPUT_FIELDS if not str(user_input_data.get(field, "") or "").strip()]
+    if not any(str(user_input_data.get(key, "") or "").strip() for key in EXTERNAL_DATA_KEYS):
+        errors.append("- At least one **External Data Input** must be provided.")
+    return errors
+
+
+def parse_profiles(raw, base_dir="."):
+    """
+    Parses user input profiles from JSON list or JSONL text.
+    '<source>_file' entries are resolved relative to `base_dir` and inlined as '<source>'.
+    Returns:
+        list: Profile dicts, each with a file-name-safe 'id'.
+    """
+    if raw.lstrip().startswith("["):
+        profiles = json.loads(raw)
+    else:
+        profiles = [json.loads(line) for line in raw.splitlines() if line.strip()]
+
+    for index, profile in enumerate(profiles):
+        for key in EXTERNAL_DATA_KEYS:
+            file_key = f"{key}_file"
+            if profile.get(file_key):
+                source_path = profile.pop(file_key)
+                if not os.path.isabs(source_path):
+                    source_path = os.path.join(base_dir, source_path)
+                with open(source_path, "r", encoding="utf-8") as f:
+                    profile[key] = f.read()
+        if not profile.get("id"):
+            profile["id"] = f"{index:04d}_{profile.get('industry', '')}_{profile.get('region', '')}"
+        profile["id"] = re.sub(r"[^A-Za-z0-9_-]+", "_", str(profile["id"])).strip("_")
+    return profiles
+
+
+def build_format_data(user_input_data):
+    """
+    Builds the placeholder values used by the user query and evaluation templates.
+    'future_year' in the profile is a delta from the current year; it is converted to an absolute year here.
+    If the profile sets 'dedupe_sources', near-duplicate passages across the external sources are collapsed
+    (see source_dedup.py), shrinking both the generator and the evaluator prompts.
+    """
+    format_data = dict(OPTIONAL_INPUT_DEFAULTS)
+    format_data.update({key: "" for key in EXTERNAL_DATA_KEYS})
+    format_data.update({k: v for k, v in user_input_data.items() if v is not None})
+    if user_input_data.get("dedupe_sources"):
+        deduped, _ = dedupe_sources_cached(format_data, EXTERNAL_DATA_KEYS)
+        format_data.update(deduped)
+    current_year = datetime.now().year
+    format_data["current_year"] = current_year
+    format_data["future_year"] = current_year + int(format_data.get("future_year") or 20)
+    return format_data
+
+
+def source_dedup_report(user_input_data):
+    """Returns the near-duplicate collapse report for a profile's external sources."""
+    sources = {key: str(user_input_data.get(key) or "") for key in EXTERNAL_DATA_KEYS}
+    return dedupe_sources_cached(sources, EXTERNAL_DATA_KEYS)[1]
+
+
+@traced("format_user_query")
+def format_user_query(user_input_data):
+    """Formats USER_QUERY_TEMPLATE for the given profile."""
+    return USER_QUERY_TEMPLATE.format(**build_format_data(user_input_data))
+
+
+@traced("format_evaluation_prompt")
+def build_evaluation_instruction(evaluation_template, system_prompt_text, user_query_text, table_text, user_input_data,
+                                 prompt_layout="template", evaluation_format="markdown"):
+    """
+    Formats the evaluation prompt template for one generated table.
+    With prompt_layout="prefix_stable", the per-step sections (system prompt, table) are moved to the end so
+    the rubric and user query form an identical, provider-cacheable prefix across steps (see prompt_cache.py).
+    With evaluation_format="json", the evaluator is asked for a schema-validated JSON object instead of
+    markdown (see evaluation_schema.py).
+    """
+    if evaluation_format == "json":
+        evaluation_template = json_evaluation_template(evaluation_template)
+    if prompt_layout == "prefix_stable":
+        evaluation_template = prefix_stable_template(evaluation_template)
+    return evaluation_template.format(
+        system_prompt_text=system_prompt_text,
+        user_query_text=user_query_text,
+        generated_table_text=table_text,
+        **build_format_data(user_input_data)
+    )
+
+
+def make_user_prompt_var(user_query_text):
+    return tg.Variable(
+        user_query_text, requires_grad=False,
+        role_description="User inputs and contextual data for table generation"
+    )
+
+
+def generate_table(generator_engine, system_prompt_var, user_prompt_var):
+    """
+    Runs the Generator LLM forward pass.
+    Returns:
+        tg.Variable: The generated table variable (keeps the graph link to the system prompt).
+    """
+    model = tg.BlackboxLLM(generator_engine, system_prompt=system_prompt_var)
+    with metrics_phase("generate"), span("BlackboxLLM.forward"):
+        return model(user_prompt_var)
+
+
+def evaluate_table(evaluator_engine, evaluation_template, system_prompt_text, user_query_text,
+                   table_variable, user_input_data, role_description="Evaluation instruction for optimization step",
+                   prompt_layout="template", evaluation_format="markdown"):
+    """
+    Runs the Evaluator LLM (tg.TextLoss) on a generated table.
+    With evaluation_format="json", the response is validated against the evaluation schema (one correction
+    call if it fails) and its markdown rendering becomes the loss value; the typed result is attached as
+    loss.evaluation_record (see evaluation_record()). If the JSON still fails, the table is evaluated again
+    in markdown.
+    Returns:
+        tuple: (loss variable, score, scoring description, feedback)
+    """
+    eval_instruction_text = build_evaluation_instruction(
+        evaluation_template, system_prompt_text, user_query_text, table_variable.value, user_input_data,
+        prompt_layout=prompt_layout, evaluation_format=evaluation_format
+    )
+    loss_instruction_var = tg.Variable(eval_instruction_text, requires_grad=False, role_description=role_description)
+    loss_fn = tg.TextLoss(loss_instruction_var, engine=evaluator_engine)
+    with metrics_phase("evaluate"), span("TextLoss.forward"):
+        loss = loss_fn(table_variable)
+    if evaluation_format == "json":
+        result, corrected = validate_json_evaluation(evaluator_engine, loss.value)
+        if result is None:
+            print("Structured evaluation is still invalid after correction; falling back to a markdown evaluation.")
+            loss, score, description, feedback = evaluate_table(
+                evaluator_engine, evaluation_template, system_prompt_text, user_query_text, table_variable,
+                user_input_data, role_description=role_description, prompt_layout=prompt_layout
+            )
+            loss.evaluation_record = {"format": "markdown", "fallback": True, "corrected": corrected, "result": None}
+            return loss, score, description, feedback
+        # The backward pass and score checks read the same markdown structure as in markdown mode
+        loss.set_value(result.to_markdown())
+        loss.evaluation_record = {"format": "json", "fallback": False, "corrected": corrected,
+                                  "result": result.to_dict()}
+        return loss, result.score, result.description, result.feedback
+    if loss.value and loss.value.strip() and parse_evaluation_details(loss.value)["score"] is None:
+        # Neither a readable Overall Score nor a complete set of awarded points to sum
+        restated = repair_evaluation_score(evaluator_engine, loss.value)
+        if restated is not None:
+            # Appended to the loss text, so the backward pass and the journal see the score that was used
+            loss.set_value(f"{loss.value.rstrip()}\n\n## Overall Score (restated):\n`score`: {restated}")
+    score, description, feedback = parse_evaluation_output(loss.value)
+    return loss, score, description, feedback
+
+
+def repair_evaluation_score(evaluator_engine, evaluation_text):
+    """
+    Asks the evaluator to restate only the Overall Score of an evaluation whose score could not be
+    parsed or summed locally (a short call instead of a full re-evaluation of the table).
+    Returns:
+        int or None: The restated score.
+    """
+    try:
+        with metrics_phase("evaluate"), span("score_repair"):
+            response = evaluator_engine(SCORE_REPAIR_PROMPT_TEMPLATE.format(evaluation_text=evaluation_text))
+    except Exception as e:
+        print(f"Score repair call failed: {e}")
+        return None
+    match = re.search(r"`?score`?\s*:\s*\**\s*(\d{1,3})\b", response or "", re.IGNORECASE)
+    if match and int(match.group(1)) <= 100:
+        print(f"Evaluation score restated by the evaluator: {match.group(1)}")
+        return int(match.group(1))
+    return None
+
+
+def validate_json_evaluation(evaluator_engine, evaluation_text):
+    """
+    Validates a JSON-mode evaluation; if it violates the schema, asks the evaluator once to correct it,
+    listing the problems found.
+    Returns:
+        tuple: (evaluation_schema.EvaluationResult or None, whether a correction call was made)
+    """
+    try:
+        return parse_evaluation_json(evaluation_text), False
+    except EvaluationValidationError as e:
+        print(f"Structured evaluation failed validation ({e}); asking the evaluator to correct it.")
+        problems = e.problems
+    try:
+        with metrics_phase("evaluate"), span("json_evaluation_correction"):
+            response = evaluator_engine(JSON_EVALUATION_CORRECTION_PROMPT_TEMPLATE.format(
+                schema_version=EVALUATION_SCHEMA_VERSION, problems="\n".join(f"- {p}" for p in problems),
+                evaluation_text=evaluation_text
+            ))
+        return parse_evaluation_json(response), True
+    except Exception as e:
+        print(f"Structured evaluation correction failed: {e}")
+        return None, True
+
+
+def evaluation_record(loss):
+    """The structured evaluation of a loss from evaluate_table (None in markdown mode), stored in history entries."""
+    return getattr(loss, "evaluation_record", None)
+
+
+async def agenerate_table(generator_engine, system_prompt_var, user_prompt_var):
+    """Async version of generate_table; runs on the shared engine pool so several generations can overlap."""
+    return await run_in_engine_pool(generate_table, generator_engine, system_prompt_var, user_prompt_var)
+
+
+async def aevaluate_table(evaluator_engine, evaluation_template, system_prompt_text, user_query_text,
+                          table_variable, user_input_data, role_description="Evaluation instruction for optimization step",
+                          prompt_layout="template", evaluation_format="markdown"):
+    """Async version of evaluate_table; runs on the shared engine pool so several evaluations can overlap."""
+    return await run_in_engine_pool(
+        evaluate_table, evaluator_engine, evaluation_template, system_prompt_text, user_query_text,
+        table_variable, user_input_data, role_description=role_description, prompt_layout=prompt_layout,
+        evaluation_format=evaluation_format
+    )
+
+
+def evaluate_table_ensemble(evaluator_engine, evaluation_template, system_prompt_text, user_query_text,
+                            table_variable, user_input_data, max_samples=3, parallel_samples=2, best_score=None,
+                            role_description="Evaluation instruction for optimization step", prompt_layout="template",
+                            evaluation_format="markdown"):
+    """
+    Evaluates one table with up to `max_samples` evaluator samples, drawn `parallel_samples` at a time,
+    stopping early once the score is clearly above or below `best_score`.
+    Args:
+        max_samples (int): Upper bound on evaluator calls for this table.
+        parallel_samples (int): Samples drawn concurrently per round.
+        best_score (int, optional): Current best score; without it all `max_samples` are drawn.
+    Returns:
+        tuple: (loss, score, description, feedback, ensemble) where `score` is the rounded median,
+               `loss`/`description`/`feedback` come from the sample closest to the median (used for
+               the backward pass) and `ensemble` holds the sample scores and their summary.
+    """
+    if isinstance(evaluator_engine, CachedEngine) and max_samples > 1:
+        # Identical calls would be served from the cache, so extra samples add nothing
+        print("Warning: evaluator response cache is enabled; using a single evaluator sample.")
+        max_samples = 1
+
+    samples = []  # (loss, score, description, feedback)
+    stopped_early = False
+    while len(samples) < max_samples:
+        round_size = min(max(1, parallel_samples), max_samples - len(samples))
+        results = run_async(gather_calls(*[
+            aevaluate_table(evaluator_engine, evaluation_template, system_prompt_text, user_query_text,
+                            table_variable, user_input_data, role_description=role_description,
+                            prompt_layout=prompt_layout, evaluation_format=evaluation_format)
+            for _ in range(round_size)
+        ], return_exceptions=True))
+        errors = [r for r in results if isinstance(r, Exception)]
+        samples.extend(r for r in results if not isinstance(r, Exception))
+        if not samples and errors:
+            raise errors[0]
+        scores = [s[1] for s in samples if s[1] is not None]
+        if len(samples) < max_samples and is_decisive(scores, best_score):
+            stopped_early = True
+            break
+
+    scored = [s for s in samples if s[1] is not None]
+    if not scored:
+        loss, _, description, feedback = samples[0]
+        return loss, None, description, feedback, {"scores": [], "samples_drawn": len(samples), "stopped_early": stopped_early}
+
+    summary = summarize_scores([s[1] for s in scored])
+    representative = min(scored, key=lambda s: abs(s[1] - summary["median"]))
+    loss, _, description, feedback = representative
+    ensemble = {
+        "scores": [s[1] for s in scored], "samples_drawn": len(samples),
+        "stopped_early": stopped_early, **summary,
+    }
+    return loss, int(round(summary["median"])), description, feedback, ensemble
+
+
+@traced("prescore_table")
+def prescore_for_profile(table_text, user_input_data):
+    """Runs the local pre-scorer with the profile's year range."""
+    format_data = build_format_data(user_input_data)
+    return prescore_table(table_text, format_data["current_year"], format_data["future_year"])
+
+
+def generate_table_with_prescore(generator_engine, system_prompt_var, user_prompt_var, user_input_data,
+                                 max_regenerations=1, status_callback=None):
+    """
+    Generates a table and checks it with the local pre-scorer, regenerating (no evaluator call)
+    up to `max_regenerations` times while it fails the gate.
+    Returns:
+        tuple: (table variable, pre-score report, number of regenerations)
+    """
+    table_var = generate_table(generator_engine, system_prompt_var, user_prompt_var)
+    report = prescore_for_profile(table_var.value, user_input_data)
+    regenerations = 0
+    while not report["passed"] and regenerations < max_regenerations:
+        regenerations += 1
+        _notify(status_callback, f"Local checks failed ({report['local_score']}/{report['local_max']}); "
+                                 f"regenerating table ({regenerations}/{max_regenerations})...", "warning")
+        table_var = generate_table(generator_engine, system_prompt_var, user_prompt_var)
+        report = prescore_for_profile(table_var.value, user_input_data)
+    return table_var, report, regenerations
+
+
+def _notify(status_callback, message, level="info"):
+    if status_callback:
+        status_callback(message, level)
+    else:
+        print(message)
+
+
+def _tgd_update(optimizer, system_prompt_var):
+    """Applies the accumulated textual gradients with TGD and returns their texts (journaled as TGD state)."""
+    gradients = [g.value for g in system_prompt_var.gradients]
+    with metrics_phase("optimizer"), span("optimizer.step"):
+        optimizer.step()
+    optimizer.zero_grad()
+    return gradients
+
+
+def run_optimization(system_prompt_text, user_input_data, generator_engine, evaluator_engine,
+                     evaluation_template=EVALUATION_PROMPT_TEMPLATE, num_steps=3, target_score=90,
+                     initial_result=None, status_callback=None, progress_callback=None, evaluator_samples=1,
+                     prescore_gate=False, max_regenerations=1, prompt_layout="template", evaluation_format="markdown",
+                     journal=None, resume=None, step_callback=None, cancel_event=None, convergence=None):
+    """
+    Runs the generate -> evaluate -> TGD loop for one user input profile.
+    The backward/optimizer engine is the default backward engine when the run starts
+    (see engine_wrappers.set_backward_engine); it stays pinned for the whole run.
+    Args:
+        system_prompt_text (str): Starting system prompt.
+        user_input_data (dict): Sidebar-style profile (industry, region, external sources, ...).
+        generator_engine, evaluator_engine: TextGrad engines.
+        evaluation_template (str): Evaluation prompt template to format each step.
+        num_steps (int): Maximum number of optimization steps.
+        target_score (int): Stop as soon as a step reaches this score.
+        initial_result (dict, optional): Already-evaluated starting point with keys
+            'prompt', 'table', 'score', 'description', 'feedback'. If omitted, the starting
+            prompt is generated and evaluated first (recorded as step 0).
+        status_callback (callable, optional): Called as status_callback(message, level) with level in
+            ('info', 'success', 'warning', 'error'). Defaults to printing.
+        progress_callback (callable, optional): Called as progress_callback(step, num_steps) before each step.
+        evaluator_samples (int): Evaluator samples per step. Above 1, each step is scored by the median of
+            an early-stopping ensemble (see evaluate_table_ensemble) instead of a single TextLoss call.
+        prescore_gate (bool): Check each table with the local pre-scorer first. Failing tables are regenerated
+            up to `max_regenerations` times; if they still fail, the step is rejected without an evaluator
+            call and the failed checks are used as the optimizer's feedback.
+        prompt_layout (str): "template" or "prefix_stable" (see build_evaluation_instruction). Each history
+            entry records the step's prompt tokens and how many were cache-eligible under 'prompt_cache'.
+        journal (run_journal.RunJournal, optional): Append every completed step (with timings and TGD state)
+            to this journal so the run survives crashes and restarts.
+        resume (dict, optional): run_journal.resume_state() of an interrupted run. Continues after its last
+            completed step (history, best result and the TGD parameter value are restored).
+        step_callback (callable, optional): Called as step_callback(entry, best) after each recorded step.
+        cancel_event (threading.Event, optional): Checked before each step and before each evaluation; once set,
+            the run stops (stop reason "cancelled") and returns the best result found so far.
+        convergence (dict, optional): Time/token/cost budgets, patience and minimum improvement for a
+            convergence.ConvergenceController (keys: convergence.SETTING_KEYS). Before each step it may stop the
+            run early (stop reasons "time_budget", "token_budget", "cost_budget", "plateau") or switch the step
+            to a single evaluator sample without regenerations; each entry records the trend under 'convergence'.
+    Returns:
+        dict: best_prompt, best_table, best_score, best_description, best_feedback, best_step,
+              history (list of step dicts), final_prompt, system_prompt_var, stop_reason, run_id (if journaled),
+              metrics (estimated tokens/LLM seconds/cost of the run by phase and model, see call_metrics.py)
+              and convergence (the controller's summary, None without budgets/patience).
+    """
+    user_query_text = format_user_query(user_input_data)
+    user_prompt_var = make_user_prompt_var(user_query_text)
+    controller = ConvergenceController.from_settings(convergence)  # Created first: the time budget includes the initial evaluation
+
+    initial_metrics = None  # LLM usage of the initial generation/evaluation, if done here
+    if resume is not None:
+        initial_result = resume["initial_result"]
+        system_prompt_text = resume["system_prompt_text"]
+        _notify(status_callback, f"Resuming run {resume['run_id']} from step {resume['next_step']}.")
+    elif initial_result is None:
+        initial_prompt_var = tg.Variable(system_prompt_text, requires_grad=True,
+                                         role_description="System prompt for generating the table report")
+        with usage_metrics() as initial_metrics, span("initial_evaluation"):
+            initial_table_var = generate_table(generator_engine, initial_prompt_var, user_prompt_var)
+            _, score, description, feedback = evaluate_table(
+                evaluator_engine, evaluation_template, system_prompt_text, user_query_text,
+                initial_table_var, user_input_data, prompt_layout=prompt_layout,
+                evaluation_format=evaluation_format
+            )
+        initial_result = {"prompt": system_prompt_text, "table": initial_table_var.value, "score": score,
+                          "description": description, "feedback": feedback}
+        _notify(status_callback, f"Initial evaluation score: {score}")
+
+    if journal is not None and resume is None:
+        journal.start({
+            "system_prompt_text": system_prompt_text, "user_input_data": user_input_data,
+            "evaluation_template": evaluation_template, "num_steps": num_steps, "target_score": target_score,
+            "evaluator_samples": evaluator_samples, "prescore_gate": prescore_gate,
+            "max_regenerations": max_regenerations, "prompt_layout": prompt_layout,
+            "evaluation_format": evaluation_format, "convergence": convergence,
+            "generator_model": getattr(generator_engine, "model_string", str(generator_engine)),
+            "evaluator_model": getattr(evaluator_engine, "model_string", str(evaluator_engine)),
+        }, initial_result)
+
+    system_prompt_var = tg.Variable(system_prompt_text, requires_grad=True,
+                                    role_description="System prompt being optimized by TextGrad")
+    optimizer = tg.TGD(parameters=[system_prompt_var])
+    # Pinned for the whole run: other sessions may switch the default backward engine meanwhile
+    backward_engine = current_backward_engine()
+
+    if resume is not None:
+        best = dict(resume["best"])
+        history = list(resume["history"])
+        first_step = resume["next_step"]
+    else:
+        # Initialize tracking for best result, starting with the already evaluated one
+        best = {
+            "score": initial_result.get("score"), "prompt": initial_result.get("prompt", system_prompt_text),
+            "table": initial_result.get("table", ""), "description": initial_result.get("description", ""),
+            "feedback": initial_result.get("feedback", ""), "step": 0,  # 0 for initial state before optimization loop
+        }
+        history = []
+        first_step = 1
+    stop_reason = "max_steps"
+    if controller is not None:
+        controller.start(initial_result.get("score"), history, initial_metrics)
+
+    with pinned_backward_engine(backward_engine), span("optimization_loop", num_steps=num_steps):
+        for current_step in range(first_step, num_steps + 1):
+            if cancel_event is not None and cancel_event.is_set():
+                stop_reason = "cancelled"
+                break
+            reduced_effort = False
+            if controller is not None:
+                early_stop = controller.check()
+                if early_stop:
+                    _notify(status_callback, f"Stopping before step {current_step}: {describe_stop_reason(early_stop)}.", "warning")
+                    stop_reason = early_stop
+                    break
+                reduced_effort = controller.reduce_effort()
+                if reduced_effort and (evaluator_samples > 1 or prescore_gate):
+                    _notify(status_callback, f"Step {current_step}: Little progress or budget left; "
+                                             f"using a single evaluator sample and no regenerations.")
+            step_samples = 1 if reduced_effort else evaluator_samples
+            step_regenerations = 0 if reduced_effort else max_regenerations
+            if progress_callback:
+                progress_callback(current_step, num_steps)
+
+            step_started = time.perf_counter()
+            timings = {}
+            gradients = None
+            with (span("optimization_step", step=current_step), prompt_cache_usage() as cache_usage,
+                  call_telemetry() as call_stats, usage_metrics() as step_metrics):
+                try:
+                    prompt_before_update = system_prompt_var.value
+                    prescore = None
+                    t0 = time.perf_counter()
+                    if prescore_gate:
+                        table_var, prescore, _ = generate_table_with_prescore(
+                            generator_engine, system_prompt_var, user_prompt_var, user_input_data,
+                            max_regenerations=step_regenerations, status_callback=status_callback
+                        )
+                        timings["generate_seconds"] = time.perf_counter() - t0
+                        if not prescore["passed"]:
+                            # Rejected locally: no evaluator round-trip; the failed checks become the gradient
+                            local_feedback = prescore_feedback(prescore)
+                            history.append({
+                                "step": current_step, "prompt": prompt_before_update,
+                                "table": table_var.value, "score": None,
+                                "description": f"Rejected by local pre-scorer ({prescore['local_score']}/{prescore['local_max']} local pts).",
+                                "feedback": local_feedback, "evaluation_raw": "", "evaluation_samples": None,
+                                "prescore": prescore
+                            })
+                            _notify(status_callback, f"Step {current_step}: Table rejected by local checks. Updating prompt from local feedback.", "warning")
+                            system_prompt_var.gradients.add(tg.Variable(
+                                local_feedback, requires_grad=False, role_description="feedback to the system prompt"
+                            ))
+                            t0 = time.perf_counter()
+                            gradients = _tgd_update(optimizer, system_prompt_var)
+                            timings["update_seconds"] = time.perf_counter() - t0
+                            continue
+                    else:
+                        table_var = generate_table(generator_engine, system_prompt_var, user_prompt_var)
+                        timings["generate_seconds"] = time.perf_counter() - t0
+
+                    if cancel_event is not None and cancel_event.is_set():
+                        # Don't pay for an evaluation nobody will use; the unevaluated step is not recorded
+                        stop_reason = "cancelled"
+                        break
+
+                    t0 = time.perf_counter()
+                    ensemble = None
+                    if step_samples > 1:
+                        loss, score, description, feedback, ensemble = evaluate_table_ensemble(
+                            evaluator_engine, evaluation_template, prompt_before_update, user_query_text,
+                            table_var, user_input_data, max_samples=step_samples, best_score=best["score"],
+                            prompt_layout=prompt_layout, evaluation_format=evaluation_format
+                        )
+                    else:
+                        loss, score, description, feedback = evaluate_table(
+                            evaluator_engine, evaluation_template, prompt_before_update, user_query_text,
+                            table_var, user_input_data, prompt_layout=prompt_layout,
+                            evaluation_format=evaluation_format
+                        )
+                    timings["evaluate_seconds"] = time.perf_counter() - t0
+
+                    history.append({
+                        "step": current_step, "prompt": prompt_before_update,
+                        "table": table_var.value, "score": score,
+                        "description": description, "feedback": feedback,
+                        "evaluation_raw": loss.value, "evaluation_samples": ensemble,
+                        "prescore": prescore, "score_check": score_check(loss.value),
+                        "evaluation": evaluation_record(loss)
+                    })
+
+                    if score is not None and (best["score"] is None or score > best["score"]):
+                        best.update(score=score, prompt=prompt_before_update, table=table_var.value,
+                                    description=description, feedback=feedback, step=current_step)
+                        _notify(status_callback, f"Step {current_step}: New best score {score}!")
+
+                    if score is not None and score >= target_score:
+                        _notify(status_callback, f"Target score reached at step {current_step}! Score: {score}.", "success")
+                        stop_reason = "target_score"
+                        break
+
+                    if score is not None:
+                        t0 = time.perf_counter()
+                        with metrics_phase("backward"), span("loss.backward"):
+                            loss.backward()
+                        gradients = _tgd_update(optimizer, system_prompt_var)
+                        timings["update_seconds"] = time.perf_counter() - t0
+                    else:
+                        _notify(status_callback, f"Step {current_step}: Invalid score parsed. Skipping optimizer update for this step.", "warning")
+
+                except Exception as e_opt:
+                    _notify(status_callback, f"Error in optimization step {current_step}: {e_opt}", "error")
+                    # Log the error in history
+                    history.append({
+                        "step": current_step, "prompt": system_prompt_var.value,
+                        "table": "Error during this step.", "score": None,
+                        "description": f"Error: {e_opt}", "feedback": "Optimization step failed.",
+                        "evaluation_raw": f"Error: {e_opt}"
+                    })
+                finally:
+                    if history and history[-1]["step"] == current_step:
+                        entry = history[-1]
+                        # Prompt tokens of every call in this step and how many were cache-eligible
+                        entry["prompt_cache"] = cache_usage
+                        # Retries, hedges and deadline failures of the step's LLM calls (call_policy.py)
+                        entry["calls"] = call_stats
+                        # Estimated tokens, LLM seconds and cost per phase and model (call_metrics.py)
+                        entry["metrics"] = step_metrics
+                        timings["total_seconds"] = time.perf_counter() - step_started
+                        entry["timings"] = {k: round(v, 3) for k, v in timings.items()}
+                        if controller is not None:
+                            controller.observe(entry)
+                            entry["convergence"] = dict(controller.state(), reduced_effort=reduced_effort)
+                        if journal is not None:
+                            journal.step(entry, timings=entry["timings"], best=best, tgd_state={
+                                "parameter_value": system_prompt_var.value, "gradients": gradients,
+                                "updated": gradients is not None, "constraints": optimizer.constraints,
+                            })
+                        if step_callback:
+                            step_callback(entry, best)
+
+    if stop_reason == "cancelled":
+        _notify(status_callback, f"Optimization cancelled; keeping the best result so far (step {best['step']}).", "warning")
+    run_metrics = merge_metrics([initial_metrics] + [entry.get("metrics") for entry in history])
+    convergence_summary = controller.summary(stop_reason) if controller is not None else None
+    if journal is not None:
+        journal.end(best, stop_reason=stop_reason, metrics=run_metrics, convergence=convergence_summary)
+
+    return {
+        "best_prompt": best["prompt"], "best_table": best["table"], "best_score": best["score"],
+        "best_description": best["description"], "best_feedback": best["feedback"],
+        "best_step": best["step"], "history": history,
+        "final_prompt": system_prompt_var.value, "system_prompt_var": system_prompt_var,
+        "stop_reason": stop_reason, "run_id": journal.run_id if journal is not None else None,
+        "metrics": run_metrics, "convergence": convergence_summary,
+    }
+
+
+def resume_optimization(journal_path, generator_engine, evaluator_engine, status_callback=None, progress_callback=None,
+                        step_callback=None, cancel_event=None):
+    """
+    Continues an interrupted journaled run with its original settings, appending to the same journal.
+    Returns:
+        dict: Same as run_optimization (history includes the steps completed before the interruption).
+    """
+    run = read_journal(journal_path)
+    if run["end"] is not None:
+        raise ValueError(f"Run {run['end']['run_id']} already finished; nothing to resume.")
+    state = resume_state(run)
+    settings = state["settings"]
+    if settings.get("mode") == "minibatch":
+        return run_minibatch_optimization(
+            settings["system_prompt_text"], settings["profiles"], generator_engine, evaluator_engine,
+            evaluation_template=settings["evaluation_template"], num_steps=settings["num_steps"],
+            target_score=settings["target_score"], batch_size=settings.get("batch_size"),
+            prompt_layout=settings.get("prompt_layout", "template"),
+            evaluation_format=settings.get("evaluation_format", "markdown"), status_callback=status_callback,
+            progress_callback=progress_callback, journal=RunJournal(run_id=state["run_id"], path=journal_path),
+            resume=state, step_callback=step_callback, cancel_event=cancel_event,
+            convergence=settings.get("convergence"),
+        )
+    if settings.get("mode") == "beam":
+        return run_beam_optimization(
+            settings["system_prompt_text"], settings["user_input_data"], generator_engine, evaluator_engine,
+            evaluation_template=settings["evaluation_template"], num_steps=settings["num_steps"],
+            target_score=settings["target_score"], beam_width=settings["beam_width"],
+            proposals_per_prompt=settings["proposals_per_prompt"], prompt_layout=settings.get("prompt_layout", "template"),
+            evaluation_format=settings.get("evaluation_format", "markdown"),
+            status_callback=status_callback, progress_callback=progress_callback,
+            journal=RunJournal(run_id=state["run_id"], path=journal_path), resume=state, step_callback=step_callback,
+            cancel_event=cancel_event, convergence=settings.get("convergence"),
+        )
+    return run_optimization(
+        settings["system_prompt_text"], settings["user_input_data"], generator_engine, evaluator_engine,
+        evaluation_template=settings["evaluation_template"], num_steps=settings["num_steps"],
+        target_score=settings["target_score"], status_callback=status_callback, progress_callback=progress_callback,
+        evaluator_samples=settings.get("evaluator_samples", 1), prescore_gate=settings.get("prescore_gate", False),
+        max_regenerations=settings.get("max_regenerations", 1), prompt_layout=settings.get("prompt_layout", "template"),
+        evaluation_format=settings.get("evaluation_format", "markdown"),
+        journal=RunJournal(run_id=state["run_id"], path=journal_path), resume=state,
+        step_callback=step_callback, cancel_event=cancel_event, convergence=settings.get("convergence"),
+    )
+
+
+def profile_batch(profiles, step, batch_size=None):
+    """
+    Profiles evaluated at a minibatch step (1-based): all of them, or consecutive windows of `batch_size`
+    that rotate through the list (wrapping around) so every profile is seen equally often.
+    """
+    if not batch_size or batch_size >= len(profiles):
+        return list(profiles)
+    start = ((step - 1) * batch_size) % len(profiles)
+    return [profiles[(start + i) % len(profiles)] for i in range(batch_size)]
+
+
+def _profile_label(profile, index):
+    return str(profile.get("id") or f"{index}_{profile.get('industry', '')}_{profile.get('region', '')}")
+
+
+async def _agenerate_and_evaluate(generator_engine, evaluator_engine, evaluation_template, system_prompt_var,
+                                  system_prompt_text, user_input_data, prompt_layout="template",
+                                  evaluation_format="markdown"):
+    user_query_text = format_user_query(user_input_data)
+    table_var = await agenerate_table(generator_engine, system_prompt_var, make_user_prompt_var(user_query_text))
+    loss, score, description, feedback = await aevaluate_table(
+        evaluator_engine, evaluation_template, system_prompt_text, user_query_text, table_var, user_input_data,
+        prompt_layout=prompt_layout, evaluation_format=evaluation_format
+    )
+    return table_var, loss, score, description, feedback
+
+
+def _backward(loss):
+    with metrics_phase("backward"), span("loss.backward"):
+        loss.backward()
+
+
+def run_minibatch_optimization(system_prompt_text, profiles, generator_engine, evaluator_engine,
+                               evaluation_template=EVALUATION_PROMPT_TEMPLATE, num_steps=3, target_score=90,
+                               batch_size=None, prompt_layout="template", evaluation_format="markdown",
+                               status_callback=None, progress_callback=None, journal=None, resume=None, step_callback=None, cancel_event=None, convergence=None):
+    """
+    Optimizes one system prompt for several user input profiles at once (e.g. a whole vertical).
+    Each step generates and evaluates a table for every profile of the step's minibatch concurrently
+    (shared engine pool), backpropagates every profile's loss into the system prompt and applies all
+    the resulting gradients in a single TGD update. A step's score is the mean score of its batch, with
+    profiles that failed or could not be scored counting as 0, and the best prompt is the one with the
+    highest mean batch score. Only fully scored batches can become the best or reach `target_score`.
+    Args:
+        profiles (list): User input profile dicts (an 'id' key is used as the profile's label).
+        batch_size (int, optional): Profiles per step. Default (or >= len(profiles)): all profiles every
+            step, so step scores are directly comparable. Smaller batches rotate through the profiles
+            (see profile_batch); their means then cover different profiles from step to step.
+        Other arguments as in run_optimization. There is no separate initial evaluation: step 1 scores
+        the starting prompt. Evaluator ensembles and the pre-score gate are not used in this mode, so
+        `convergence` only stops the run early (the batch itself is not shrunk: its mean must stay comparable).
+    Returns:
+        dict: Same keys as run_optimization (best_table is the table of the batch's first profile; each
+              history entry lists every profile's score, table and feedback under 'batch').
+    """
+    if not profiles:
+        raise ValueError("Minibatch optimization needs at least one profile.")
+    labels = [_profile_label(profile, i) for i, profile in enumerate(profiles)]
+
+    if resume is not None:
+        system_prompt_text = resume["system_prompt_text"]
+        best = dict(resume["best"])
+        history = list(resume["history"])
+        first_step = resume["next_step"]
+        _notify(status_callback, f"Resuming minibatch run {resume['run_id']} from step {first_step}.")
+    else:
+        best = {"score": None, "prompt": system_prompt_text, "table": "", "description": "", "feedback": "", "step": 0}
+        history = []
+        first_step = 1
+        if journal is not None:
+            journal.start({
+                "mode": "minibatch", "system_prompt_text": system_prompt_text, "profiles": profiles,
+                "evaluation_template": evaluation_template, "num_steps": num_steps, "target_score": target_score,
+                "batch_size": batch_size, "prompt_layout": prompt_layout, "evaluation_format": evaluation_format,
+                "convergence": convergence,
+                "generator_model": getattr(generator_engine, "model_string", str(generator_engine)),
+                "evaluator_model": getattr(evaluator_engine, "model_string", str(evaluator_engine)),
+            }, dict(best))
+
+    system_prompt_var = tg.Variable(system_prompt_text, requires_grad=True,
+                                    role_description="System prompt being optimized by TextGrad")
+    optimizer = tg.TGD(parameters=[system_prompt_var])
+    backward_engine = current_backward_engine()
+    stop_reason = "max_steps"
+    controller = ConvergenceController.from_settings(convergence)
+    if controller is not None:
+        controller.start(None, history)
+
+    with pinned_backward_engine(backward_engine), span("minibatch_optimization_loop", num_steps=num_steps):
+        for current_step in range(first_step, num_steps + 1):
+            if cancel_event is not None and cancel_event.is_set():
+                stop_reason = "cancelled"
+                break
+            early_stop = controller.check() if controller is not None else None
+            if early_stop:
+                _notify(status_callback, f"Stopping before step {current_step}: {describe_stop_reason(early_stop)}.", "warning")
+                stop_reason = early_stop
+                break
+            if progress_callback:
+                progress_callback(current_step, num_steps)
+            batch = profile_batch(list(zip(labels, profiles)), current_step, batch_size)
+            _notify(status_callback, f"Step {current_step}/{num_steps}: generating and evaluating {len(batch)} profiles...")
+
+            step_started = time.perf_counter()
+            timings = {}
+            gradients = None
+            with (span("optimization_step", step=current_step, batch_size=len(batch)), prompt_cache_usage() as cache_usage,
+                  call_telemetry() as call_stats, usage_metrics() as step_metrics):
+                try:
+                    prompt_before_update = system_prompt_var.value
+                    t0 = time.perf_counter()
+                    results = run_async(gather_calls(*[
+                        _agenerate_and_evaluate(generator_engine, evaluator_engine, evaluation_template,
+                                                system_prompt_var, prompt_before_update, profile,
+                                                prompt_layout=prompt_layout, evaluation_format=evaluation_format)
+                        for _, profile in batch
+                    ], return_exceptions=True))
+                    timings["generate_evaluate_seconds"] = time.perf_counter() - t0
+
+                    batch_results = []
+                    for (label, _), result in zip(batch, results):
+                        if isinstance(result, Exception):
+                            _notify(status_callback, f"Step {current_step}: profile '{label}' failed: {result}", "warning")
+                            batch_results.append({"id": label, "score": None, "table": "", "description": f"Error: {result}",
+                                                  "feedback": "", "loss": None})
+                        else:
+                            table_var, loss, score, description, feedback = result
+                            batch_results.append({"id": label, "score": score, "table": table_var.value,
+                                                  "description": description, "feedback": feedback,
+                                                  "score_check": score_check(loss.value),
+                                                  "evaluation": evaluation_record(loss), "loss": loss})
+                    if all(r["loss"] is None for r in batch_results):
+                        raise RuntimeError(f"All {len(batch_results)} profiles of the batch failed.")
+
+                    if cancel_event is not None and cancel_event.is_set():
+                        stop_reason = "cancelled"
+                        break
+
+                    scores = [r["score"] for r in batch_results if r["score"] is not None]
+                    # Over the whole batch, so a step where profiles failed is not compared on its best profiles
+                    complete = len(scores) == len(batch_results)
+                    mean_score = round(sum(scores) / len(batch_results), 1) if scores else None
+                    history.append({
+                        "step": current_step, "prompt": prompt_before_update,
+                        "table": batch_results[0]["table"], "score": mean_score, "batch_complete": complete,
+                        "description": f"Mean score {mean_score} over {len(scores)}/{len(batch_results)} profiles"
+                                       + ("" if complete else " (unscored profiles count as 0)") + ": "
+                                       + ", ".join(f"{r['id']} {r['score']}" for r in batch_results),
+                        "feedback": "\n\n".join(f"### {r['id']} ({r['score']})\n{r['feedback']}" for r in batch_results),
+                        "evaluation_raw": "\n\n".join(f"### {r['id']}\n{r['loss'].value}"
+                                                       for r in batch_results if r["loss"] is not None),
+                        "batch": [{k: v for k, v in r.items() if k != "loss"} for r in batch_results],
+                    })
+
+                    if not complete:
+                        _notify(status_callback, f"Step {current_step}: Only {len(scores)}/{len(batch_results)} profiles "
+                                                 f"were scored; the step cannot become the best or reach the target.", "warning")
+                    elif mean_score is not None and (best["score"] is None or mean_score > best["score"]):
+                        best.update(score=mean_score, prompt=prompt_before_update, table=batch_results[0]["table"],
+                                    description=history[-1]["description"], feedback=history[-1]["feedback"],
+                                    step=current_step)
+                        _notify(status_callback, f"Step {current_step}: New best mean batch score {mean_score}!")
+
+                    if complete and mean_score is not None and mean_score >= target_score:
+                        _notify(status_callback, f"Target score reached at step {current_step}! Mean score: {mean_score}.", "success")
+                        stop_reason = "target_score"
+                        break
+
+                    losses = [r["loss"] for r in batch_results if r["loss"] is not None and r["score"] is not None]
+                    if losses:
+                        # Equivalent to tg.sum(losses).backward() (the sum passes an empty gradient to every loss),
+                        # but the per-profile backward calls run concurrently instead of one after another
+                        t0 = time.perf_counter()
+                        run_async(gather_calls(*[run_in_engine_pool(_backward, loss) for loss in losses]))
+                        timings["backward_seconds"] = time.perf_counter() - t0
+                        t0 = time.perf_counter()
+                        # One TGD update from the gradients of all profiles
+                        gradients = _tgd_update(optimizer, system_prompt_var)
+                        timings["update_seconds"] = time.perf_counter() - t0
+                    else:
+                        _notify(status_callback, f"Step {current_step}: No valid scores in the batch. Skipping optimizer update.", "warning")
+
+                except Exception as e_opt:
+                    _notify(status_callback, f"Error in optimization step {current_step}: {e_opt}", "error")
+                    history.append({
+                        "step": current_step, "prompt": system_prompt_var.value,
+                        "table": "Error during this step.", "score": None,
+                        "description": f"Error: {e_opt}", "feedback": "Optimization step failed.",
+                        "evaluation_raw": f"Error: {e_opt}"
+                    })
+                finally:
+                    if history and history[-1]["step"] == current_step:
+                        entry = history[-1]
+                        entry["prompt_cache"] = cache_usage
+                        entry["calls"] = call_stats
+                        entry["metrics"] = step_metrics
+                        timings["total_seconds"] = time.perf_counter() - step_started
+                        entry["timings"] = {k: round(v, 3) for k, v in timings.items()}
+                        if controller is not None:
+                            controller.observe(entry)
+                            entry["convergence"] = controller.state()
+                        if journal is not None:
+                            journal.step(entry, timings=entry["timings"], best=best, tgd_state={
+                                "parameter_value": system_prompt_var.value, "gradients": gradients,
+                                "updated": gradients is not None, "constraints": optimizer.constraints,
+                            })
+                        if step_callback:
+                            step_callback(entry, best)
+
+    if stop_reason == "cancelled":
+        _notify(status_callback, f"Optimization cancelled; keeping the best result so far (step {best['step']}).", "warning")
+    run_metrics = merge_metrics([entry.get("metrics") for entry in history])
+    convergence_summary = controller.summary(stop_reason) if controller is not None else None
+    if journal is not None:
+        journal.end(best, stop_reason=stop_reason, metrics=run_metrics, convergence=convergence_summary)
+
+    return {
+        "best_prompt": best["prompt"], "best_table": best["table"], "best_score": best["score"],
+        "best_description": best["description"], "best_feedback": best["feedback"],
+        "best_step": best["step"], "history": history,
+        "final_prompt": system_prompt_var.value, "system_prompt_var": system_prompt_var,
+        "stop_reason": stop_reason, "run_id": journal.run_id if journal is not None else None,
+        "metrics": run_metrics, "convergence": convergence_summary, "profiles": labels,
+    }
+
+
+def _beam_candidate(candidate_id, parent_id, step, prompt, proposal=None):
+    return {"id": candidate_id, "parent": parent_id, "step": step, "proposal": proposal, "prompt": prompt,
+            "score": None, "table": "", "description": "", "feedback": "", "evaluation_raw": "", "kept": False}
+
+
+def _evaluate_beam_candidates(candidates, generator_engine, evaluator_engine, evaluation_template, user_input_data,
+                              prompt_layout="template", evaluation_format="markdown"):
+    """
+    Generates and evaluates every candidate prompt concurrently and fills in its results.
+    Returns:
+        dict: candidate ID -> (prompt variable, loss) for the candidates that got a score (their graphs
+              are needed for the backward pass of the next step).
+    """
+    prompt_vars = [tg.Variable(c["prompt"], requires_grad=True, role_description="System prompt being optimized by TextGrad")
+                   for c in candidates]
+    results = run_async(gather_calls(*[
+        _agenerate_and_evaluate(generator_engine, evaluator_engine, evaluation_template, prompt_var, c["prompt"],
+                                user_input_data, prompt_layout=prompt_layout,
+                                evaluation_format=evaluation_format)
+        for c, prompt_var in zip(candidates, prompt_vars)
+    ], return_exceptions=True))
+    graphs = {}
+    for candidate, prompt_var, result in zip(candidates, prompt_vars, results):
+        if isinstance(result, Exception):
+            candidate["description"] = f"Error: {result}"
+            continue
+        table_var, loss, score, description, feedback = result
+        candidate.update(table=table_var.value, score=score, description=description, feedback=feedback,
+                         evaluation_raw=loss.value, score_check=score_check(loss.value),
+                         evaluation=evaluation_record(loss))
+        if score is not None:
+            graphs[candidate["id"]] = (prompt_var, loss)
+    return graphs
+
+
+def _tgd_proposal(prompt_var, constraints):
+    """One TGD rewrite of a prompt from its gradients, on a copy (the beam member itself is not changed)."""
+    proposal = tg.Variable(prompt_var.value, requires_grad=True, role_description=prompt_var.get_role_description())
+    proposal.gradients = set(prompt_var.gradients)
+    proposal.gradients_context.update(prompt_var.gradients_context)
+    with metrics_phase("optimizer"), span("optimizer.step"):
+        tg.TGD(parameters=[proposal], constraints=constraints).step()
+    return proposal.value
+
+
+def beam_lineage(history, candidate_id=None):
+    """
+    Ancestry of a beam candidate, from the starting prompt to the candidate.
+    Args:
+        history (list): History of a beam run (entries with 'beam').
+        candidate_id (str, optional): Defaults to the best candidate of the whole run.
+    Returns:
+        list: Candidate dicts (id, parent, step, score, prompt, ...), oldest first.
+    """
+    candidates = {c["id"]: c for entry in history for c in entry.get("beam", [])}
+    if candidate_id is None:
+        scored = [c for c in candidates.values() if c["score"] is not None]
+        if not scored:
+            return []
+        candidate_id = max(scored, key=lambda c: c["score"])["id"]
+    lineage = []
+    while candidate_id is not None and candidate_id in candidates:
+        lineage.append(candidates[candidate_id])
+        candidate_id = candidates[candidate_id]["parent"]
+    return list(reversed(lineage))
+
+
+def run_beam_optimization(system_prompt_text, user_input_data, generator_engine, evaluator_engine,
+                          evaluation_template=EVALUATION_PROMPT_TEMPLATE, num_steps=3, target_score=90,
+                          beam_width=2, proposals_per_prompt=2, prompt_layout="template", evaluation_format="markdown",
+                          status_callback=None, progress_callback=None, journal=None, resume=None, step_callback=None,
+                          cancel_event=None, convergence=None):
+    """
+    Beam search over system prompts for one user input profile.
+    Instead of following a single optimizer.step() path, the run keeps the `beam_width` best prompts.
+    Each step backpropagates every beam prompt's evaluation, asks TGD for `proposals_per_prompt`
+    rewrites of each (different proposals use different BEAM_PROPOSAL_CONSTRAINTS), generates and
+    evaluates all new candidates concurrently on the shared engine pool, and prunes the beam back
+    to `beam_width` by score among the old beam and the new candidates. A bad update therefore
+    only costs one candidate, not the run.
+    Args:
+        beam_width (int): Prompts kept between steps.
+        proposals_per_prompt (int): TGD proposals per beam prompt and step.
+        Other arguments as in run_optimization. The starting prompt is always evaluated here (its
+        evaluation graph is needed for the first backward pass); evaluator ensembles and the
+        pre-score gate are not used in this mode. A resumed run re-evaluates its last beam first.
+    Returns:
+        dict: Same keys as run_optimization. Each history entry describes the step's best new candidate
+              and lists every candidate of the step under 'beam' (id, parent, proposal, prompt, score,
+              table, feedback, kept); see beam_lineage().
+    """
+    user_query_text = format_user_query(user_input_data)
+    controller = ConvergenceController.from_settings(convergence)
+    initial_metrics = None
+
+    if resume is not None:
+        best = dict(resume["best"])
+        history = list(resume["history"])
+        first_step = resume["next_step"]
+        initial_result = resume["initial_result"]
+        last_beam = [c for c in history[-1]["beam"] if c["kept"]] if history and history[-1].get("beam") else []
+        beam = [_beam_candidate(c["id"], c["parent"], c["step"], c["prompt"], c["proposal"]) for c in last_beam] or \
+               [_beam_candidate("0.0", None, 0, resume["system_prompt_text"])]
+        _notify(status_callback, f"Resuming beam run {resume['run_id']} from step {first_step}: "
+                                 f"re-evaluating its {len(beam)} beam prompts.")
+        with span("initial_evaluation"):
+            graphs = _evaluate_beam_candidates(beam, generator_engine, evaluator_engine, evaluation_template,
+                                               user_input_data, prompt_layout=prompt_layout,
+                                               evaluation_format=evaluation_format)
+    else:
+        beam = [_beam_candidate("0.0", None, 0, system_prompt_text)]
+        with usage_metrics() as initial_metrics, span("initial_evaluation"):
+            graphs = _evaluate_beam_candidates(beam, generator_engine, evaluator_engine, evaluation_template,
+                                               user_input_data, prompt_layout=prompt_layout,
+                                               evaluation_format=evaluation_format)
+        start = beam[0]
+        initial_result = {"prompt": system_prompt_text, "table": start["table"], "score": start["score"],
+                          "description": start["description"], "feedback": start["feedback"]}
+        _notify(status_callback, f"Initial evaluation score: {start['score']}")
+        best = dict(initial_result, step=0)
+        history = []
+        first_step = 1
+        if journal is not None:
+            journal.start({
+                "mode": "beam", "system_prompt_text": system_prompt_text, "user_input_data": user_input_data,
+                "evaluation_template": evaluation_template, "num_steps": num_steps, "target_score": target_score,
+                "beam_width": beam_width, "proposals_per_prompt": proposals_per_prompt, "prompt_layout": prompt_layout,
+                "evaluation_format": evaluation_format, "convergence": convergence,
+                "generator_model": getattr(generator_engine, "model_string", str(generator_engine)),
+                "evaluator_model": getattr(evaluator_engine, "model_string", str(evaluator_engine)),
+            }, initial_result)
+    beam = [c for c in beam if c["id"] in graphs]
+    if not beam:
+        raise RuntimeError("No prompt of the beam could be evaluated.")
+    for candidate in beam:
+        candidate["kept"] = True
+    seen_prompts = {c["prompt"] for c in beam} | {c["prompt"] for entry in history for c in entry.get("beam", [])}
+
+    backward_engine = current_backward_engine()
+    stop_reason = "max_steps"
+    if controller is not None:
+        controller.start(initial_result.get("score"), history, initial_metrics)
+
+    with pinned_backward_engine(backward_engine), span("beam_optimization_loop", num_steps=num_steps, beam_width=beam_width):
+        for current_step in range(first_step, num_steps + 1):
+            if cancel_event is not None and cancel_event.is_set():
+                stop_reason = "cancelled"
+                break
+            early_stop = controller.check() if controller is not None else None
+            if early_stop:
+                _notify(status_callback, f"Stopping before step {current_step}: {describe_stop_reason(early_stop)}.", "warning")
+                stop_reason = early_stop
+                break
+            if progress_callback:
+                progress_callback(current_step, num_steps)
+            _notify(status_callback, f"Step {current_step}/{num_steps}: expanding {len(beam)} beam prompts "
+                                     f"into {len(beam) * proposals_per_prompt} candidates...")
+
+            step_started = time.perf_counter()
+            timings = {}
+            gradients = {}
+            with (span("optimization_step", step=current_step, beam=len(beam)), prompt_cache_usage() as cache_usage,
+                  call_telemetry() as call_stats, usage_metrics() as step_metrics):
+                try:
+                    # Backward once per beam prompt; members kept from earlier steps already have their gradients
+                    t0 = time.perf_counter()
+                    pending = [graphs[c["id"]][1] for c in beam if not graphs[c["id"]][0].gradients]
+                    run_async(gather_calls(*[run_in_engine_pool(_backward, loss) for loss in pending]))
+                    timings["backward_seconds"] = time.perf_counter() - t0
+
+                    t0 = time.perf_counter()
+                    expansions = [(parent, k) for parent in beam for k in range(proposals_per_prompt)]
+                    proposals = run_async(gather_calls(*[
+                        run_in_engine_pool(_tgd_proposal, graphs[parent["id"]][0],
+                                           [c for c in [BEAM_PROPOSAL_CONSTRAINTS[k % len(BEAM_PROPOSAL_CONSTRAINTS)]] if c])
+                        for parent, k in expansions
+                    ], return_exceptions=True))
+                    timings["propose_seconds"] = time.perf_counter() - t0
+                    gradients = {c["id"]: [g.value for g in graphs[c["id"]][0].gradients] for c in beam}
+
+                    candidates = []
+                    for (parent, k), proposal in zip(expansions, proposals):
+                        if isinstance(proposal, Exception):
+                            _notify(status_callback, f"Step {current_step}: proposal {k} for {parent['id']} failed: {proposal}", "warning")
+                        elif proposal not in seen_prompts:  # A prompt is evaluated once per run
+                            seen_prompts.add(proposal)
+                            candidates.append(_beam_candidate(f"{current_step}.{len(candidates)}", parent["id"],
+                                                              current_step, proposal, proposal=k))
+                    if not candidates:
+                        raise RuntimeError("No new candidate prompts were proposed.")
+
+                    if cancel_event is not None and cancel_event.is_set():
+                        stop_reason = "cancelled"
+                        break
+
+                    t0 = time.perf_counter()
+                    graphs.update(_evaluate_beam_candidates(candidates, generator_engine, evaluator_engine,
+                                                            evaluation_template, user_input_data,
+                                                            prompt_layout=prompt_layout,
+                                                            evaluation_format=evaluation_format))
+                    timings["generate_evaluate_seconds"] = time.perf_counter() - t0
+
+                    # Prune: new candidates first, so they win ties against their parents
+                    parents = beam
+                    pool = [c for c in candidates + parents if c["id"] in graphs]
+                    beam = sorted(pool, key=lambda c: c["score"], reverse=True)[:beam_width]
+                    kept_ids = {c["id"] for c in beam}
+                    for candidate in candidates + parents:
+                        candidate["kept"] = candidate["id"] in kept_ids
+                    graphs = {candidate_id: graphs[candidate_id] for candidate_id in kept_ids}
+
+                    scored = [c for c in candidates if c["score"] is not None]
+                    step_best = max(scored, key=lambda c: c["score"]) if scored else candidates[0]
+                    history.append({
+                        "step": current_step, "prompt": step_best["prompt"], "table": step_best["table"],
+                        "score": step_best["score"], "description": step_best["description"],
+                        "feedback": step_best["feedback"], "evaluation_raw": step_best["evaluation_raw"],
+                        "candidate": step_best["id"], "score_check": step_best.get("score_check"),
+                        "evaluation": step_best.get("evaluation"),
+                        # The step's new candidates plus the beam they were expanded from (their parents)
+                        "beam": [dict(c) for c in candidates] + [dict(c, carried=True) for c in parents],
+                    })
+                    _notify(status_callback, f"Step {current_step}: candidate scores "
+                                             + ", ".join(f"{c['id']} {c['score']}" for c in candidates)
+                                             + f"; beam is now {', '.join(c['id'] for c in beam)}.")
+
+                    if step_best["score"] is not None and (best["score"] is None or step_best["score"] > best["score"]):
+                        best.update(score=step_best["score"], prompt=step_best["prompt"], table=step_best["table"],
+                                    description=step_best["description"], feedback=step_best["feedback"],
+                                    step=current_step)
+                        _notify(status_callback, f"Step {current_step}: New best score {step_best['score']} "
+                                                 f"(candidate {step_best['id']})!")
+
+                    if best["score"] is not None and best["score"] >= target_score:
+                        _notify(status_callback, f"Target score reached at step {current_step}! Score: {best['score']}.", "success")
+                        stop_reason = "target_score"
+                        break
+
+                except Exception as e_opt:
+                    _notify(status_callback, f"Error in optimization step {current_step}: {e_opt}", "error")
+                    history.append({
+                        "step": current_step, "prompt": beam[0]["prompt"],
+                        "table": "Error during this step.", "score": None,
+                        "description": f"Error: {e_opt}", "feedback": "Optimization step failed.",
+                        "evaluation_raw": f"Error: {e_opt}",
+                        "beam": [dict(c, carried=True) for c in beam],
+                    })
+                finally:
+                    if history and history[-1]["step"] == current_step:
+                        entry = history[-1]
+                        entry["prompt_cache"] = cache_usage
+                        entry["calls"] = call_stats
+                        entry["metrics"] = step_metrics
+                        timings["total_seconds"] = time.perf_counter() - step_started
+                        entry["timings"] = {k: round(v, 3) for k, v in timings.items()}
+                        if controller is not None:
+                            controller.observe(entry)
+                            entry["convergence"] = controller.state()
+                        if journal is not None:
+                            journal.step(entry, timings=entry["timings"], best=best, tgd_state={
+                                "beam": [c["id"] for c in beam], "gradients": gradients,
+                                "updated": bool(gradients), "constraints": BEAM_PROPOSAL_CONSTRAINTS,
+                            })
+                        if step_callback:
+                            step_callback(entry, best)
+
+    if stop_reason == "cancelled":
+        _notify(status_callback, f"Optimization cancelled; keeping the best result so far (step {best['step']}).", "warning")
+    run_metrics = merge_metrics([initial_metrics] + [entry.get("metrics") for entry in history])
+    convergence_summary = controller.summary(stop_reason) if controller is not None else None
+    if journal is not None:
+        journal.end(best, stop_reason=stop_reason, metrics=run_metrics, convergence=convergence_summary)
+
+    final_var = graphs[beam[0]["id"]][0] if beam and beam[0]["id"] in graphs else tg.Variable(
+        best["prompt"], requires_grad=True, role_description="System prompt being optimized by TextGrad")
+    return {
+        "best_prompt": best["prompt"], "best_table": best["table"], "best_score": best["score"],
+        "best_description": best["description"], "best_feedback": best["feedback"],
+        "best_step": best["step"], "history": history,
+        "final_prompt": beam[0]["prompt"], "system_prompt_var": final_var,
+        "stop_reason": stop_reason, "run_id": journal.run_id if journal is not None else None,
+        "metrics": run_metrics, "convergence": convergence_summary,
+    }
@@ -0,0 +1,143 @@
+"""
+Prefix-stable evaluation prompt layout and a local stand-in for provider prompt caching.
+
+Providers (Gemini implicit caching, OpenAI, Anthropic) discount/accelerate the part of a request
+that repeats a recently seen prefix byte for byte. The default evaluation template puts the
+per-step parts (system prompt under evaluation, generated table) in the middle of the static
+rubric, so almost nothing is reusable between steps. prefix_stable_template() moves every section
+that holds a per-step placeholder to the end, keeping the rubric, the user query and the external
+data as an identical prefix across steps.
+
+PrefixCacheEngine does not change any call: it replays the provider's behaviour locally (block-hashed
+prefixes, minimum cacheable length, expiry) to report how many prompt tokens per call/step were
+cache-eligible.
+"""
+import contextvars
+import hashlib
+import re
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import lru_cache
+
+from config import PROMPT_CACHE_MIN_TOKENS, PROMPT_CACHE_BLOCK_TOKENS, PROMPT_CACHE_TTL_SECONDS
+from engine_wrappers import EngineWrapper
+from utils import estimate_tokens
+
+PROMPT_LAYOUTS = ["template", "prefix_stable"]
+# Placeholders that change every optimization step
+PER_STEP_PLACEHOLDERS = ["{system_prompt_text}", "{generated_table_text}"]
+MAX_CACHED_BLOCKS = 200000  # Bounded LRU of block hashes (a few tens of MB), shared by all engines in the process
+
+_SECTION_RE = re.compile(r"^(?=#{1,2} )", re.MULTILINE)
+
+
+@lru_cache(maxsize=16)
+def prefix_stable_template(evaluation_template):
+    """
+    Reorders an evaluation template so sections with per-step placeholders come last.
+    Sections are split at '# ' / '## ' headings. Templates without such sections are returned unchanged.
+    """
+    sections = _SECTION_RE.split(evaluation_template)
+    per_step = [s for s in sections if any(p in s for p in PER_STEP_PLACEHOLDERS)]
+    if not per_step:
+        return evaluation_template
+    static = [s for s in sections if s not in per_step]
+    tail = ("# --- INPUTS THAT CHANGE EVERY STEP (referenced above) ---\n\n"
+            + "".join(s.rstrip("\n") + "\n\n" for s in per_step))
+    return "".join(static).rstrip("\n") + "\n\n" + tail
+
+
+class PrefixCache:
+    """
+    Simulated provider prefix cache: prompts are cut into fixed-size blocks whose hashes chain
+    over everything before them; a call is cache-eligible up to the last leading block seen recently.
+    """
+
+    def __init__(self, block_tokens=PROMPT_CACHE_BLOCK_TOKENS, min_tokens=PROMPT_CACHE_MIN_TOKENS,
+                 ttl_seconds=PROMPT_CACHE_TTL_SECONDS, max_blocks=MAX_CACHED_BLOCKS):
+        self.block_chars = block_tokens * 4  # Same ~4 chars/token estimate as utils.estimate_tokens
+        self.min_tokens = min_tokens
+        self.ttl_seconds = ttl_seconds
+        self.max_blocks = max_blocks
+        self._blocks = OrderedDict()  # chained block hash -> last used
+        self._lock = threading.Lock()
+
+    def lookup_and_insert(self, scope, text):
+        """
+        Returns (prompt_tokens, cached_tokens) for a prompt and records its blocks.
+        Args:
+            scope (str): Cache namespace (providers cache per model).
+            text (str): The full prompt as sent (system prompt first).
+        """
+        now = time.time()
+        digest = hashlib.sha256(scope.encode("utf-8"))
+        cached_blocks = 0
+        still_prefix = True
+        with self._lock:
+            for start in range(0, len(text) - self.block_chars + 1, self.block_chars):
+                digest.update(text[start:start + self.block_chars].encode("utf-8"))
+                key = digest.hexdigest()
+                last_used = self._blocks.get(key)
+                if still_prefix and last_used is not None and now - last_used <= self.ttl_seconds:
+                    cached_blocks += 1
+                else:
+                    still_prefix = False
+                self._blocks[key] = now
+                self._blocks.move_to_end(key)
+            while len(self._blocks) > self.max_blocks:
+                self._blocks.popitem(last=False)
+        cached_tokens = estimate_tokens(text[:cached_blocks * self.block_chars])
+        if cached_tokens < self.min_tokens:
+            cached_tokens = 0
+        return estimate_tokens(text), cached_tokens
+
+
+_prefix_cache = PrefixCache()
+# Usage accumulator of the current optimization step / run (see prompt_cache_usage)
+_usage = contextvars.ContextVar("prompt_cache_usage", default=None)
+_usage_lock = threading.Lock()
+
+
+def new_usage():
+    return {"calls": 0, "prompt_tokens": 0, "cached_tokens": 0}
+
+
+@contextmanager
+def prompt_cache_usage():
+    """
+    Collects prompt/cache-eligible token counts of every call made in this context (including calls
+    run on the shared engine pool). Yields the usage dict, which is filled in as calls complete.
+    """
+    usage = new_usage()
+    token = _usage.set(usage)
+    try:
+        yield usage
+    finally:
+        _usage.reset(token)
+
+
+def cache_eligible_pct(usage):
+    return round(100.0 * usage["cached_tokens"] / usage["prompt_tokens"], 1) if usage and usage["prompt_tokens"] else 0.0
+
+
+class PrefixCacheEngine(EngineWrapper):
+    """Engine wrapper that reports, per call, how much of the prompt a provider prefix cache could reuse."""
+
+    def __init__(self, engine, prefix_cache=None):
+        super().__init__(engine)
+        self.prefix_cache = prefix_cache or _prefix_cache
+        self.totals = new_usage()
+
+    def generate(self, prompt, system_prompt=None, **kwargs):
+        if isinstance(prompt, str):
+            text = (system_prompt or self.system_prompt or "") + "\n" + prompt
+            prompt_tokens, cached_tokens = self.prefix_cache.lookup_and_insert(self.model_string, text)
+            with _usage_lock:
+                for usage in (self.totals, _usage.get()):
+                    if usage is not None:
+                        usage["calls"] += 1
+                        usage["prompt_tokens"] += prompt_tokens
+                        usage["cached_tokens"] += cached_tokens
+        return self.engine(prompt, system_prompt=system_prompt, **kwargs)
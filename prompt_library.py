@@ -0,0 +1,272 @@
+"""
+Persistent metadata index for the saved prompt library.
+
+Listing the library used to stat every file (and loading parsed the '# ...' headers each time).
+The index (saved_prompts/.index/index.json) keeps, per file: prompt name, score, context inputs, saved time,
+size, mtime and content hash. It is updated incrementally when a prompt is saved and revalidated with a
+single stat of the directory: only when the directory changed (files added, removed or replaced) are the
+files rescanned, and only files whose size/mtime changed are re-parsed.
+
+rank_prompts_for_context() uses the index to pick a warm-start prompt for a new profile.
+"""
+import hashlib
+import json
+import math
+import os
+import re
+import threading
+from collections import Counter
+
+# Kept in a subdirectory: writing it then does not change the library directory's own mtime
+INDEX_DIRNAME = ".index"
+INDEX_FILENAME = "index.json"
+INDEX_VERSION = 1
+PROMPT_MARKER = "# --- BEGIN PROMPT ---"
+
+_HEADER_FIELDS = {
+    "# Prompt Name:": "name",
+    "# Associated Score:": "score",
+    "# Context Inputs:": "context_inputs",
+    "# Saved At:": "saved_at",
+}
+
+_lock = threading.Lock()
+_indexes = {}  # library dir -> loaded index (shared by all sessions in the process)
+
+
+def parse_prompt_file(text):
+    """
+    Splits a saved prompt file into its header metadata and the prompt body.
+    Files without the BEGIN PROMPT marker are treated as a bare prompt.
+    Returns:
+        tuple: (metadata dict, prompt text)
+    """
+    header, marker, body = text.partition(PROMPT_MARKER + "\n")
+    if not marker:
+        header, marker, body = text.partition(PROMPT_MARKER)
+    if not marker:
+        return {}, text
+    metadata = {}
+    for line in header.splitlines():
+        for prefix, field in _HEADER_FIELDS.items():
+            if line.startswith(prefix):
+                value = line[len(prefix):].strip()
+                if field == "score":
+                    try:
+                        value = int(float(value))
+                    except ValueError:
+                        value = None
+                elif field == "context_inputs":
+                    try:
+                        value = json.loads(value)
+                    except json.JSONDecodeError:
+                        value = {}
+                metadata[field] = value
+    return metadata, body
+
+
+def _build_entry(library_dir, filename, stat):
+    with open(os.path.join(library_dir, filename), "r", encoding="utf-8") as f:
+        text = f.read()
+    metadata, body = parse_prompt_file(text)
+    return {
+        "filename": filename, "name": metadata.get("name") or filename[:-4],
+        "score": metadata.get("score"), "context_inputs": metadata.get("context_inputs") or {},
+        "saved_at": metadata.get("saved_at"), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns,
+        "sha256": hashlib.sha256(body.encode("utf-8")).hexdigest(), "prompt_chars": len(body),
+    }
+
+
+def _index_path(library_dir):
+    return os.path.join(library_dir, INDEX_DIRNAME, INDEX_FILENAME)
+
+
+def _write_index(library_dir, index):
+    os.makedirs(os.path.dirname(_index_path(library_dir)), exist_ok=True)
+    tmp_path = _index_path(library_dir) + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(index, f)
+    os.replace(tmp_path, _index_path(library_dir))
+
+
+def _read_index(library_dir):
+    try:
+        with open(_index_path(library_dir), "r", encoding="utf-8") as f:
+            index = json.load(f)
+        if index.get("version") == INDEX_VERSION:
+            return index
+    except (OSError, json.JSONDecodeError):
+        pass
+    return {"version": INDEX_VERSION, "dir_mtime_ns": None, "entries": {}}
+
+
+def _rescan(library_dir, index):
+    entries = {}
+    for filename in os.listdir(library_dir):
+        if not filename.endswith(".txt"):
+            continue
+        try:
+            stat = os.stat(os.path.join(library_dir, filename))
+            entry = index["entries"].get(filename)
+            if not entry or entry["mtime_ns"] != stat.st_mtime_ns or entry["size"] != stat.st_size:
+                entry = _build_entry(library_dir, filename, stat)
+            entries[filename] = entry
+        except OSError as e:
+            print(f"Error indexing saved prompt '{filename}': {e}")
+    index["entries"] = entries
+
+
+def get_library_index(library_dir):
+    """
+    Returns the (validated) index entries {filename: metadata}.
+    Costs one stat of the directory when nothing changed since the last call.
+    """
+    with _lock:
+        os.makedirs(os.path.join(library_dir, INDEX_DIRNAME), exist_ok=True)
+        index = _indexes.get(library_dir) or _read_index(library_dir)
+        dir_mtime_ns = os.stat(library_dir).st_mtime_ns
+        if index["dir_mtime_ns"] != dir_mtime_ns:
+            _rescan(library_dir, index)
+            index["dir_mtime_ns"] = dir_mtime_ns
+            _write_index(library_dir, index)
+        _indexes[library_dir] = index
+        return index["entries"]
+
+
+def record_saved_prompt(library_dir, filename):
+    """
+    Updates the index entry of a just-saved prompt file (incremental update, no rescan).
+    Call get_library_index() before writing the file so the index is known to be current.
+    """
+    with _lock:
+        index = _indexes.get(library_dir) or _read_index(library_dir)
+        try:
+            index["entries"][filename] = _build_entry(library_dir, filename, os.stat(os.path.join(library_dir, filename)))
+        except OSError as e:
+            print(f"Error indexing saved prompt '{filename}': {e}")
+            return
+        index["dir_mtime_ns"] = os.stat(library_dir).st_mtime_ns
+        _write_index(library_dir, index)
+        _indexes[library_dir] = index
+
+
+def validate_entry(library_dir, filename):
+    """Re-indexes one file if it was modified in place (same name, so the directory mtime did not change)."""
+    with _lock:
+        index = _indexes.get(library_dir)
+        entry = index["entries"].get(filename) if index else None
+        try:
+            stat = os.stat(os.path.join(library_dir, filename))
+        except OSError:
+            return
+        if entry and (entry["mtime_ns"] != stat.st_mtime_ns or entry["size"] != stat.st_size):
+            index["entries"][filename] = _build_entry(library_dir, filename, stat)
+            _write_index(library_dir, index)
+
+
+def query_prompts(library_dir, sort_by="saved", descending=True, min_score=None, industry=None, region=None):
+    """
+    Lists saved prompts from the index.
+    Args:
+        sort_by (str): "saved" (file modification time), "score" or "name".
+        min_score (int, optional): Only prompts with an associated score >= this.
+        industry, region (str, optional): Case-insensitive substring filters on the saved context inputs.
+    Returns:
+        list: Index entries (dicts with 'filename', 'name', 'score', 'context_inputs', ...).
+    """
+    entries = list(get_library_index(library_dir).values())
+    if min_score is not None:
+        entries = [e for e in entries if e["score"] is not None and e["score"] >= min_score]
+    for field, wanted in (("industry", industry), ("region", region)):
+        if wanted:
+            entries = [e for e in entries if wanted.lower() in str(e["context_inputs"].get(field, "")).lower()]
+    if sort_by == "score":
+        key = lambda e: (e["score"] is not None, e["score"] or 0, e["mtime_ns"])
+    elif sort_by == "name":
+        key = lambda e: e["name"].lower()
+    else:
+        key = lambda e: e["mtime_ns"]
+    return sorted(entries, key=key, reverse=descending)
+
+
+# --- Warm start: rank library prompts by context similarity + historical score ---
+# Weights of the saved context inputs in the similarity (normalized over the fields the query has)
+WARM_START_FIELDS = {"industry": 0.45, "region": 0.3, "transformational_journey": 0.25}
+WARM_START_SCORE_WEIGHT = 0.3  # rank = (1 - w) * similarity + w * score/100
+WARM_START_MIN_SIMILARITY = 0.25  # Below this a prompt is not considered a match, whatever its score
+
+_WORD_RE = re.compile(r"[a-z0-9]+")
+_text_index_cache = {}  # library dir -> (signature, text index)
+
+
+def _terms(text):
+    """Words plus character trigrams of each word, so 'automotive' also matches 'automobiles'."""
+    terms = []
+    for word in _WORD_RE.findall(str(text or "").lower()):
+        terms.append("w:" + word)
+        padded = f"_{word}_"
+        terms.extend("c:" + padded[i:i + 3] for i in range(len(padded) - 2))
+    return terms
+
+
+def _tfidf(terms, idf):
+    counts = Counter(terms)
+    vector = {t: (1 + math.log(c)) * idf.get(t, 0.0) for t, c in counts.items()}
+    norm = math.sqrt(sum(v * v for v in vector.values()))
+    return {t: v / norm for t, v in vector.items()} if norm else {}
+
+
+def _build_text_index(entries):
+    """Per context field: idf table and one tf-idf vector per library entry."""
+    index = {}
+    n = len(entries) + 1  # +1 for the query, keeps idf positive for terms in every entry
+    for field in WARM_START_FIELDS:
+        doc_terms = {e["filename"]: _terms(e["context_inputs"].get(field)) for e in entries}
+        df = Counter(t for terms in doc_terms.values() for t in set(terms))
+        idf = {t: math.log(n / c) + 1.0 for t, c in df.items()}
+        index[field] = (idf, {f: _tfidf(terms, idf) for f, terms in doc_terms.items() if terms})
+    return index
+
+
+def rank_prompts_for_context(library_dir, context, top_k=5, min_similarity=WARM_START_MIN_SIMILARITY):
+    """
+    Ranks saved prompts for a profile by similarity of their saved context inputs to `context`,
+    blended with the score the prompt was saved with. Local tf-idf text index, no external services.
+    Args:
+        context (dict): The current inputs (industry, region, transformational_journey).
+        top_k (int): Number of matches to return.
+    Returns:
+        list: Index entries with added 'similarity' and 'rank_score' (0-1), best first.
+    """
+    entries = get_library_index(library_dir)
+    if not entries:
+        return []
+    query_fields = {f: w for f, w in WARM_START_FIELDS.items() if str(context.get(f) or "").strip()}
+    total_weight = sum(query_fields.values())
+    if not total_weight:
+        return []
+
+    signature = tuple(sorted((f, e["mtime_ns"]) for f, e in entries.items()))
+    cached = _text_index_cache.get(library_dir)
+    if cached and cached[0] == signature:
+        text_index = cached[1]
+    else:
+        text_index = _build_text_index(list(entries.values()))
+        _text_index_cache[library_dir] = (signature, text_index)
+
+    similarities = Counter()
+    for field, weight in query_fields.items():
+        idf, vectors = text_index[field]
+        query = _tfidf(_terms(context[field]), idf)
+        for filename, vector in vectors.items():
+            similarities[filename] += weight / total_weight * sum(v * vector.get(t, 0.0) for t, v in query.items())
+
+    ranked = []
+    for filename, similarity in similarities.items():
+        if similarity < min_similarity:
+            continue
+        entry = entries[filename]
+        score = min(max(entry["score"] or 0, 0), 100) / 100.0
+        rank_score = (1 - WARM_START_SCORE_WEIGHT) * similarity + WARM_START_SCORE_WEIGHT * score
+        ranked.append(dict(entry, similarity=round(similarity, 3), rank_score=round(rank_score, 3)))
+    return sorted(ranked, key=lambda e: (e["rank_score"], e["mtime_ns"]), reverse=True)[:top_k]
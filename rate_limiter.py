@@ -0,0 +1,282 @@
+"""
+Provider-aware request pacing and API-key pool.
+
+Every LLM call to a model with a configured quota (config.MODEL_RATE_LIMITS) goes through that
+model's RateLimiter before it is sent:
+    - each API key of the pool (GOOGLE_API_KEYS, else the single default key) has two token
+      buckets, requests/min and tokens/min, refilled continuously;
+    - a call takes the key that can serve it soonest, and waits if none can;
+    - waiting calls are queued per session and served round-robin across sessions, so one
+      session's optimization run cannot starve the others;
+    - a key that still gets a quota error is rested for RATE_LIMIT_COOLDOWN_SECONDS.
+The chosen key is handed to the provider call through a context variable (see current_api_key).
+Limits apply per process; batch_optimize.py gives each worker process its share.
+"""
+import contextvars
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+from litellm import completion
+from textgrad.engine_experimental.engine_utils import open_ai_like_formatting
+from textgrad.engine_experimental.litellm import LiteLLMEngine
+
+from config import (
+    AVAILABLE_MODELS, MODEL_RATE_LIMITS, API_KEY_POOL_ENV, RATE_LIMIT_MAX_WAIT_SECONDS, RATE_LIMIT_COOLDOWN_SECONDS
+)
+from call_policy import CallDeadlineExceeded, classify_error
+from engine_wrappers import EngineWrapper, call_timeout, current_call_timeout
+from tracing import span
+from utils import estimate_tokens
+
+DEFAULT_RESPONSE_TOKENS = 2000  # Reserved per call until the real response size is known
+
+_session = contextvars.ContextVar("rate_limit_session", default="default")
+_api_key = contextvars.ContextVar("rate_limit_api_key", default=None)
+
+
+class RateLimitTimeout(CallDeadlineExceeded):
+    """Raised when a call waited longer than RATE_LIMIT_MAX_WAIT_SECONDS (or its deadline) for quota."""
+
+
+@contextmanager
+def scheduler_session(session_id):
+    """Tags LLM calls made in this context (and pooled calls it starts) with a session for fair queueing."""
+    token = _session.set(str(session_id))
+    try:
+        yield
+    finally:
+        _session.reset(token)
+
+
+def set_scheduler_session(session_id):
+    """Like scheduler_session, for a thread that only ever serves one session (e.g. a Streamlit script run)."""
+    _session.set(str(session_id))
+
+
+def current_api_key():
+    """API key chosen by the rate limiter for the call in progress (None: provider default)."""
+    return _api_key.get()
+
+
+class TokenBucket:
+    """Continuously refilled bucket: `per_minute` units per minute, bursts up to one minute's worth."""
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.level = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount, now):
+        self._refill(now)
+        amount = min(amount, self.capacity)  # A request larger than the bucket waits for a full bucket
+        return 0.0 if self.level >= amount else (amount - self.level) / self.rate
+
+    def consume(self, amount, now):
+        self._refill(now)
+        self.level = min(self.capacity, self.level - min(amount, self.capacity))
+
+
+class KeySlot:
+    """Quota state of one API key for one model."""
+
+    def __init__(self, api_key, rpm, tpm):
+        self.api_key = api_key
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.blocked_until = 0.0
+        self.calls = 0
+
+    def wait_time(self, tokens, now):
+        waits = [self.requests.wait_time(1, now), self.blocked_until - now]
+        if self.tokens is not None:
+            waits.append(self.tokens.wait_time(tokens, now))
+        return max(waits)
+
+
+class RateLimiter:
+    """Token-bucket limiter for one model over a pool of API keys, with per-session fair queueing."""
+
+    def __init__(self, model_string, rpm, tpm=None, api_keys=None):
+        self.model_string = model_string
+        self.rpm, self.tpm = rpm, tpm
+        self.slots = [KeySlot(key, rpm, tpm) for key in (api_keys or [None])]
+        self._cond = threading.Condition()
+        self._queues = OrderedDict()  # session -> deque of waiting tickets; order = round-robin turn
+        self.stats = {"calls": 0, "waited_calls": 0, "wait_seconds": 0.0, "max_wait_seconds": 0.0,
+                      "quota_errors": 0, "timeouts": 0}
+
+    def _next_ticket(self):
+        for queue in self._queues.values():
+            return queue[0]
+        return None
+
+    def _remove(self, session, ticket):
+        queue = self._queues[session]
+        queue.remove(ticket)
+        if not queue:
+            del self._queues[session]
+
+    def acquire(self, tokens, timeout=RATE_LIMIT_MAX_WAIT_SECONDS):
+        """
+        Blocks until this session's turn and a key with enough quota, then reserves it.
+        Returns:
+            KeySlot: The key to use; pass it to release() when the call is done.
+        """
+        session = _session.get()
+        ticket = object()
+        started = time.monotonic()
+        deadline = started + timeout
+        with self._cond:
+            self._queues.setdefault(session, deque()).append(ticket)
+            while True:
+                now = time.monotonic()
+                wait = None
+                if self._next_ticket() is ticket:
+                    slot = min(self.slots, key=lambda s: (s.wait_time(tokens, now), s.calls))
+                    wait = slot.wait_time(tokens, now)
+                    if wait <= 0:
+                        slot.requests.consume(1, now)
+                        if slot.tokens is not None:
+                            slot.tokens.consume(tokens, now)
+                        slot.calls += 1
+                        self._remove(session, ticket)
+                        if session in self._queues:
+                            self._queues.move_to_end(session)  # Next turn goes to another session
+                        self._record_wait(now - started)
+                        self._cond.notify_all()
+                        return slot
+                if now >= deadline:
+                    self._remove(session, ticket)
+                    self.stats["timeouts"] += 1
+                    self._cond.notify_all()
+                    raise RateLimitTimeout(f"Waited {timeout:.0f}s for {self.model_string} quota "
+                                           f"({len(self.slots)} key(s), {self.rpm} req/min).")
+                self._cond.wait(min(wait if wait is not None else deadline - now, deadline - now))
+
+    def _record_wait(self, waited):
+        self.stats["calls"] += 1
+        if waited > 0.05:
+            self.stats["waited_calls"] += 1
+            self.stats["wait_seconds"] += waited
+            self.stats["max_wait_seconds"] = max(self.stats["max_wait_seconds"], waited)
+
+    def release(self, slot, reserved_tokens, used_tokens=None, quota_error=False):
+        """Settles the token reservation with the real usage; rests the key after a quota error."""
+        with self._cond:
+            now = time.monotonic()
+            if slot.tokens is not None and used_tokens is not None:
+                slot.tokens.consume(used_tokens - reserved_tokens, now)  # Negative difference refunds
+            if quota_error:
+                slot.blocked_until = now + RATE_LIMIT_COOLDOWN_SECONDS
+                self.stats["quota_errors"] += 1
+            self._cond.notify_all()
+
+    def snapshot(self):
+        with self._cond:
+            now = time.monotonic()
+            return dict(self.stats, model=self.model_string, keys=len(self.slots), rpm=self.rpm, tpm=self.tpm,
+                        queued=sum(len(q) for q in self._queues.values()), sessions_waiting=len(self._queues),
+                        resting_keys=sum(s.blocked_until > now for s in self.slots))
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+_limit_share = 1.0
+
+
+def configure_limit_share(share):
+    """Scales all quotas for this process (e.g. 1/N in each of N worker processes sharing the keys)."""
+    global _limit_share
+    _limit_share = share
+
+
+def _configured_limits(model_string):
+    for name, limits in MODEL_RATE_LIMITS.items():
+        if name == model_string or AVAILABLE_MODELS.get(name) == model_string:
+            return limits
+    return None
+
+
+def get_rate_limiter(model_string):
+    """Returns the process-wide limiter for a model, or None if the model has no configured quota."""
+    with _limiters_lock:
+        if model_string not in _limiters:
+            limits = _configured_limits(model_string)
+            if limits:
+                api_keys = [k.strip() for k in os.getenv(API_KEY_POOL_ENV, "").split(",") if k.strip()]
+                tpm = limits.get("tpm")
+                _limiters[model_string] = RateLimiter(
+                    model_string, max(limits["rpm"] * _limit_share, 0.1),
+                    tpm * _limit_share if tpm else None, api_keys=api_keys,
+                )
+            else:
+                _limiters[model_string] = None
+        return _limiters[model_string]
+
+
+def rate_limit_stats():
+    """Snapshot of every active limiter (for the UI and reports)."""
+    with _limiters_lock:
+        limiters = [l for l in _limiters.values() if l is not None]
+    return [l.snapshot() for l in limiters]
+
+
+class RateLimitedEngine(EngineWrapper):
+    """Engine wrapper that paces calls through the model's RateLimiter and picks the API key for each call."""
+
+    def __init__(self, engine, limiter):
+        super().__init__(engine)
+        self.limiter = limiter
+
+    def generate(self, prompt, system_prompt=None, **kwargs):
+        prompt_text = prompt if isinstance(prompt, str) else ""
+        reserved = estimate_tokens((system_prompt or self.system_prompt or "") + prompt_text) + DEFAULT_RESPONSE_TOKENS
+        # Time spent queueing for quota counts against the call's deadline (call_policy.py)
+        deadline = current_call_timeout()
+        started = time.monotonic()
+        with span("rate_limit_wait", model=self.model_string):
+            slot = self.limiter.acquire(reserved, timeout=min(deadline or RATE_LIMIT_MAX_WAIT_SECONDS,
+                                                              RATE_LIMIT_MAX_WAIT_SECONDS))
+        token = _api_key.set(slot.api_key)
+        try:
+            with call_timeout(max(deadline - (time.monotonic() - started), 0.001) if deadline else None):
+                response = self.engine(prompt, system_prompt=system_prompt, **kwargs)
+        except Exception as e:
+            self.limiter.release(slot, reserved, quota_error=classify_error(e) == "rate_limit")
+            raise
+        finally:
+            _api_key.reset(token)
+        used = reserved - DEFAULT_RESPONSE_TOKENS + estimate_tokens(response if isinstance(response, str) else "")
+        self.limiter.release(slot, reserved, used_tokens=used)
+        return response
+
+
+class PooledKeyLiteLLMEngine(LiteLLMEngine):
+    """
+    TextGrad's LiteLLM engine, sending each call with the API key picked by the rate limiter and the
+    remaining call deadline as request timeout. Retries are left to call_policy.ResilientEngine
+    (TextGrad's own tenacity retry would multiply attempts and ignore the deadline).
+    """
+
+    def _generate_from_single_prompt(self, content, system_prompt=None, temperature=0, max_tokens=2000, top_p=0.99):
+        return self.lite_llm_generate(content, system_prompt)
+
+    def _generate_from_multiple_input(self, content, system_prompt=None, temperature=0, max_tokens=2000, top_p=0.99):
+        return self.lite_llm_generate(open_ai_like_formatting(content), system_prompt)
+
+    def lite_llm_generate(self, content, system_prompt=None, **kwargs):
+        messages = [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": content},
+        ]
+        api_key, timeout = current_api_key(), current_call_timeout()
+        options = dict(({"api_key": api_key} if api_key else {}), **({"timeout": timeout} if timeout else {}))
+        return completion(model=self.model_string, messages=messages, **options)['choices'][0]['message']['content']
@@ -0,0 +1,138 @@
+"""
+Append-only journal of optimization runs, for crash-safe resume.
+
+Each run is one JSON Lines file (logs/runs/<run_id>.jsonl by default):
+    {"type": "start", ...run settings and the evaluated starting point...}
+    {"type": "step", ...one history entry + timings + TGD state...}   (one per completed step)
+    {"type": "end", ...best result...}
+Records are flushed and fsync'ed as they are written, so everything up to the last completed step
+survives a browser refresh, a worker restart or a crash. A run without an "end" record can be resumed
+from its last completed step (see resume_state and pipeline.run_optimization(resume=...)).
+"""
+import json
+import os
+import threading
+import uuid
+from datetime import datetime
+
+from config import RUN_JOURNAL_DIR
+
+
+def new_run_id():
+    return f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:6]}"
+
+
+class RunJournal:
+    """Writes the records of one optimization run to an append-only JSONL file."""
+
+    def __init__(self, run_id=None, path=None, root=RUN_JOURNAL_DIR):
+        self.run_id = run_id or new_run_id()
+        self.path = path or os.path.join(root, f"{self.run_id}.jsonl")
+        self._lock = threading.Lock()
+
+    def append(self, record_type, **fields):
+        record = {"type": record_type, "run_id": self.run_id, "written_at": datetime.now().isoformat(), **fields}
+        line = json.dumps(record, default=str, ensure_ascii=False)
+        with self._lock:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            with open(self.path, "a+", encoding="utf-8") as f:
+                if f.tell() and not self._ends_with_newline():
+                    line = "\n" + line  # Terminate a torn record left by a crash
+                f.write(line + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+    def _ends_with_newline(self):
+        with open(self.path, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b"\n"
+
+    def start(self, settings, initial_result):
+        self.append("start", settings=settings, initial_result=initial_result)
+
+    def step(self, entry, timings=None, tgd_state=None, best=None):
+        self.append("step", entry=entry, timings=timings or {}, tgd_state=tgd_state or {}, best=best)
+
+    def end(self, best, stop_reason=None, metrics=None, convergence=None):
+        self.append("end", best=best, stop_reason=stop_reason, metrics=metrics, convergence=convergence)
+
+
+def read_journal(path):
+    """
+    Reads a journal file. A torn last line (crash while writing) is ignored.
+    Returns:
+        dict: start (record or None), steps (list of step records), end (record or None).
+    """
+    run = {"start": None, "steps": [], "end": None, "path": path}
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                print(f"Warning: skipping unreadable journal line in '{path}'.")
+                continue
+            if record.get("type") == "step":
+                run["steps"].append(record)
+            elif record.get("type") in ("start", "end"):
+                run[record["type"]] = record
+    return run
+
+
+def list_runs(root=RUN_JOURNAL_DIR, incomplete_only=False):
+    """
+    Lists journaled runs, newest first.
+    Returns:
+        list: Dicts with run_id, path, started_at, steps_completed, num_steps, best_score, complete.
+    """
+    if not os.path.isdir(root):
+        return []
+    runs = []
+    for filename in os.listdir(root):
+        if not filename.endswith(".jsonl"):
+            continue
+        path = os.path.join(root, filename)
+        try:
+            run = read_journal(path)
+        except OSError as e:
+            print(f"Error reading journal '{path}': {e}")
+            continue
+        if not run["start"]:
+            continue
+        complete = run["end"] is not None
+        if incomplete_only and complete:
+            continue
+        last_best = (run["end"] or (run["steps"][-1] if run["steps"] else {})).get("best") or run["start"]["initial_result"]
+        runs.append({
+            "run_id": run["start"]["run_id"], "path": path, "started_at": run["start"]["written_at"],
+            "steps_completed": len(run["steps"]), "num_steps": run["start"]["settings"].get("num_steps"),
+            "best_score": (last_best or {}).get("score"), "complete": complete,
+        })
+    return sorted(runs, key=lambda r: r["started_at"], reverse=True)
+
+
+def resume_state(run):
+    """
+    Builds the state needed to continue a journaled run after its last completed step.
+    Args:
+        run (dict): Output of read_journal.
+    Returns:
+        dict: run_id, settings, initial_result, history, best, next_step and system_prompt_text
+              (the TGD parameter value after the last completed step).
+    """
+    if not run["start"]:
+        raise ValueError(f"Journal '{run.get('path')}' has no start record; the run cannot be resumed.")
+    start = run["start"]
+    history = [record["entry"] for record in run["steps"]]
+    last = run["steps"][-1] if run["steps"] else None
+    initial = start["initial_result"]
+    best = (last or {}).get("best") or {
+        "score": initial.get("score"), "prompt": initial.get("prompt"), "table": initial.get("table", ""),
+        "description": initial.get("description", ""), "feedback": initial.get("feedback", ""), "step": 0,
+    }
+    tgd_state = (last or {}).get("tgd_state") or {}
+    return {
+        "run_id": start["run_id"], "settings": start["settings"], "initial_result": initial,
+        "history": history, "best": best,
+        "next_step": (history[-1]["step"] + 1) if history else 1,
+        "system_prompt_text": tgd_state.get("parameter_value", start["settings"].get("system_prompt_text")),
+    }
@@ -0,0 +1,152 @@
+"""
+Cross-source near-duplicate elimination for the external data inputs.
+
+The sidebar sources (google_agent_output, bard_outputs, ...) often repeat the same facts, and all of
+them are inlined into the user query and again into every evaluation instruction. dedupe_sources()
+splits each source into sentence-level passages, finds near-duplicates across (and within) sources
+with word shingles + MinHash/LSH (verified by exact Jaccard similarity), and keeps only the first
+occurrence in source order. The kept passage is annotated with the other sources that stated it and
+with any URLs only the dropped copies had, so attribution and links survive. Paragraphs whose
+passages are all duplicates disappear entirely.
+"""
+import hashlib
+import random
+import re
+from functools import lru_cache
+
+from utils import estimate_tokens
+
+SHINGLE_WORDS = 3
+NUM_PERMUTATIONS = 64
+LSH_BANDS = 16  # 16 bands x 4 rows: pairs above ~0.5 similarity become candidates
+DUPLICATE_THRESHOLD = 0.6  # Exact Jaccard similarity of shingle sets to treat passages as duplicates
+MIN_PASSAGE_WORDS = 6  # Headings, list numbers and short fragments are never removed
+
+_MERSENNE_PRIME = (1 << 61) - 1
+_rng = random.Random(1234)  # Fixed seed: the same inputs always collapse the same way
+_PERMUTATIONS = [(_rng.randrange(1, _MERSENNE_PRIME), _rng.randrange(0, _MERSENNE_PRIME))
+                 for _ in range(NUM_PERMUTATIONS)]
+
+# Sentence ends (not list numbers like "1.") and line breaks, including the literal "\n" escapes
+# found in pasted agent outputs. Captured so the original separators are kept.
+_SPLIT_RE = re.compile(r'((?<=[^\d\s][.!?])\s+|\s*(?:\\n|\n)+\s*)')
+_URL_RE = re.compile(r'https?://[^\s<>"\')\]]+')
+_WORD_RE = re.compile(r"[a-z0-9]+(?:['.][a-z0-9]+)*")
+
+
+def _shingles(text):
+    words = _WORD_RE.findall(_URL_RE.sub(" ", text.lower()))
+    if len(words) < SHINGLE_WORDS:
+        return {" ".join(words)} if words else set()
+    return {" ".join(words[i:i + SHINGLE_WORDS]) for i in range(len(words) - SHINGLE_WORDS + 1)}
+
+
+def _minhash(shingles):
+    hashed = [int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=8).digest(), "big") for s in shingles]
+    return [min((a * h + b) % _MERSENNE_PRIME for h in hashed) for a, b in _PERMUTATIONS]
+
+
+def _jaccard(a, b):
+    return len(a & b) / len(a | b) if a and b else 0.0
+
+
+def _split_passages(text):
+    """Returns a list of [passage, separator] pairs covering the whole text."""
+    parts = _SPLIT_RE.split(text)
+    return [[parts[i], parts[i + 1] if i + 1 < len(parts) else ""] for i in range(0, len(parts), 2)]
+
+
+def dedupe_sources(sources, source_order=None):
+    """
+    Collapses near-duplicate passages across external data sources.
+    Args:
+        sources (dict): {source_key: text}.
+        source_order (list, optional): Precedence for keeping passages (defaults to dict order);
+            use the order the sources appear in the prompt.
+    Returns:
+        tuple: (dict of deduplicated texts, report dict with tokens_before, tokens_after, saved_tokens,
+                saved_pct, passages_removed and merges [(kept_source, dropped_source, similarity, snippet)])
+    """
+    order = [k for k in (source_order or sources.keys()) if k in sources]
+    passages = {key: _split_passages(sources[key] or "") for key in order}
+
+    # Signature bands -> passages already kept (first occurrence wins)
+    buckets = {}
+    kept = []  # (source, index, shingles, extra_sources, extra_urls)
+    removed = {key: set() for key in order}
+    merges = []
+
+    for key in order:
+        for index, (passage, _) in enumerate(passages[key]):
+            if len(passage.split()) < MIN_PASSAGE_WORDS:
+                continue
+            shingles = _shingles(passage)
+            if not shingles:
+                continue
+            signature = _minhash(shingles)
+            rows = NUM_PERMUTATIONS // LSH_BANDS
+            bands = [(b, tuple(signature[b * rows:(b + 1) * rows])) for b in range(LSH_BANDS)]
+
+            candidates = {kept_id for band in bands for kept_id in buckets.get(band, ())}
+            best_id, best_similarity = None, 0.0
+            for kept_id in candidates:
+                similarity = _jaccard(shingles, kept[kept_id][2])
+                if similarity > best_similarity:
+                    best_id, best_similarity = kept_id, similarity
+
+            if best_id is not None and best_similarity >= DUPLICATE_THRESHOLD:
+                kept_source, kept_index, kept_shingles, extra_sources, extra_urls = kept[best_id]
+                removed[key].add(index)
+                if key != kept_source and key not in extra_sources:
+                    extra_sources.append(key)
+                kept_urls = set(_URL_RE.findall(passages[kept_source][kept_index][0]))
+                for url in _URL_RE.findall(passage):
+                    if url not in kept_urls and url not in extra_urls:
+                        extra_urls.append(url)
+                merges.append((kept_source, key, round(best_similarity, 2), passage[:80]))
+                continue
+
+            kept_id = len(kept)
+            kept.append((key, index, shingles, [], []))
+            for band in bands:
+                buckets.setdefault(band, []).append(kept_id)
+
+    # Annotate kept passages with the attribution/URLs of their dropped copies
+    for source, index, _, extra_sources, extra_urls in kept:
+        notes = []
+        if extra_sources:
+            notes.append(f"also in {', '.join(extra_sources)}")
+        if extra_urls:
+            notes.append(f"see also {' '.join(extra_urls)}")
+        if notes:
+            passages[source][index][0] += f" [{'; '.join(notes)}]"
+
+    deduped = {}
+    for key in order:
+        deduped[key] = "".join(p + sep for i, (p, sep) in enumerate(passages[key]) if i not in removed[key]).strip()
+    for key in sources:
+        deduped.setdefault(key, sources[key])
+
+    tokens_before = sum(estimate_tokens(sources[k] or "") for k in order)
+    tokens_after = sum(estimate_tokens(deduped[k]) for k in order)
+    report = {
+        "tokens_before": tokens_before, "tokens_after": tokens_after,
+        "saved_tokens": tokens_before - tokens_after,
+        "saved_pct": round(100.0 * (tokens_before - tokens_after) / tokens_before, 1) if tokens_before else 0.0,
+        "passages_removed": sum(len(r) for r in removed.values()), "merges": merges,
+    }
+    return deduped, report
+
+
+@lru_cache(maxsize=32)
+def _dedupe_cached(source_items):
+    return dedupe_sources(dict(source_items), [k for k, _ in source_items])
+
+
+def dedupe_sources_cached(sources, source_order):
+    """
+    Memoized dedupe_sources (the same inputs are formatted into every generation and evaluation).
+    Returns copies, so callers may modify the results.
+    """
+    deduped, report = _dedupe_cached(tuple((k, sources.get(k) or "") for k in source_order))
+    return dict(deduped), dict(report, merges=list(report["merges"]))
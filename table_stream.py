@@ -0,0 +1,195 @@
+"""
+Streaming table generation.
+
+StreamingEngine wraps the generator engine: it streams the response, parses TSV rows as they
+arrive (IncrementalTSVParser), reports each row to the listener registered in the current
+context (so the UI can render the table progressively; pooled and background calls run in a copy
+of their caller's context, so they report to the same listener) and aborts/retries a generation as soon
+as it breaks the required format, instead of waiting for thousands of malformed tokens.
+"""
+import contextvars
+import csv
+import io
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+from textgrad.engine_experimental.litellm import LiteLLMEngine
+
+from config import TABLE_COLUMNS
+from engine_wrappers import EngineWrapper, current_call_timeout
+from rate_limiter import current_api_key
+
+EXPECTED_COLUMNS = len(TABLE_COLUMNS)
+HEADER_PREFIX = "strategic imperative"
+# Every field double-quoted (with "" as the escaped quote), separated by single tabs
+_QUOTED_ROW_RE = re.compile(r'^"(?:[^"]|"")*"(?:\t"(?:[^"]|"")*")*$')
+
+
+class MalformedTableStreamError(ValueError):
+    """Raised by IncrementalTSVParser when the streamed table breaks the required format."""
+
+
+class IncrementalTSVParser:
+    """
+    Incrementally parses a TAB-delimited, fully quoted table from text chunks.
+    `feed()` returns the rows completed by that chunk and raises MalformedTableStreamError on:
+    text before the "Strategic Imperative" header, unquoted fields, or a wrong column count.
+    """
+
+    def __init__(self, expected_columns=EXPECTED_COLUMNS, strict=True):
+        self.expected_columns = expected_columns
+        self.strict = strict
+        self.header = None
+        self.rows = []
+        self._pending = ""
+
+    def feed(self, chunk):
+        self._pending += chunk
+        if self.header is None and self.strict:
+            self._check_header_prefix()
+        completed = []
+        while "\n" in self._pending:
+            line, rest = self._pending.split("\n", 1)
+            # A newline inside a quoted field does not end the row
+            if line.count('"') % 2 == 1:
+                if "\n" not in rest:
+                    break
+                next_line, rest = rest.split("\n", 1)
+                self._pending = f"{line} {next_line}\n{rest}"
+                continue
+            self._pending = rest
+            row = self._parse_line(line)
+            if row is not None:
+                completed.append(row)
+        return completed
+
+    def finish(self):
+        """Parses whatever is left after the stream ends. Returns the final rows (if any)."""
+        line, self._pending = self._pending, ""
+        row = self._parse_line(line)
+        return [row] if row is not None else []
+
+    def _check_header_prefix(self):
+        # Abort on intro text without waiting for the end of the first line
+        head = self._pending.lstrip().lstrip('"').lower()
+        if len(head) >= len(HEADER_PREFIX) and not head.startswith(HEADER_PREFIX):
+            raise MalformedTableStreamError(
+                f"Output does not start with the 'Strategic Imperative' header: {self._pending.strip()[:60]!r}"
+            )
+
+    def _parse_line(self, line):
+        line = line.strip("\r").strip()
+        if not line:
+            return None
+        if not self.strict:
+            # Lenient mode: skip anything that is not a header or a well-formed row
+            if self.header is None and not line.lstrip('"').lower().startswith(HEADER_PREFIX):
+                return None
+        elif not _QUOTED_ROW_RE.match(line):
+            raise MalformedTableStreamError(f"Row {len(self.rows) + 1} has unquoted fields or stray text: {line[:80]!r}")
+        fields = next(csv.reader(io.StringIO(line), delimiter="\t", quotechar='"'))
+        if len(fields) != self.expected_columns:
+            if self.strict:
+                raise MalformedTableStreamError(
+                    f"Row {len(self.rows) + 1} has {len(fields)} columns instead of {self.expected_columns}."
+                )
+            return None
+        if self.header is None:
+            self.header = fields
+            return None
+        self.rows.append(fields)
+        return fields
+
+
+# Per-context listener so concurrent sessions only see their own rows, while generations on pool
+# threads or in a background job (which run in a copied context) still reach it
+_listener = contextvars.ContextVar("stream_listener", default=None)
+
+
+@contextmanager
+def stream_listener(on_row=None, on_restart=None):
+    """
+    Registers callbacks for streamed generations made from the current context.
+    Args:
+        on_row (callable): on_row(header, row, row_index) for every completed row.
+        on_restart (callable): on_restart(reason, attempt) when a malformed stream is aborted and retried.
+    """
+    token = _listener.set({"on_row": on_row, "on_restart": on_restart})
+    try:
+        yield
+    finally:
+        _listener.reset(token)
+
+
+def _current_listener():
+    return _listener.get() or {}
+
+
+class StreamingEngine(EngineWrapper):
+    """
+    Generator engine wrapper that streams, validates and retries table generations.
+    The final attempt is never aborted, so a stubborn model still produces a (possibly malformed)
+    table, as it would without streaming.
+    """
+
+    def __init__(self, engine, max_retries=2):
+        super().__init__(engine)
+        self.max_retries = max_retries
+        self._stats = threading.local()
+
+    @property
+    def last_stream_stats(self):
+        """Stats of the last streamed generation on this thread (time to first row, aborts, ...)."""
+        return getattr(self._stats, "value", None)
+
+    def _iter_chunks(self, prompt, system_prompt, **kwargs):
+        provider = self.unwrap()
+        if hasattr(provider, "stream_generate"):
+            yield from provider.stream_generate(prompt, system_prompt=system_prompt, **kwargs)
+        elif isinstance(provider, LiteLLMEngine) and isinstance(prompt, str):
+            import litellm  # installed with TextGrad's experimental (LiteLLM) engines
+            messages = [{"role": "system", "content": system_prompt or self.system_prompt},
+                        {"role": "user", "content": prompt}]
+            if current_api_key():
+                kwargs = dict(kwargs, api_key=current_api_key())
+            if current_call_timeout():
+                kwargs = dict(kwargs, timeout=current_call_timeout())
+            for chunk in litellm.completion(model=provider.model_string, messages=messages, stream=True, **kwargs):
+                yield chunk.choices[0].delta.content or ""
+        else:
+            # Engine cannot stream: validate the complete response in one go
+            yield self.engine(prompt, system_prompt=system_prompt, **kwargs)
+
+    def generate(self, prompt, system_prompt=None, **kwargs):
+        listener = _current_listener()
+        started = time.perf_counter()
+        stats = {"attempts": 0, "aborts": [], "time_to_first_row": None, "rows": 0}
+        self._stats.value = stats
+
+        for attempt in range(self.max_retries + 1):
+            stats["attempts"] = attempt + 1
+            stats["rows"] = 0
+            is_last_attempt = attempt == self.max_retries
+            parser = IncrementalTSVParser(strict=not is_last_attempt)
+            parts = []
+            try:
+                for chunk in self._iter_chunks(prompt, system_prompt, **kwargs):
+                    parts.append(chunk)
+                    self._emit_rows(parser, parser.feed(chunk), listener, stats, started)
+                self._emit_rows(parser, parser.finish(), listener, stats, started)
+                return "".join(parts)
+            except MalformedTableStreamError as e:
+                stats["aborts"].append(str(e))
+                print(f"Aborting malformed table stream (attempt {attempt + 1}): {e}")
+                if listener.get("on_restart"):
+                    listener["on_restart"](str(e), attempt + 1)
+
+    def _emit_rows(self, parser, rows, listener, stats, started):
+        for row in rows:
+            if stats["time_to_first_row"] is None:
+                stats["time_to_first_row"] = time.perf_counter() - started
+            stats["rows"] += 1
+            if listener.get("on_row"):
+                listener["on_row"](parser.header, row, len(parser.rows) - 1)
@@ -0,0 +1,169 @@
+"""
+Local, deterministic pre-scorer for generated tables.
+
+Computes the rubric checks of EVALUATION_PROMPT_TEMPLATE that need no LLM judgement:
+    B1.1  TSV-only output (no intro/outro text)                      10 pts
+    B1.2  every field double-quoted, consistent column count          5 pts
+    B2.1  minimum 3 events per SI8 category                           5 pts
+    A4.1  'Side details' of at least 30 words                         5 pts (rule part only)
+    A4.2  bold header + no "Based on X" filler in 'Side details'      5 pts
+    A5.1  Impact Score / Revenue in 10-100 and not divisible by 5     5 pts (rule part only)
+    A5.2  numeric Impact Start within the year range, numeric Duration 5 pts (rule part only)
+The report is used to gate the paid evaluator: tables that fail the gate are regenerated or
+rejected locally (see pipeline.run_optimization).
+"""
+import csv
+import io
+import re
+
+from config import SI8_CATEGORIES, TABLE_COLUMNS
+from utils import find_table_header_index, parse_table_text
+
+MIN_EVENTS_PER_SI8 = 3
+MIN_SIDE_DETAILS_WORDS = 30
+# Minimum share of the local points a table needs before it is sent to the evaluator
+PRESCORE_GATE_MIN_RATIO = 0.6
+
+_QUOTED_ROW_RE = re.compile(r'^"(?:[^"]|"")*"(?:\t"(?:[^"]|"")*")*$')
+_BOLD_HEADER_RE = re.compile(r'^\s*\*\*[^*]+\*\*\s*(--|—|–|-|:)')
+_FILLER_RE = re.compile(r'\b(based on|drawing from|as per)\b', re.IGNORECASE)
+
+
+def _ratio_points(max_points, passed, total):
+    return int(max_points * passed / total) if total else 0
+
+
+def _to_int(value):
+    digits = re.sub(r"[^\d-]", "", str(value))
+    try:
+        return int(digits)
+    except ValueError:
+        return None
+
+
+def _check(awarded, max_points, detail):
+    return {"awarded": awarded, "max": max_points, "detail": detail}
+
+
+def _format_checks(table_text):
+    lines = table_text.strip().split("\n")
+    header_index = find_table_header_index(lines)
+    extraneous = [l for l in lines[:header_index] if l.strip()]
+    rows = [l for l in lines[header_index:] if l.strip()]
+    quoted = 0
+    wrong_columns = 0
+    for line in rows:
+        stripped = line.strip()
+        if _QUOTED_ROW_RE.match(stripped):
+            quoted += 1
+        fields = next(csv.reader(io.StringIO(stripped), delimiter="\t", quotechar='"'))
+        if len(fields) != len(TABLE_COLUMNS):
+            wrong_columns += 1
+            # Rows with no tab at all are trailing prose, not table rows
+            if "\t" not in stripped:
+                extraneous.append(line)
+    quoting_points = _ratio_points(5, quoted, len(rows))
+    if wrong_columns:
+        quoting_points = max(0, quoting_points - 2)
+    return {
+        "B1.1": _check(max(0, 10 - 4 * len(extraneous)), 10,
+                       "Only the TSV table was returned." if not extraneous
+                       else f"{len(extraneous)} line(s) of text outside the table, e.g. {extraneous[0].strip()[:60]!r}."),
+        "B1.2": _check(quoting_points, 5,
+                       f"{quoted}/{len(rows)} lines fully double-quoted; {wrong_columns} line(s) without "
+                       f"{len(TABLE_COLUMNS)} columns."),
+    }
+
+
+def _content_checks(df, current_year, future_year):
+    checks = {}
+    n = len(df)
+
+    if "Strategic Imperative" in df.columns:
+        counts = df["Strategic Imperative"].str.strip().str.strip('"').value_counts()
+        covered = [si for si in SI8_CATEGORIES if counts.get(si, 0) >= MIN_EVENTS_PER_SI8]
+        missing = [si for si in SI8_CATEGORIES if si not in covered]
+        checks["B2.1"] = _check(_ratio_points(5, len(covered), len(SI8_CATEGORIES)), 5,
+                                f"{len(covered)}/8 SI8 categories have {MIN_EVENTS_PER_SI8}+ events."
+                                + (f" Short: {', '.join(missing)}." if missing else ""))
+    else:
+        checks["B2.1"] = _check(0, 5, "'Strategic Imperative' column missing.")
+
+    if "Side details" in df.columns and n:
+        details = df["Side details"].astype(str)
+        long_enough = sum(len(d.split()) >= MIN_SIDE_DETAILS_WORDS for d in details)
+        well_formed = sum(bool(_BOLD_HEADER_RE.match(d)) and not _FILLER_RE.search(d) for d in details)
+        fillers = sum(bool(_FILLER_RE.search(d)) for d in details)
+        checks["A4.1"] = _check(_ratio_points(5, long_enough, n), 5,
+                                f"{long_enough}/{n} 'Side details' have {MIN_SIDE_DETAILS_WORDS}+ words.")
+        checks["A4.2"] = _check(_ratio_points(5, well_formed, n), 5,
+                                f"{well_formed}/{n} start with a bold header and avoid filler; "
+                                f"{fillers} contain 'Based on'/'Drawing from'/'As per'.")
+    else:
+        checks["A4.1"] = _check(0, 5, "'Side details' column missing or table empty.")
+        checks["A4.2"] = _check(0, 5, "'Side details' column missing or table empty.")
+
+    score_columns = [c for c in ("Impact Score", "Potential Impact on Revenue") if c in df.columns]
+    if len(score_columns) == 2 and n:
+        values = [_to_int(v) for c in score_columns for v in df[c]]
+        valid = sum(v is not None and 10 <= v <= 100 and v % 5 != 0 for v in values)
+        checks["A5.1"] = _check(_ratio_points(5, valid, len(values)), 5,
+                                f"{valid}/{len(values)} Impact Score/Revenue values are 10-100 and not divisible by 5.")
+    else:
+        checks["A5.1"] = _check(0, 5, "'Impact Score' or 'Potential Impact on Revenue' column missing.")
+
+    if "Impact Start" in df.columns and "Impact Duration" in df.columns and n:
+        starts = [_to_int(v) for v in df["Impact Start"]]
+        durations = [_to_int(v) for v in df["Impact Duration"]]
+        valid = sum(s is not None and current_year <= s <= future_year and d is not None and d > 0
+                    for s, d in zip(starts, durations))
+        checks["A5.2"] = _check(_ratio_points(5, valid, n), 5,
+                                f"{valid}/{n} rows have a numeric Impact Start in {current_year}-{future_year} "
+                                f"and a numeric Impact Duration.")
+    else:
+        checks["A5.2"] = _check(0, 5, "'Impact Start' or 'Impact Duration' column missing.")
+    return checks
+
+
+def prescore_table(table_text, current_year, future_year):
+    """
+    Runs all local checks on a generated table.
+    Returns:
+        dict: checks ({id: {awarded, max, detail}}), local_score, local_max, rows,
+              parse_error (str or None) and passed (gate decision).
+    """
+    report = {"checks": {}, "local_score": 0, "local_max": 40, "rows": 0, "parse_error": None, "passed": False}
+    if not table_text or not isinstance(table_text, str) or not table_text.strip():
+        report["parse_error"] = "Empty table."
+        return report
+
+    report["checks"].update(_format_checks(table_text))
+    try:
+        df, _ = parse_table_text(table_text)
+        df.columns = [str(c).strip().strip('"') for c in df.columns]
+        report["rows"] = len(df)
+        report["checks"].update(_content_checks(df, current_year, future_year))
+    except Exception as e:
+        report["parse_error"] = f"Table could not be parsed: {e}"
+
+    report["local_score"] = sum(c["awarded"] for c in report["checks"].values())
+    report["local_max"] = sum(c["max"] for c in report["checks"].values()) or report["local_max"]
+    report["passed"] = (report["parse_error"] is None and report["rows"] > 0
+                        and report["local_score"] >= PRESCORE_GATE_MIN_RATIO * report["local_max"])
+    return report
+
+
+def prescore_feedback(report):
+    """
+    Builds textual feedback for the system prompt from failed local checks.
+    Used as the gradient when a table is rejected without calling the evaluator.
+    """
+    lines = ["The generated table was rejected by automatic format checks before evaluation."]
+    if report.get("parse_error"):
+        lines.append(f"- {report['parse_error']} The system prompt must insist on ONLY a TAB-delimited, fully "
+                     f"double-quoted table starting with the 'Strategic Imperative' header row.")
+    for check_id, check in sorted(report.get("checks", {}).items()):
+        if check["awarded"] < check["max"]:
+            lines.append(f"- {check_id} ({check['awarded']}/{check['max']} pts): {check['detail']}")
+    lines.append("Strengthen the corresponding guidelines in the system prompt so these rules are always followed.")
+    return "\n".join(lines)
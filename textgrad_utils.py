@@ -1,27 +1,78 @@
 import streamlit as st
 import textgrad as tg
 
+from llm_cache import CachedEngine
+from fake_engine import FakeEngine
+from table_stream import StreamingEngine
+from prompt_cache import PrefixCacheEngine
+from rate_limiter import PooledKeyLiteLLMEngine, RateLimitedEngine, get_rate_limiter
+from call_policy import ResilientEngine, classify_error
+from call_metrics import MeteredEngine
+
+def create_engine(name, use_cache=False, streaming=False, hedge=False):
+    """
+    Creates a TextGrad engine instance outside of Streamlit's resource cache.
+    Used directly by headless entry points (e.g. batch_optimize.py worker processes).
+    Args:
+        name (str): The name or identifier of the TextGrad engine.
+        use_cache (bool): Serve exact-repeat calls from the persistent response cache (llm_cache.py).
+        streaming (bool): Stream table generations with incremental validation (table_stream.py).
+            Only for generator engines: every call is expected to return a table.
+        hedge (bool): Send a duplicate request when a call is slower than the recent p95 (call_policy.py).
+            Ignored for streaming engines, whose stream stats are per thread.
+    Returns:
+        An instance of the TextGrad engine.
+    """
+    if name.startswith("fake:"):
+        engine = FakeEngine(name)
+    elif name.startswith("experimental:"):
+        engine = PooledKeyLiteLLMEngine(model_string=name.split("experimental:", 1)[1], cache=False)
+    else:
+        engine = tg.get_engine(name, cache=False)
+    if streaming:
+        engine = StreamingEngine(engine)
+    # Metered right above the provider (streaming talks to it directly): every attempt and hedge is counted
+    engine = MeteredEngine(engine)
+    # Pacing sits below both caches: cache hits cost no quota
+    limiter = get_rate_limiter(name)
+    if limiter is not None:
+        engine = RateLimitedEngine(engine, limiter)
+    # Retries/deadlines wrap the pacing, so every attempt (and hedge) waits its turn for quota
+    engine = ResilientEngine(engine, hedge=hedge and not streaming)
+    # Below the response cache: only calls that reach the provider count for prompt caching
+    engine = PrefixCacheEngine(engine)
+    if use_cache:
+        engine = CachedEngine(engine)
+    return engine
+
 @st.cache_resource
-def get_generator_engine(name):
+def get_generator_engine(name, use_cache=False, streaming=False, hedge=False):
     """
-    Retrieves a TextGrad engine instance for generation, with caching disabled.
+    Retrieves a TextGrad engine instance for generation.
+    TextGrad's own cache is disabled; `use_cache` opts into the persistent response cache.
     Args:
         name (str): The name or identifier of the TextGrad engine.
+        use_cache (bool): Whether to cache responses on disk.
+        streaming (bool): Whether to stream and validate tables as they are generated.
+        hedge (bool): Whether to hedge slow calls with a duplicate request.
     Returns:
-        An instance of the TextGrad engcacheine.
+        An instance of the TextGrad engine.
     """
-    return tg.get_engine(name, cache=False)
+    return create_engine(name, use_cache=use_cache, streaming=streaming, hedge=hedge)
 
 @st.cache_resource
-def get_evaluator_engine(name):
+def get_evaluator_engine(name, use_cache=False, hedge=False):
     """
-    Retrieves a TextGrad engine instance for evaluation, with caching disabled.
+    Retrieves a TextGrad engine instance for evaluation.
+    Keep `use_cache` off when fresh evaluator samples are wanted.
     Args:
         name (str): The name or identifier of the TextGrad engine.
+        use_cache (bool): Whether to cache responses on disk.
+        hedge (bool): Whether to hedge slow calls with a duplicate request.
     Returns:
         An instance of the TextGrad engine.
     """
-    return tg.get_engine(name, cache=False)
+    return create_engine(name, use_cache=use_cache, hedge=hedge)
 
 def handle_textgrad_exception(e, context="operation"):
     """
@@ -32,8 +83,15 @@ def handle_textgrad_exception(e, context="operation"):
     """
     st.error(f"Error during {context}: {e}")
     print(f"Error during {context}: {e}")
-    st.warning(
-        "Please ensure API keys (e.g., GOOGLE_API_KEY) are correctly set in your environment "
-        "and have access to the selected models. Also, verify the model names are correct."
-    )
+    error_class = classify_error(e)
+    if error_class in ("rate_limit", "deadline"):
+        st.warning("The model's quota or the call deadline was exhausted even after retries. "
+                   "Wait a minute, lower the number of parallel calls, or add keys to GOOGLE_API_KEYS.")
+    elif error_class in ("timeout", "transient"):
+        st.warning("The model provider kept timing out or was unavailable after several retries. Please try again.")
+    else:
+        st.warning(
+            "Please ensure API keys (e.g., GOOGLE_API_KEY) are correctly set in your environment "
+            "and have access to the selected models. Also, verify the model names are correct."
+        )
  
\ No newline at end of file
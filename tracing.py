@@ -0,0 +1,227 @@
+"""
+Profiling mode: nested timing spans over the whole pipeline, written as Chrome trace files.
+
+While a Tracer is active (tracing_session() / activate_tracer()), span() records how long each
+stage takes: prompt formatting, BlackboxLLM forward, TextLoss, evaluation parsing, loss.backward(),
+optimizer.step(), individual LLM calls, quota waits and retry backoff, table parsing and Streamlit
+rendering. Spans nest through a context variable, so calls run on the engine pool still hang under
+the step that started them; a background job (root_span) starts a tree of its own.
+
+Tracer.write() saves the spans in the Chrome trace event format (open in chrome://tracing,
+https://ui.perfetto.dev or speedscope); summarize() gives count / total / self time per span name,
+where self time excludes child spans, i.e. the overhead of the stage itself.
+Without an active tracer span() is a no-op.
+
+Usage (summary of a saved trace):
+    python tracing.py logs/traces/trace_20250101_120000.json
+"""
+import contextvars
+import functools
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+from config import TRACE_DIR, TRACE_MAX_SPANS
+
+_tracer = contextvars.ContextVar("tracer", default=None)
+_parent = contextvars.ContextVar("trace_parent", default=None)
+
+
+class Tracer:
+    """Collects finished spans (thread-safe, bounded to TRACE_MAX_SPANS)."""
+
+    def __init__(self, name="trace", max_spans=TRACE_MAX_SPANS):
+        self.name = name
+        self.max_spans = max_spans
+        self.spans = []  # (span_id, parent_id, name, start, duration, thread_id, args)
+        self.dropped = 0
+        self.thread_names = {}
+        self.created_at = time.perf_counter()
+        self._ids = 0
+        self._lock = threading.Lock()
+
+    def next_id(self):
+        with self._lock:
+            self._ids += 1
+            return self._ids
+
+    def add(self, span_id, parent_id, name, start, duration, args):
+        thread = threading.current_thread()
+        with self._lock:
+            if len(self.spans) >= self.max_spans:
+                self.dropped += 1
+                return
+            self.thread_names[thread.ident] = thread.name
+            self.spans.append((span_id, parent_id, name, start, duration, thread.ident, args))
+
+    def clear(self):
+        with self._lock:
+            self.spans, self.dropped = [], 0
+
+    def chrome_trace(self):
+        """The spans as a Chrome trace event dict ('X' complete events, microseconds)."""
+        with self._lock:
+            spans, thread_names = list(self.spans), dict(self.thread_names)
+        pid = os.getpid()
+        events = [{"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": name}}
+                  for tid, name in thread_names.items()]
+        for span_id, parent_id, name, start, duration, tid, args in spans:
+            events.append({"name": name, "ph": "X", "pid": pid, "tid": tid,
+                           "ts": round((start - self.created_at) * 1e6, 1), "dur": round(duration * 1e6, 1),
+                           "args": dict(args, span_id=span_id, parent_id=parent_id)})
+        return {"traceEvents": events, "displayTimeUnit": "ms",
+                "otherData": {"name": self.name, "dropped_spans": self.dropped}}
+
+    def write(self, path=None):
+        """Writes the Chrome trace file (default: TRACE_DIR/<name>_<timestamp>.json) and returns its path."""
+        path = path or os.path.join(TRACE_DIR, f"{self.name}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.chrome_trace(), f)
+        return path
+
+    def summary(self):
+        return summarize(self.chrome_trace()["traceEvents"])
+
+
+def summarize(events):
+    """
+    Aggregates trace events per span name.
+    Returns:
+        list: dicts (name, count, total_ms, self_ms, mean_ms, max_ms), largest self time first.
+            Self time is the span minus its direct children (children running in parallel on other
+            threads can exceed their parent; self time is then clamped to zero).
+    """
+    spans = [e for e in events if e.get("ph") == "X"]
+    child_time = {}
+    for e in spans:
+        parent_id = e["args"].get("parent_id")
+        if parent_id is not None:
+            child_time[parent_id] = child_time.get(parent_id, 0.0) + e["dur"]
+    rows = {}
+    for e in spans:
+        row = rows.setdefault(e["name"], {"name": e["name"], "count": 0, "total_ms": 0.0, "self_ms": 0.0,
+                                          "mean_ms": 0.0, "max_ms": 0.0})
+        row["count"] += 1
+        row["total_ms"] += e["dur"] / 1000
+        row["self_ms"] += max(e["dur"] - child_time.get(e["args"].get("span_id"), 0.0), 0.0) / 1000
+        row["max_ms"] = max(row["max_ms"], e["dur"] / 1000)
+    for row in rows.values():
+        row["mean_ms"] = row["total_ms"] / row["count"]
+        for key in ("total_ms", "self_ms", "mean_ms", "max_ms"):
+            row[key] = round(row[key], 2)
+    return sorted(rows.values(), key=lambda r: r["self_ms"], reverse=True)
+
+
+def current_tracer():
+    return _tracer.get()
+
+
+def activate_tracer(tracer):
+    """Sets (or with None, clears) the tracer for this context, e.g. a Streamlit script run."""
+    _tracer.set(tracer)
+    _parent.set(None)
+
+
+@contextmanager
+def tracing_session(name="trace", path=None):
+    """Traces everything in this context with a new Tracer and writes the trace file at the end."""
+    tracer = Tracer(name)
+    token, parent_token = _tracer.set(tracer), _parent.set(None)
+    try:
+        yield tracer
+    finally:
+        _tracer.reset(token)
+        _parent.reset(parent_token)
+        tracer.write(path)
+
+
+@contextmanager
+def root_span(name, **args):
+    """Like span(), but starts a new tree: for work that outlives the code that started it (background jobs)."""
+    token = _parent.set(None)
+    try:
+        with span(name, **args):
+            yield
+    finally:
+        _parent.reset(token)
+
+
+class Span:
+    """An open span; end() records it. Returned by start_span() for code that cannot use `with`."""
+
+    def __init__(self, tracer, name, args):
+        self.tracer, self.name, self.args = tracer, name, args
+        self.span_id = tracer.next_id()
+        self.parent_id = _parent.get()
+        self._token = _parent.set(self.span_id)
+        self.start = time.perf_counter()
+
+    def end(self):
+        if self.tracer is None:
+            return
+        self.tracer.add(self.span_id, self.parent_id, self.name, self.start, time.perf_counter() - self.start, self.args)
+        try:
+            _parent.reset(self._token)
+        except ValueError:  # Ended in another context than it was started in; nesting already unwound
+            pass
+        self.tracer = None
+
+
+class _NoSpan:
+    def end(self):
+        pass
+
+
+_NO_SPAN = _NoSpan()
+
+
+def start_span(name, **args):
+    """Opens a span under the current one; call .end() on the result. No-op without an active tracer."""
+    tracer = _tracer.get()
+    return Span(tracer, name, args) if tracer is not None else _NO_SPAN
+
+
+@contextmanager
+def span(name, **args):
+    """Times the enclosed block as a span named `name` (args are shown in the trace viewer)."""
+    opened = start_span(name, **args)
+    try:
+        yield
+    finally:
+        opened.end()
+
+
+def traced(name=None):
+    """Decorator: every call of the function is a span (named after the function by default)."""
+    def decorator(func):
+        span_name = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _tracer.get() is None:
+                return func(*args, **kwargs)
+            with span(span_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def main():
+    if len(sys.argv) != 2:
+        print(__doc__)
+        sys.exit(1)
+    with open(sys.argv[1], "r", encoding="utf-8") as f:
+        rows = summarize(json.load(f)["traceEvents"])
+    print(f"{'Span':45s} {'count':>7s} {'total (ms)':>12s} {'self (ms)':>12s} {'mean (ms)':>11s} {'max (ms)':>11s}")
+    for r in rows:
+        print(f"{r['name'][:45]:45s} {r['count']:7d} {r['total_ms']:12.1f} {r['self_ms']:12.1f} "
+              f"{r['mean_ms']:11.1f} {r['max_ms']:11.1f}")
+
+
+if __name__ == "__main__":
+    main()
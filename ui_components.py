@@ -1,8 +1,17 @@
 import streamlit as st
 import pandas as pd
 import io
+import json
 
-def display_text_with_copy_and_download(label, text_content, height=200, key_suffix="", disabled=True, help_text=None, filename="downloaded_text.txt"):
+from config import TABLE_PARSE_CACHE_MAX_ENTRIES
+from table_validator import prescore_table
+from call_metrics import PHASES, metrics_report, metrics_csv
+from utils import content_hash, parse_table_text
+from pipeline import beam_lineage
+from history_store import run_bundle
+
+def display_text_with_copy_and_download(label, text_content, height=200, key_suffix="", disabled=True, help_text=None, filename="downloaded_text.txt",
+                                        download=True):
     """
     Displays text in a text_area with a copy hint and a download button.
     Args:
@@ -13,6 +22,7 @@ def display_text_with_copy_and_download(label, text_content, height=200, key_suf
         disabled (bool): Whether the text area should be disabled (read-only).
         help_text (str, optional): Help tooltip for the text area.
         filename (str): Default filename for downloaded text.
+        download (bool): Show the download button (its payload is sent to the browser on every render).
     """
     st.text_area(
         label,
@@ -24,7 +34,7 @@ def display_text_with_copy_and_download(label, text_content, height=200, key_suf
     )
     
     # Only show buttons if there is content
-    if text_content:
+    if text_content and download:
         col1, col2 = st.columns([0.6, 0.4]) # Adjust column ratios as needed
         with col1:
             # The "copy hint" button might be less necessary if the text_area help text is clear.
@@ -41,7 +51,7 @@ def display_text_with_copy_and_download(label, text_content, height=200, key_suf
             mime="text/plain",
             key=f"download_text_{key_suffix}"
         )
-    else:
+    elif not text_content:
         st.caption(f"{label} is empty.")
 
 
@@ -134,6 +144,200 @@ def display_df_with_download_and_copy(df, table_text, filename_prefix="table_rep
             key=f"download_raw_table_txt_{key_suffix}"
         )
 
+def live_table_callbacks(placeholder):
+    """
+    Returns (on_row, on_restart) callbacks that render a streamed table progressively.
+    Meant to be registered with table_stream.stream_listener while a generation runs.
+    Args:
+        placeholder: A Streamlit placeholder (st.empty()) to render into.
+    """
+    rows = []
+
+    def on_row(header, row, row_index):
+        if row_index == 0: # A new generation started (e.g. next optimization step)
+            rows.clear()
+        rows.append(row)
+        placeholder.dataframe(pd.DataFrame(rows, columns=header), use_container_width=True)
+
+    def on_restart(reason, attempt):
+        rows.clear()
+        placeholder.warning(f"Generation attempt {attempt} broke the table format and was restarted: {reason}")
+
+    return on_row, on_restart
+
+@st.cache_data(max_entries=TABLE_PARSE_CACHE_MAX_ENTRIES, show_spinner=False)
+def _parse_table_by_hash(table_hash, _table_text):
+    # Keyed by the content hash only (underscore args are not hashed by Streamlit).
+    # Parse errors are returned rather than raised so failing tables are cached too.
+    try:
+        df, processed_table_text = parse_table_text(_table_text)
+        return df, processed_table_text, None
+    except Exception as e:
+        return None, _table_text, str(e)
+
+
+def parse_table_cached(table_text):
+    """
+    Memoized utils.parse_table_text for rendering: the same table text is parsed once and
+    reused across reruns and sessions (bounded LRU, each caller gets its own DataFrame copy).
+    Returns:
+        tuple: (DataFrame or None, processed table text, error message or None)
+    """
+    return _parse_table_by_hash(content_hash(table_text), table_text)
+
+
+@st.cache_data(max_entries=TABLE_PARSE_CACHE_MAX_ENTRIES, show_spinner=False)
+def _prescore_by_hash(table_hash, current_year, future_year, _table_text):
+    return prescore_table(_table_text, current_year, future_year)
+
+
+def prescore_table_cached(table_text, current_year, future_year):
+    """Memoized table_validator.prescore_table, keyed by table content hash and year range."""
+    return _prescore_by_hash(content_hash(table_text), current_year, future_year, table_text)
+
+
+def display_prescore_report(report, expanded=False):
+    """
+    Shows the local (no-LLM) format checks of a table in an expander.
+    Args:
+        report (dict): Output of table_validator.prescore_table.
+    """
+    label = f"Local Format Checks: {report['local_score']}/{report['local_max']} pts"
+    label += " ✅" if report["passed"] else " ⚠️ (would be regenerated before evaluation)"
+    with st.expander(label, expanded=expanded):
+        if report.get("parse_error"):
+            st.warning(report["parse_error"])
+        rows = [{"Check": check_id, "Points": f"{c['awarded']}/{c['max']}", "Details": c["detail"]}
+                for check_id, c in sorted(report["checks"].items())]
+        if rows:
+            st.dataframe(pd.DataFrame(rows), use_container_width=True, hide_index=True)
+        st.caption("Computed locally from the rubric's rule-based parts; the evaluator LLM still scores the full rubric.")
+
+def display_usage_metrics(run_metrics, history, run_info=None, key_suffix="run"):
+    """
+    Shows where a run's LLM budget went (estimated tokens, LLM seconds and cost by phase and model)
+    with JSON and CSV metrics downloads.
+    Args:
+        run_metrics (dict): Run metrics (run_optimization result 'metrics', see call_metrics.py).
+        history (list): The run's history entries (per-step metrics for the downloads).
+        run_info (dict, optional): Extra fields for the JSON report header.
+    """
+    total = run_metrics["total"]
+    with st.expander(f"LLM Usage & Cost: {total['calls']} calls, ~{total['input_tokens'] + total['output_tokens']:,} tokens, "
+                     f"~${total['cost_usd']:.4f}", expanded=False):
+        phases = sorted(run_metrics["phases"], key=lambda p: PHASES.index(p) if p in PHASES else len(PHASES))
+        for title, group, names in (("Phase", "phases", phases), ("Model", "models", sorted(run_metrics["models"]))):
+            rows = [dict({title: name}, **run_metrics[group][name]) for name in names]
+            if rows:
+                df = pd.DataFrame(rows)
+                df["share_of_cost"] = (df["cost_usd"] / total["cost_usd"]).round(3) if total["cost_usd"] else 0.0
+                st.dataframe(df, use_container_width=True, hide_index=True)
+        st.caption("Tokens are estimated from the request/response text (~4 characters per token) and priced with "
+                   "MODEL_PRICING; LLM seconds are summed over calls, so parallel calls can exceed the wall time.")
+        col1, col2 = st.columns(2)
+        with col1:
+            st.download_button(
+                label="📥 Download Metrics (JSON)",
+                data=json.dumps(metrics_report(history, run_metrics, run_info), indent=2, default=str).encode('utf-8'),
+                file_name=f"optimization_metrics_{key_suffix}.json", mime="application/json",
+                key=f"download_metrics_json_{key_suffix}"
+            )
+        with col2:
+            st.download_button(
+                label="📥 Download Per-Step Metrics (CSV)",
+                data=metrics_csv(history).encode('utf-8'),
+                file_name=f"optimization_metrics_{key_suffix}.csv", mime="text/csv",
+                key=f"download_metrics_csv_{key_suffix}"
+            )
+
+def display_beam_lineage(history, key_suffix="run", load_candidate=None):
+    """
+    Per-beam lineage view of a beam search run: every candidate with its parent and score, and the
+    ancestry (prompt by prompt) of a selected candidate.
+    Args:
+        history (list): History of a pipeline.run_beam_optimization run (full entries or
+            history_store summaries, whose candidates have no prompts).
+        load_candidate (callable, optional): Candidate ID -> full candidate, for the selected candidate's
+            prompt when `history` holds summaries (e.g. HistoryStore.find_candidate).
+    """
+    candidates = {c["id"]: c for entry in history for c in entry.get("beam", [])}
+    if not candidates:
+        return
+    final_beam = [c["id"] for c in history[-1].get("beam", []) if c["kept"]]
+    with st.expander(f"Beam Search Lineage ({len(candidates)} candidates, final beam: {', '.join(final_beam)})"):
+        st.dataframe(pd.DataFrame([{
+            "step": c["step"], "candidate": c["id"], "parent": c["parent"], "proposal": c["proposal"],
+            "score": c["score"], "in final beam": c["id"] in final_beam,
+        } for c in sorted(candidates.values(), key=lambda c: (c["step"], c["id"]))]), use_container_width=True, hide_index=True)
+        scored = sorted((c for c in candidates.values() if c["score"] is not None), key=lambda c: c["score"], reverse=True)
+        options = final_beam + [c["id"] for c in scored if c["id"] not in final_beam]
+        selected = st.selectbox("Trace the lineage of", options, key=f"beam_lineage_select_{key_suffix}")
+        lineage = beam_lineage(history, selected)
+        st.markdown(" → ".join(f"`{c['id']}` ({c['score']})" for c in lineage))
+        for c in lineage[1:]:
+            parent = candidates.get(c["parent"])
+            st.caption(f"{c['id']}: proposal {c['proposal']} from {c['parent']}, score "
+                       f"{parent['score'] if parent else '?'} → {c['score']}")
+        selected_candidate = candidates[selected]
+        if "prompt" not in selected_candidate and load_candidate is not None:
+            selected_candidate = load_candidate(selected) or selected_candidate
+        display_text_with_copy_and_download(
+            f"System Prompt of Candidate {selected}", selected_candidate.get("prompt", ""), height=200,
+            key_suffix=f"beam_prompt_{key_suffix}_{selected}", filename=f"beam_candidate_{selected}_prompt.txt"
+        )
+
+def display_run_bundle_download(store, run_info=None, key_suffix="run"):
+    """
+    Download of a whole run as one ZIP (history_store.run_bundle). The archive is built when 'Prepare'
+    is clicked and only sent with that rerun: later reruns show the 'Prepare' button again instead of
+    rebuilding and re-sending it.
+    Args:
+        store (history_store.HistoryStore): The run's history.
+        run_info (dict, optional): Run fields for history.json (run ID, best step, stop reason, ...).
+    """
+    if not st.button("📦 Prepare Run Bundle (ZIP)", key=f"prepare_run_bundle_{key_suffix}",
+                     help="Every step's prompt, table, feedback and evaluation plus a summary CSV, in one archive."):
+        return
+    with st.spinner("Building the run bundle..."):
+        bundle = run_bundle(store, run_info)
+    st.download_button(f"📥 Download Run Bundle ({len(bundle) / 1024:,.0f} KB)", data=bundle,
+                       file_name=f"optimization_run_{key_suffix}.zip", mime="application/zip",
+                       key=f"download_run_bundle_{key_suffix}")
+
+def display_trace_summary(tracer):
+    """
+    Profiling mode panel: self/total time per span name of the session's trace, with trace file
+    download/save (Chrome trace format, see tracing.py) and a reset.
+    Args:
+        tracer (tracing.Tracer): The session's tracer.
+    """
+    st.header("Profiling")
+    rows = tracer.summary()
+    if not rows:
+        st.info("No spans recorded yet. Interact with the app or run an optimization with profiling mode on.")
+        return
+    reruns = next((r for r in rows if r["name"] == "streamlit_rerun"), None)
+    st.caption(f"{sum(r['count'] for r in rows)} spans"
+               + (f" over {reruns['count']} reruns (mean {reruns['mean_ms']:.0f} ms per rerun)" if reruns else "")
+               + (f"; {tracer.dropped} dropped (TRACE_MAX_SPANS reached)" if tracer.dropped else "")
+               + ". Self time excludes nested spans: it is the stage's own cost (rendering, parsing, waiting).")
+    st.dataframe(pd.DataFrame(rows), use_container_width=True, hide_index=True)
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        st.download_button(
+            label="📥 Download Trace (Chrome format)",
+            data=json.dumps(tracer.chrome_trace()).encode('utf-8'),
+            file_name="autoprompt_trace.json", mime="application/json", key="download_trace_json",
+            help="Open in chrome://tracing, https://ui.perfetto.dev or speedscope."
+        )
+    with col2:
+        if st.button("💾 Save Trace File", key="save_trace_button"):
+            st.success(f"Trace written to '{tracer.write()}'.")
+    with col3:
+        if st.button("🗑️ Clear Trace", key="clear_trace_button"):
+            tracer.clear()
+            st.rerun()
+
 def render_understanding_optimization_section():
     """Renders the explanation section about TextGrad optimization."""
     st.header("6. Understanding Optimization")
@@ -151,7 +355,7 @@ def render_understanding_optimization_section():
 
     **How This App Handles It:**
     * **Tracking the Best:** The app always saves the prompt that achieved the **highest score** during the optimization run (shown in Section 4). This ensures you don't lose the best result found. You can download this best prompt and also save it to your local library.
-    * **Viewing History:** The **Optimization History** (Section 5) allows you to see the prompt, score, and feedback for each step. This helps understand the optimization path. You can download prompts from history.
+    * **Viewing History:** The **Optimization History** (Section 5) allows you to see the prompt, score, and feedback for each step. This helps understand the optimization path. The summary table lists every step's score, change and timings; step details are shown a page at a time, and **Prepare Run Bundle** downloads all prompts, tables and evaluations as one ZIP.
     * **Prompt Library (New Feature):** In Section 1, you can load prompts from your saved library. In Section 4 (Best Optimization Result), there's an option to "Save this Best Prompt to Library".
     * **Continuing Optimization:** The editable prompt (in Section 3) is updated to the *final state* after the optimization loop finishes.
     """)
\ No newline at end of file
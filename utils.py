@@ -1,7 +1,19 @@
 import re
 import os
+import hashlib
+import io
+import csv
 import json
 from datetime import datetime
+from functools import lru_cache
+
+import pandas as pd
+
+from prompt_library import (
+    PROMPT_MARKER, get_library_index, parse_prompt_file, query_prompts, rank_prompts_for_context,
+    record_saved_prompt, validate_entry
+)
+from tracing import traced
 
 SAVED_PROMPTS_DIR = "saved_prompts"
 
@@ -12,7 +24,7 @@ def ensure_saved_prompts_dir():
         os.makedirs(SAVED_PROMPTS_DIR)
 
 def save_prompt_to_library(prompt_name, prompt_content, score=None, related_inputs=None):
-    """Saves a system prompt to the library."""
+    """Saves a system prompt to the library and updates the library index."""
     ensure_saved_prompts_dir()
     filename_base = "".join(c if c.isalnum() or c in (' ', '_', '-') else '_' for c in prompt_name).rstrip()
     filename = f"{filename_base}.txt"
@@ -27,12 +39,14 @@ def save_prompt_to_library(prompt_name, prompt_content, score=None, related_inpu
         if context_inputs:
             file_content += f"# Context Inputs: {json.dumps(context_inputs)}\n"
     file_content += f"# Saved At: {datetime.now().isoformat()}\n"
-    file_content += "# --- BEGIN PROMPT ---\n"
+    file_content += f"{PROMPT_MARKER}\n"
     file_content += prompt_content
     
     try:
+        get_library_index(SAVED_PROMPTS_DIR) # Index must be current before the incremental update below
         with open(filepath, "w", encoding="utf-8") as f:
             f.write(file_content)
+        record_saved_prompt(SAVED_PROMPTS_DIR, filename)
         return True
     except Exception as e:
         print(f"Failed to save prompt '{prompt_name}': {e}") # Add a print for debugging
@@ -44,24 +58,11 @@ def load_prompt_from_library(filename):
     filepath = os.path.join(SAVED_PROMPTS_DIR, filename)
     try:
         with open(filepath, "r", encoding="utf-8") as f:
-            lines = f.readlines()
-        prompt_content_lines = []
-        found_marker = False
-        for line in lines:
-            if line.strip() == "# --- BEGIN PROMPT ---":
-                found_marker = True
-                continue
-            if found_marker:
-                prompt_content_lines.append(line)
-        
-        if not found_marker and lines:
-            return "".join(lines) # Fallback: load whole file if no marker but content exists
-        elif not prompt_content_lines and not found_marker and not lines: # File is truly empty
-            return ""
-        elif not prompt_content_lines and found_marker: # Marker exists, but no content after
-             return ""
-
-        return "".join(prompt_content_lines)
+            text = f.read()
+        validate_entry(SAVED_PROMPTS_DIR, filename) # Keep the index in sync with in-place edits
+        # Files without the marker are loaded whole
+        _, prompt_content = parse_prompt_file(text)
+        return prompt_content
     except FileNotFoundError:
         print(f"Prompt file '{filename}' not found in '{SAVED_PROMPTS_DIR}'.") # Add a print for debugging
         return None
@@ -70,72 +71,206 @@ def load_prompt_from_library(filename):
         return None
 
 
-def get_saved_prompts_list():
-    """Returns a list of filenames of saved prompts, sorted by modification time (newest first)."""
+def get_saved_prompts_list(sort_by="saved", min_score=None, industry=None, region=None):
+    """
+    Returns a list of filenames of saved prompts, newest first by default.
+    Served from the persistent library index (prompt_library.py) instead of scanning the directory.
+    Args:
+        sort_by (str): "saved", "score" or "name".
+        min_score (int, optional): Only prompts saved with at least this score.
+        industry, region (str, optional): Substring filters on the prompt's saved context inputs.
+    """
     ensure_saved_prompts_dir()
     try:
-        files = [f for f in os.listdir(SAVED_PROMPTS_DIR) if f.endswith(".txt")]
-        # Sort files by modification time, newest first
-        files.sort(key=lambda f: os.path.getmtime(os.path.join(SAVED_PROMPTS_DIR, f)), reverse=True)
-        return files
+        entries = query_prompts(SAVED_PROMPTS_DIR, sort_by=sort_by, descending=(sort_by != "name"),
+                                min_score=min_score, industry=industry, region=region)
+        return [entry["filename"] for entry in entries]
     except Exception as e:
         print(f"Error listing saved prompts: {e}") # Add a print for debugging
         return []
 
 
-def parse_evaluation_output(output_text):
-    """
-    Parses scoring description, score, and feedback from the evaluator LLM's output.
-    Assumes the structure specified in EVALUATION_PROMPT_TEMPLATE.
-    """
-    score = None
-    scoring_description = "Could not parse scoring description from evaluation output."
-    feedback = "Could not parse feedback from evaluation output."
+def get_saved_prompts_index():
+    """Returns {filename: metadata} for all saved prompts (name, score, context inputs, saved time, ...)."""
+    ensure_saved_prompts_dir()
+    return get_library_index(SAVED_PROMPTS_DIR)
 
-    if not output_text or not isinstance(output_text, str):
-        return score, scoring_description, feedback
 
+def suggest_warm_start_prompts(user_input_data, top_k=3):
+    """
+    Returns the saved prompts best suited as a starting point for this profile (see
+    prompt_library.rank_prompts_for_context), best first. Each entry has 'similarity' and 'rank_score'.
+    """
+    ensure_saved_prompts_dir()
     try:
-        # Regex for Scoring Description
-        # This now captures EVERYTHING after "## Scoring Description:"
-        # up to the next main header or end of string.
-        desc_match = re.search(
-            r"## Scoring Description:\s*(.*?)(?=\n## Overall Score:|\n## System Prompt Improvement Feedback:|\Z)",
-            output_text, re.IGNORECASE | re.DOTALL
-        )
-        if desc_match:
-            scoring_description = desc_match.group(1).strip()
-        
-        # Regex for Overall Score
-        score_match = re.search(
-            r"## Overall Score:\s*`?score`?:\s*(\d+)",
-            output_text, re.IGNORECASE
-        )
-        if score_match:
-            try:
-                score = int(score_match.group(1))
-            except ValueError:
-                print(f"Warning: Could not convert score to int: {score_match.group(1)}")
-
-        # Regex for System Prompt Improvement Feedback
-        # This now captures EVERYTHING after "## System Prompt Improvement Feedback:"
-        # up to the end of the string.
-        feedback_match = re.search(
-            r"## System Prompt Improvement Feedback:\s*(.*)",
-            output_text, re.IGNORECASE | re.DOTALL
-        )
-        if feedback_match:
-            feedback = feedback_match.group(1).strip()
-            
+        return rank_prompts_for_context(SAVED_PROMPTS_DIR, user_input_data, top_k=top_k)
     except Exception as e:
-        print(f"Error parsing evaluation output: {e}")
+        print(f"Error ranking saved prompts for warm start: {e}") # Add a print for debugging
+        return []
 
-    return score, scoring_description, feedback
 
+def load_warm_start_prompt(user_input_data):
+    """
+    Loads the best library match for this profile.
+    Returns:
+        tuple: (prompt text, match entry) or (None, None) if the library has no match.
+    """
+    for match in suggest_warm_start_prompts(user_input_data, top_k=3):
+        prompt_text = load_prompt_from_library(match["filename"])
+        if prompt_text:
+            return prompt_text, match
+    return None, None
+
+
+def find_table_header_index(lines):
+    """
+    Returns the index of the table header line (the first line that *starts* with "Strategic Imperative"
+    and contains tab characters, suggesting it's a TSV header), or 0 if none is found.
+    """
+    for i, line in enumerate(lines):
+        # Check if the line starts with a known header and has tabs (likely a TSV header)
+        if line.strip().lower().startswith('"strategic imperative"') and '\t' in line:
+            return i
+        # Fallback for slightly different quoting, if necessary
+        elif line.strip().lower().startswith('strategic imperative') and '\t' in line:
+            return i
+    return 0
 
 
+def content_hash(text):
+    """Returns the SHA-256 hex digest of a text (used as a cache key for parsed tables)."""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
 
 
+def estimate_tokens(text):
+    """Rough token count (~4 characters per token), good enough for reporting savings and cache eligibility."""
+    return (len(text) + 3) // 4 if text else 0
+
+
+@traced("parse_table_text")
+def parse_table_text(table_text):
+    """
+    Parses generated TSV table text into a DataFrame (all columns as strings).
+    Any text before the header line is skipped. Raises on pandas parsing errors.
+    Returns:
+        tuple: (DataFrame, processed table text starting at the header)
+    """
+    lines = table_text.strip().split('\n')
+    processed_table_text = "\n".join(lines[find_table_header_index(lines):])
+    df = pd.read_csv(io.StringIO(processed_table_text), sep='\t', quotechar='"', quoting=csv.QUOTE_MINIMAL,
+                     keep_default_na=False, dtype=str, skipinitialspace=True)
+    return df, processed_table_text
+
+
+# Evaluation output parsing: one pass over the section headers, then small searches inside each section
+_EVAL_HEADER_RE = re.compile(
+    r"^[ \t>]*(?:#{1,6}[ \t]*)?\**[ \t]*(scoring description|overall score|system prompt improvement feedback)"
+    r"[ \t]*(\(restated\))?[ \t]*\**[ \t]*:?[ \t]*\**",
+    re.IGNORECASE | re.MULTILINE
+)
+_STATED_SCORE_RE = re.compile(r"`?score`?\s*\**\s*:\s*\**\s*(\d{1,3})\b", re.IGNORECASE)
+_LEADING_SCORE_RE = re.compile(r"\A[\s*`]*(\d{1,3})\s*(?:/\s*100)?\b")
+_GRAND_TOTAL_RE = re.compile(r"grand total[^\n]*?=\s*(\d{1,3})\s*\**\s*$", re.IGNORECASE | re.MULTILINE)
+_AWARDED_RE = re.compile(r"awarded\W{0,3}(\d+(?:\.\d+)?)\s*(?:/|out of)\s*(\d+(?:\.\d+)?)", re.IGNORECASE)
+RUBRIC_TOTAL_POINTS = 100  # Sum of the sub-criterion maxima in EVALUATION_PROMPT_TEMPLATE
+
+
+def parse_evaluation_details(output_text):
+    """
+    Parses the evaluator output (structure of EVALUATION_PROMPT_TEMPLATE) and verifies its score.
+    Every "Awarded X/Y pts" sub-criterion of the scoring description is summed locally. If the
+    sub-criteria cover the whole rubric (maxima add up to 100), that sum is authoritative: it
+    replaces a missing or unreadable Overall Score, and a stated score that disagrees with it.
+    Otherwise the stated score is used as is (a mismatch is still flagged).
+    Parses are cached per text; every call gets its own copy of the result.
+    Returns:
+        dict: score (int or None, after repair), stated_score, computed_score, max_points, criteria
+              (list of [awarded, max]), mismatch (bool), repair (None, 'missing_score', 'sum_mismatch',
+              'restated'), description, feedback.
+    """
+    details = _parse_evaluation_details_cached(output_text)
+    return dict(details, criteria=[list(c) for c in details["criteria"]])
+
+
+@lru_cache(maxsize=64)
+def _parse_evaluation_details_cached(output_text):
+    # Shared by all callers: criteria are stored as tuples, the public function copies the dict
+    details = {
+        "score": None, "stated_score": None, "computed_score": None, "max_points": None, "criteria": (),
+        "mismatch": False, "repair": None,
+        "description": "Could not parse scoring description from evaluation output.",
+        "feedback": "Could not parse feedback from evaluation output.",
+    }
+    if not output_text or not isinstance(output_text, str):
+        return details
+
+    sections = {}
+    # Markdown headers, or a bold/plain "Overall Score:" line (a header without '#' needs its colon)
+    headers = [h for h in _EVAL_HEADER_RE.finditer(output_text)
+               if h.group(0).lstrip(" \t>").startswith("#") or ":" in h.group(0)]
+    for i, header in enumerate(headers):
+        name = header.group(1).lower()
+        if header.group(2):
+            name += " (restated)"
+        body = output_text[header.end():headers[i + 1].start() if i + 1 < len(headers) else len(output_text)]
+        sections.setdefault(name, body.strip())
+    if "scoring description" in sections:
+        details["description"] = sections["scoring description"]
+    if "system prompt improvement feedback" in sections:
+        details["feedback"] = sections["system prompt improvement feedback"]
+
+    stated = None
+    score_text = sections.get("overall score")
+    if score_text is not None:
+        match = _STATED_SCORE_RE.search(score_text) or _LEADING_SCORE_RE.search(score_text) \
+            or _GRAND_TOTAL_RE.search(score_text)
+        if match and int(match.group(1)) <= RUBRIC_TOTAL_POINTS:
+            stated = int(match.group(1))
+    if stated is None and "overall score (restated)" in sections:
+        match = _STATED_SCORE_RE.search(sections["overall score (restated)"])
+        if match and int(match.group(1)) <= RUBRIC_TOTAL_POINTS:
+            stated = int(match.group(1))
+            details["repair"] = "restated"
+    details["stated_score"] = stated
+
+    criteria = tuple((float(a), float(m)) for a, m in _AWARDED_RE.findall(sections.get("scoring description", output_text)))
+    details["criteria"] = criteria
+    if criteria:
+        details["computed_score"] = round(sum(a for a, _ in criteria), 1)
+        details["max_points"] = round(sum(m for _, m in criteria), 1)
+    computed = details["computed_score"]
+    complete = details["max_points"] == RUBRIC_TOTAL_POINTS and all(a <= m for a, m in criteria)
+    details["mismatch"] = stated is not None and computed is not None and abs(stated - computed) >= 0.5
+
+    if stated is not None and not (details["mismatch"] and complete):
+        details["score"] = stated
+    elif complete:
+        details["score"] = int(round(computed))
+        details["repair"] = "sum_mismatch" if stated is not None else "missing_score"
+    return details
+
+
+@traced("parse_evaluation_output")
+def parse_evaluation_output(output_text):
+    """
+    Parses scoring description, score, and feedback from the evaluator LLM's output.
+    Assumes the structure specified in EVALUATION_PROMPT_TEMPLATE; the score is verified against
+    the awarded sub-criterion points (see parse_evaluation_details).
+    """
+    details = parse_evaluation_details(output_text if isinstance(output_text, str) else None)
+    if details["repair"] in ("missing_score", "sum_mismatch"):
+        print(f"Evaluation score repaired locally ({details['repair']}): stated {details['stated_score']}, "
+              f"sub-criteria sum {details['computed_score']}/{details['max_points']}.")
+    return details["score"], details["description"], details["feedback"]
+
+
+def score_check(output_text):
+    """Compact record of the score verification of an evaluation (stored in history entries as 'score_check')."""
+    details = parse_evaluation_details(output_text if isinstance(output_text, str) else None)
+    check = {key: details[key] for key in ("stated_score", "computed_score", "max_points", "mismatch", "repair")}
+    check["criteria"] = len(details["criteria"])
+    return check
+
 
 # import re
 # import os